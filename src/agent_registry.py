@@ -0,0 +1,297 @@
+""" Several dialogue agents behind one, loaded when they're first needed and unloaded again when memory runs short.
+
+The agents and the messages of the system come from a dialogue config, a JSON file (see load_dialogue_config) whose
+keys override DEFAULT_DIALOGUE_CONFIG, e.g.
+
+    {"default_agent": "blenderbot-400m",
+     "memory_budget_mb": 6000,
+     "routes": [{"agent": "blenderbot-1b", "prefixes": ["think hard about", "tell me more about"]}]}
+
+- AgentRegistry loads an agent the first time it is used. The memory_mb estimates of the loaded agents are kept under
+  memory_budget_mb by unloading the least recently used ones that aren't generating, and agents that haven't been
+  used for idle_unload_s are unloaded too, so the big model is only resident while it's wanted.
+- RoutedAgent looks like any other agent to the control module and the dialogue server. Each session (a
+  RoutedState) has an agent, the default_agent unless it asked for another, and every request is checked against the
+  routes first: one starting with one of a route's prefixes goes to the route's agent without the prefix, as does one
+  of at least its min_words words. Every agent keeps its own conversation state within the RoutedState.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+import gc
+import json
+import sys
+
+DEFAULT_AGENTS = {
+    # memory_mb is a rough guess at the resident size with the int8 backend, set it for your setup
+    "blenderbot-400m": {"type": "BlenderBot", "model_name": "facebook/blenderbot-400M-distill", "memory_mb": 1200},
+    "blenderbot-1b": {"type": "BlenderBot", "model_name": "facebook/blenderbot-1B-distill", "memory_mb": 2800},
+    "dialogpt": {"type": "DialogueGPT", "model_name": "microsoft/DialoGPT-medium", "memory_mb": 1000},
+    "stub": {"type": "Stub", "memory_mb": 0},
+}
+
+DEFAULT_DIALOGUE_CONFIG = {
+    "hello_message": "Hello! My name is Rose. How are you today? What would you like to talk about?",
+    "shutdown_message": "I'm going to sleep now. Let's talk more soon.",
+    "reprompt_message": "Sorry, I didn't catch that. Could you say it again?",
+    "okay_message": "Okay.",
+    "commands": None,  # command name -> phrases, None for the ones in commands.py
+    "agents": DEFAULT_AGENTS,
+    "default_agent": "blenderbot-400m",
+    "memory_budget_mb": 4000,  # None for no limit
+    "idle_unload_s": 600.0,  # None to keep idle agents until the memory is needed
+    "routes": [],
+}
+
+
+def load_dialogue_config(path=None):
+    """
+    :param path: JSON file with the keys to override, None for the defaults
+    :return: the dialogue config dict
+    """
+    config = dict(DEFAULT_DIALOGUE_CONFIG)
+    if path is not None:
+        with open(path) as f:
+            config.update(json.load(f))
+    if config["default_agent"] not in config["agents"]:
+        raise ValueError("default agent {} is not one of the agents {}".format(config["default_agent"],
+                                                                               sorted(config["agents"])))
+    for route in config["routes"]:
+        if route["agent"] not in config["agents"]:
+            raise ValueError("route to unknown agent {}".format(route["agent"]))
+    return config
+
+
+class AgentRegistry:
+    """ Loads agents by name on first use and unloads them to stay within a memory budget, see the top of this file.
+
+    Loading happens under the registry's lock, so a second thread asking for the agent being loaded waits for it
+    rather than loading another copy."""
+
+    def __init__(self, specs, factory, memory_budget_mb=None, idle_unload_s=None):
+        """
+        :param specs: dict of agent name -> spec dict, with at least "memory_mb"
+        :param factory: makes an agent from a spec
+        :param memory_budget_mb: most memory the loaded agents may take together, None for no limit
+        :param idle_unload_s: unload agents that haven't been used for this long (see unload_idle), None to not
+        """
+        self.specs = specs
+        self.factory = factory
+        self.memory_budget_mb = memory_budget_mb
+        self.idle_unload_s = idle_unload_s
+        self.loaded = OrderedDict()  # name -> agent, least recently used first
+        self.last_used = {}
+        self.in_use = {}  # name -> number of generations running, those aren't unloaded
+        self.lock = Lock()
+
+        # metrics
+        self.loads = 0
+        self.unloads = 0
+        self.load_s = 0.0
+
+    def memory_mb(self):
+        return sum(self.specs[name].get("memory_mb", 0) for name in self.loaded)
+
+    def _evict_for(self, needed_mb):
+        """ unload least recently used idle agents until needed_mb more fits in the budget"""
+        if self.memory_budget_mb is None:
+            return
+        for name in list(self.loaded):
+            if self.memory_mb() + needed_mb <= self.memory_budget_mb:
+                return
+            if not self.in_use.get(name):
+                self._unload(name, "to make room")
+        if self.memory_mb() + needed_mb > self.memory_budget_mb:
+            print("AGENTS: over the memory budget of {} MB, {} MB loaded plus {} MB".format(
+                self.memory_budget_mb, self.memory_mb(), needed_mb))
+
+    def _unload(self, name, reason):
+        del self.loaded[name]
+        self.unloads += 1
+        gc.collect()  # the model is only freed once nothing refers to it, a generation in flight holds on to it
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print("AGENTS: unloaded {} {}".format(name, reason))
+
+    def get(self, name: str):
+        """ the agent, loading it first if need be"""
+        if name not in self.specs:
+            raise ValueError("unknown agent {}, have {}".format(name, sorted(self.specs)))
+        with self.lock:
+            if name not in self.loaded:
+                spec = self.specs[name]
+                self._evict_for(spec.get("memory_mb", 0))
+                start = time()
+                self.loaded[name] = self.factory(spec)
+                self.loads += 1
+                self.load_s += time() - start
+                print("AGENTS: loaded {} in {:.1f}s, {} MB of agents loaded".format(name, time() - start,
+                                                                                  self.memory_mb()))
+            self.loaded.move_to_end(name)
+            self.last_used[name] = time()
+            return self.loaded[name]
+
+    def peek(self, name: str):
+        """ the agent if it's loaded, else None. Doesn't load it or count as using it"""
+        with self.lock:
+            return self.loaded.get(name)
+
+    @contextmanager
+    def using(self, name: str):
+        """ the agent for a generation, it isn't unloaded until the with block ends"""
+        agent = self.get(name)
+        with self.lock:
+            self.in_use[name] = self.in_use.get(name, 0) + 1
+        try:
+            yield agent
+        finally:
+            with self.lock:
+                self.in_use[name] -= 1
+                self.last_used[name] = time()
+
+    def unload_idle(self, now=None):
+        """ unload the agents nobody has used for idle_unload_s. Call now and then"""
+        if self.idle_unload_s is None:
+            return
+        now = time() if now is None else now
+        with self.lock:
+            for name in list(self.loaded):
+                if not self.in_use.get(name) and now - self.last_used[name] > self.idle_unload_s:
+                    self._unload(name, "after {:.0f}s idle".format(now - self.last_used[name]))
+
+    def stats(self):
+        return {"loaded": list(self.loaded), "memory_mb": self.memory_mb(), "loads": self.loads,
+                "unloads": self.unloads, "load_s": self.load_s}
+
+
+class RoutedState:
+    """ Conversation state for a RoutedAgent: the session's agent and the state of every agent it has talked to"""
+
+    def __init__(self, agent_name=None):
+        self.agent_name = agent_name  # None for the default agent
+        self.states = {}  # agent name -> that agent's state
+
+    def fork(self):
+        forked = RoutedState(self.agent_name)
+        forked.states = {name: state.fork() if state is not None else None for name, state in self.states.items()}
+        return forked
+
+    def adopt(self, other):
+        self.states = other.states
+
+
+class RoutedAgent:
+    """ An agent that hands every request to one of the agents in an AgentRegistry, see the top of this file"""
+
+    def __init__(self, registry: AgentRegistry, default: str, routes=()):
+        """
+        :param registry: the AgentRegistry
+        :param default: name of the agent for sessions that don't ask for one
+        :param routes: list of route dicts with "agent" and optionally "prefixes" and "min_words"
+        """
+        self.registry = registry
+        self.default = default
+        self.routes = [dict(route, prefixes=[p.lower() for p in route.get("prefixes", ())]) for route in routes]
+        self.state = self.new_state()  # used when no state is passed in
+        # of the last reply. Not the agent itself, holding on to that would keep it in memory after it's unloaded
+        self.last_timings = None
+        self.requests = {}  # agent name -> requests routed to it
+
+    def new_state(self, agent_name=None):
+        """
+        :param agent_name: the agent of this session, None for the default
+        """
+        if agent_name is not None and agent_name not in self.registry.specs:
+            raise ValueError("unknown agent {}".format(agent_name))
+        return RoutedState(agent_name)
+
+    def route(self, query: str, state=None):
+        """ which agent gets query, and what it gets of it
+
+        :return: (agent name, query)
+        """
+        state = self.state if state is None else state
+        lowered = query.lower()
+        for route in self.routes:
+            for prefix in route["prefixes"]:
+                if lowered.startswith(prefix) and lowered[len(prefix):len(prefix) + 1] in ("", " "):
+                    return route["agent"], query[len(prefix):].strip()
+            if "min_words" in route and len(query.split()) >= route["min_words"]:
+                return route["agent"], query
+        return state.agent_name or self.default, query
+
+    def _sub_state(self, state, name, agent):
+        """ the agent's own state within state, made the first time the agent is used in this conversation"""
+        state = self.state if state is None else state
+        if name not in state.states:
+            state.states[name] = agent.new_state()
+        return state.states[name]
+
+    def _count(self, name):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    def get_response(self, query: str, state=None, stop_event=None):
+        name, query = self.route(query, state)
+        self._count(name)
+        with self.registry.using(name) as agent:
+            reply = agent.get_response(query, self._sub_state(state, name, agent), stop_event=stop_event)
+            self.last_timings = agent.last_timings
+        return reply
+
+    def get_responses(self, queries, states=None):
+        """ Batched get_response. The requests are grouped by agent, one batch per agent"""
+        states = [None] * len(queries) if states is None else states
+        groups = OrderedDict()  # agent name -> [(position, query, state)]
+        for i, (query, state) in enumerate(zip(queries, states)):
+            name, query = self.route(query, state)
+            groups.setdefault(name, []).append((i, query, state))
+        replies = [None] * len(queries)
+        for name, group in groups.items():
+            self.requests[name] = self.requests.get(name, 0) + len(group)
+            with self.registry.using(name) as agent:
+                sub_states = [self._sub_state(state, name, agent) for _, _, state in group]
+                for (i, _, _), reply in zip(group, agent.get_responses([q for _, q, _ in group], sub_states)):
+                    replies[i] = reply
+        return replies
+
+    def get_response_stream(self, query: str, state=None):
+        name, query = self.route(query, state)
+        self._count(name)
+        with self.registry.using(name) as agent:
+            stream = agent.get_response_stream(query, self._sub_state(state, name, agent))
+            try:
+                for chunk in stream:
+                    yield chunk
+            finally:
+                stream.close()  # stops the generation if we were closed early
+            self.last_timings = agent.last_timings
+
+    def context_key(self, state=None, turns=1, query=None):
+        """ the context of the agent query is routed to, for the response cache. None if that agent isn't loaded, as
+        its context can't be worked out without it and a cache lookup shouldn't load a model (or keep one loaded)"""
+        name, query = self.route(query or "", state)
+        agent = self.registry.peek(name)
+        if agent is None:
+            return None
+        context = agent.context_key(self._sub_state(state, name, agent), turns, query=query)
+        return None if context is None else (name,) + tuple(context)
+
+    def record_exchange(self, query: str, reply: str, state=None):
+        name, query = self.route(query, state)
+        agent = self.registry.get(name)
+        agent.record_exchange(query, reply, self._sub_state(state, name, agent))
+
+    def stats(self):
+        return dict(self.registry.stats(), requests=self.requests)
+
+
+def make_routed_agent(config, factory):
+    """
+    :param config: dialogue config, see load_dialogue_config
+    :param factory: makes an agent from one of the config's agent specs
+    :return: RoutedAgent over a new AgentRegistry
+    """
+    registry = AgentRegistry(config["agents"], factory, config["memory_budget_mb"], config["idle_unload_s"])
+    return RoutedAgent(registry, config["default_agent"], config["routes"])
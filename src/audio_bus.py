@@ -0,0 +1,154 @@
+""" Shared memory audio bus.
+
+Raw PCM lives in ring buffers in shared memory (multiprocessing.shared_memory), so any process on the box can read
+the microphone audio or the audio being played without it being copied through a socket. The layout is
+
+    header  64 bytes: write index, capacity, sample rate, channels, bytes per sample, magic
+    data    capacity int16 samples
+
+There is a single writer per ring. Positions are absolute sample counts since the ring was created, as in the in
+process AudioRingBuffer of speech_to_text.py, so readers can tell when they've been lapped. What goes over ZMQ is only
+an AUDIO message saying which ring and which span of it (see span_message), the reader then looks at the samples in
+place with views().
+"""
+from multiprocessing import shared_memory, resource_tracker
+import struct
+import sys
+from threading import Condition
+from time import time, sleep
+import numpy as np
+import message_schema as ms
+
+MAGIC = b"SVAB"
+HEADER_BYTES = 64
+_HEADER = struct.Struct("=QQIHH4s")  # write index first, so it's 8 byte aligned
+_SPAN = struct.Struct("!QI")  # start, count
+
+
+class SharedAudioRing:
+    """ int16 ring buffer in shared memory, same interface as AudioRingBuffer plus zero copy views"""
+
+    def __init__(self, name: str, capacity_samples=0, sample_rate=16000, channels=1, create=False):
+        """
+        :param name: shared memory name, e.g. stack name + "-capture"
+        :param capacity_samples: ring size, only used when creating
+        :param sample_rate: only used when creating, readers get it from the header
+        :param channels: only used when creating
+        :param create: True in the one process that writes to the ring, False to attach to an existing one
+        """
+        self.name = name
+        self.is_writer = create
+        if create:
+            size = HEADER_BYTES + 2 * capacity_samples
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # left behind by a writer that crashed, there can only be one writer so it's ours to replace
+                stale = _attach(name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.shm.buf[:_HEADER.size] = _HEADER.pack(0, capacity_samples, sample_rate, channels, 2, MAGIC)
+        else:
+            self.shm = _attach(name)
+        _, self.capacity, self.sample_rate, self.channels, self.bytes_per_sample, magic = \
+            _HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("shared memory {} is not an audio ring".format(name))
+        self._write_index = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf, offset=0)
+        self.buffer = np.ndarray((self.capacity,), dtype=np.int16, buffer=self.shm.buf, offset=HEADER_BYTES)
+        self.condition = Condition()  # wakes up readers in the writer's own process
+
+    @property
+    def write_index(self):
+        return int(self._write_index[0])
+
+    def write(self, samples):
+        """ copy samples into the ring, then publish the new write index (only ever from the one writer)"""
+        n = len(samples)
+        if n > self.capacity:
+            samples = samples[-self.capacity:]
+            n = self.capacity
+        write_index = self.write_index
+        start = write_index % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+        with self.condition:
+            self._write_index[0] = write_index + n  # after the samples, so readers never see an index ahead of them
+            self.condition.notify_all()
+
+    def oldest_index(self):
+        return max(0, self.write_index - self.capacity)
+
+    def wait_for(self, index: int, timeout=None, poll_s=0.005):
+        """ block until the writer has got to index. Returns False on time out. Readers in other processes can't be
+        woken up, they poll the header every poll_s (or wait for an AUDIO message)"""
+        if self.is_writer:
+            with self.condition:
+                return self.condition.wait_for(lambda: self.write_index >= index, timeout)
+        deadline = None if timeout is None else time() + timeout
+        while self.write_index < index:
+            if deadline is not None and time() >= deadline:
+                return False
+            sleep(poll_s)
+        return True
+
+    def views(self, start: int, count: int):
+        """ the samples [start, start + count) as one or two numpy views into shared memory, no copying. Only valid
+        until the writer laps them, so check start >= oldest_index() after using them if it matters"""
+        start = max(start, self.oldest_index())
+        count = min(count, self.write_index - start)
+        if count <= 0:
+            return []
+        offset = start % self.capacity
+        first = min(count, self.capacity - offset)
+        if first == count:
+            return [self.buffer[offset:offset + count]]
+        return [self.buffer[offset:], self.buffer[:count - first]]
+
+    def read_into(self, out, read_index: int):
+        """ copy len(out) samples starting at read_index into the preallocated array out.
+
+        :return: the read index after the copy, which may have jumped forward if the reader had been lapped
+        """
+        read_index = max(read_index, self.oldest_index())
+        n = len(out)
+        start = read_index % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:] = self.buffer[:n - first]
+        return read_index + n
+
+    def close(self):
+        """ detach, and remove the shared memory if we made it"""
+        # the numpy views have to go before the memory can be released
+        self._write_index = None
+        self.buffer = None
+        self.shm.close()
+        if self.is_writer:
+            self.shm.unlink()
+
+
+def _attach(name: str):
+    """ open existing shared memory without handing it to the resource tracker. Before python 3.13 attaching registers
+    the segment too, and the tracker would unlink it when a reader exits while the writer is still using it"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def span_message(ring: SharedAudioRing, start: int, count: int, trace_id=0):
+    """ an AUDIO message pointing at samples [start, start + count) of the ring"""
+    return ms.Message(ms.AUDIO, ring.name, data=_SPAN.pack(start, count), trace_id=trace_id)
+
+
+def parse_span(msg):
+    """ (ring name, start, count) from an AUDIO message"""
+    start, count = _SPAN.unpack(msg.data)
+    return msg.text, start, count
@@ -0,0 +1,328 @@
+""" Offline replay benchmark.
+
+Runs the turn loop (listen, respond, speak) without a microphone, speakers or pico2wave, so the numbers can be
+reproduced on a headless box:
+
+    microphone  a directory of .wav files, one utterance each, replayed through VoiceCapture's recognition path (VAD,
+                endpointing and Vosk) by a stand in for the blocking pyaudio stream. Each file is followed by some
+                silence so the utterance can end the way it would live
+    agent       the deterministic StubAgent by default, or any agent make_agent knows about (e.g. a small local model)
+    speakers    a null sink that plays nothing, but still counts how long the audio would have played for (and waits
+                that long with realtime=True). Synthesis is pico2wave if asked for, otherwise silence of about the
+                right length
+
+The stages are timed with the same spans as the live system (see tracing.py) and summarized by a MetricsCollector.
+end_of_speech is measured from where the speech in the file really ends to when its transcript came out, so
+end_to_first_audio is the whole turn as the user would feel it. On top of that it reports throughput, CPU seconds
+per stage and the memory of the process.
+
+With realtime=False (the default) audio is fed as fast as it can be recognized, which measures processing cost.
+realtime=True paces the audio at the speed a microphone would deliver it, which measures latency as a user gets it.
+
+python3 benchmark.py ../benchmarks/utterances
+"""
+import os
+import sys
+import wave
+from threading import Event
+from time import sleep, time, process_time
+import numpy as np
+import message_schema as ms
+from speech_to_text import VoiceCapture, EndpointPolicy, pwd_vosk_model
+from voice_activity import VADGate, EnergyVAD
+from dialogue_control import make_agent
+from text_to_speech import PcmAudio, Pico2WaveBackend, StreamingSpeaker
+from tracing import Tracer, MetricsCollector, span_record
+
+# psutil is optional, it gives the current memory use. Without it only the peak is reported, and not on windows
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# fake microphone
+
+def load_wav(path: str, rate=16000):
+    """ int16 mono samples of a wav file at the given rate. Stereo is mixed down and other rates are resampled"""
+    with wave.open(path, "rb") as wf:
+        if wf.getsampwidth() != 2:
+            raise ValueError("{} is not 16 bit audio".format(path))
+        channels, file_rate = wf.getnchannels(), wf.getframerate()
+        samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    if file_rate != rate:
+        n_out = int(len(samples) * rate / file_rate)
+        samples = np.interp(np.arange(n_out) * file_rate / rate, np.arange(len(samples)), samples)
+    return samples.astype(np.int16)
+
+
+class WavReplayStream:
+    """ Stands in for a blocking pyaudio input stream, reading a list of wav files one after the other with silence
+    in between. The files are loaded up front so disk reads aren't part of the timings.
+
+    Remembers when the speech of each file was handed out (speech_ended), so the benchmark can tell how long the
+    transcript took after the user really stopped talking."""
+
+    def __init__(self, paths, rate=16000, trailing_silence_s=1.5, realtime=False):
+        """
+        :param paths: wav files, one utterance each
+        :param rate: sample rate the recognizer wants
+        :param trailing_silence_s: silence after each file, has to be longer than it takes to end an utterance
+        :param realtime: hand out audio no faster than a microphone would
+        """
+        self.rate = rate
+        self.realtime = realtime
+        silence = np.zeros(int(trailing_silence_s * rate), dtype=np.int16)
+        utterances = [load_wav(path, rate) for path in paths]
+        self.speech_ends = list(np.cumsum([len(u) + len(silence) for u in utterances]) - len(silence))
+        self.audio = np.concatenate([part for u in utterances for part in (u, silence)])
+        self.speech_s = sum(len(u) for u in utterances) / float(rate)
+        self.position = 0
+        self.end_times = {}  # file index -> time() its last sample of speech was read
+        self.claimed = -1  # speech ends up to here have already been matched with a transcript
+        self.clock_start = None
+
+    def start_stream(self):
+        # the clock only runs while the stream does, same as a stopped microphone
+        self.clock_start = time() - self.position / float(self.rate)
+
+    def stop_stream(self):
+        self.clock_start = None
+
+    def close(self):
+        pass
+
+    def read(self, num_frames: int, exception_on_overflow=True):
+        chunk = self.audio[self.position:self.position + num_frames]
+        self.position += len(chunk)
+        if self.realtime and self.clock_start is not None:
+            wait = self.clock_start + self.position / float(self.rate) - time()
+            if wait > 0:
+                sleep(wait)
+        now = time()
+        while len(self.end_times) < len(self.speech_ends) and self.speech_ends[len(self.end_times)] <= self.position:
+            # in realtime mode the last sample came out of the microphone a bit before the whole chunk did
+            late = (self.position - self.speech_ends[len(self.end_times)]) / float(self.rate) if self.realtime else 0
+            self.end_times[len(self.end_times)] = now - late
+        return chunk.tobytes()
+
+    def speech_ended(self):
+        """ time() the speech of the latest file ended, if that hasn't been asked for before, otherwise None (say the
+        recognizer ended an utterance at a pause in the middle of a file)"""
+        latest = len(self.end_times) - 1
+        if latest <= self.claimed:
+            return None
+        self.claimed = latest
+        return self.end_times[latest]
+
+
+class ReplayVoiceCapture(VoiceCapture):
+    """ VoiceCapture listening to a WavReplayStream instead of a microphone. No pyaudio needed"""
+
+    def __init__(self, replay_stream: WavReplayStream, **kwargs):
+        self.replay_stream = replay_stream
+        super().__init__(rate=replay_stream.rate, **kwargs)
+
+    def open_audio_interface(self):
+        return None
+
+    def open_audio_stream(self):
+        return self.replay_stream
+
+    def shut_down_pyaudio(self):
+        self.stream.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# fake speakers
+
+class SilentBackend:
+    """ Synthesis stand in: silence of about as long as the text would take to say"""
+
+    def __init__(self, words_per_s=2.5, sample_rate=16000):
+        self.words_per_s = words_per_s
+        self.sample_rate = sample_rate
+
+    def synthesize(self, text: str):
+        n_samples = int(len(text.split()) / self.words_per_s * self.sample_rate)
+        return PcmAudio(bytes(2 * n_samples), self.sample_rate)
+
+    def close(self):
+        pass
+
+
+class NullPlayObject:
+    """ Plays nothing, but wait_done takes as long as the audio would have (or no time at all)"""
+
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.stopped = Event()
+
+    def wait_done(self):
+        self.stopped.wait(self.duration)
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_playing(self):
+        return False
+
+
+class NullSink:
+    """ Synthesis backend wrapper for StreamingSpeaker that sends the audio nowhere and counts it instead"""
+
+    def __init__(self, backend, realtime=False):
+        """
+        :param backend: does the synthesis, e.g. Pico2WaveBackend or SilentBackend
+        :param realtime: take as long to "play" the audio as playing it would
+        """
+        self.backend = backend
+        self.realtime = realtime
+        self.played_s = 0.0
+        self.chunks = 0
+
+    def synthesize(self, text: str):
+        sink = self
+        audio = self.backend.synthesize(text)
+
+        class NullAudio(PcmAudio):
+            def play(self):
+                sink.played_s += self.duration
+                sink.chunks += 1
+                return NullPlayObject(self.duration if sink.realtime else 0.0)
+
+        return NullAudio(audio.pcm, audio.sample_rate, audio.num_channels, audio.bytes_per_sample)
+
+    def close(self):
+        self.backend.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# process stats
+
+def memory_mb():
+    """ (current, peak) resident memory of this process in MB, None where it can't be had"""
+    current = peak = None
+    if psutil is not None:
+        current = psutil.Process().memory_info().rss / 2 ** 20
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # bytes on mac, kB elsewhere
+    return current, peak
+
+
+class CpuMeter:
+    """ CPU seconds of the whole process (all threads) spent in each stage. Stages run one after the other, so the
+    process total during a stage is that stage's"""
+
+    def __init__(self):
+        self.seconds = {}
+
+    def measure(self, stage: str, func, *args, **kwargs):
+        start = process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + process_time() - start
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# the benchmark
+
+def benchmark_main(wav_dir: str, chatbot_model="Stub", inference_backend="reference", synthesize=False,
+                   realtime=False, stream_responses=True, pwd_model=pwd_vosk_model, jsonl_path=None):
+    """ Replay every wav file in wav_dir through the turn loop and print the report.
+
+    :param wav_dir: directory of 16 bit wav files, one utterance each, replayed in name order
+    :param chatbot_model: 'Stub', or a real model for make_agent e.g. 'DialogueGPT'
+    :param inference_backend: for real models, see inference_backends.py
+    :param synthesize: synthesize the replies with pico2wave instead of making up silence
+    :param realtime: feed and play audio at real speed instead of as fast as possible
+    :param stream_responses: speak the reply clause by clause as it's generated, like control_main does
+    :param pwd_model: vosk model directory
+    :param jsonl_path: also write every span to this file
+    :return: the MetricsCollector, for anyone who wants the numbers rather than the printout
+    """
+    paths = sorted(os.path.join(wav_dir, name) for name in os.listdir(wav_dir) if name.lower().endswith(".wav"))
+    if not paths:
+        raise ValueError("no .wav files in {}".format(wav_dir))
+
+    cpu = CpuMeter()
+    t_start = time()
+    stream = WavReplayStream(paths, realtime=realtime)
+    vcap = cpu.measure("load", ReplayVoiceCapture, stream, pwd_model=pwd_model, vad=VADGate(EnergyVAD()),
+                       endpoint_policy=EndpointPolicy(trailing_silence_s=0.4, stable_partial_s=0.8))
+    agent = cpu.measure("load", make_agent, chatbot_model, "Hello! How are you today?", inference_backend)
+    sink = NullSink(Pico2WaveBackend() if synthesize else SilentBackend(), realtime)
+    tracer = Tracer("benchmark")
+    speaker = StreamingSpeaker(sink, tracer=tracer)
+    collector = MetricsCollector(jsonl_path=jsonl_path)
+    load_s = time() - t_start
+    memory_loaded = memory_mb()
+
+    def respond(text, trace_id):
+        if stream_responses:
+            for chunk in agent.get_response_stream(text):
+                speaker.speak(chunk, trace_id)
+        else:
+            speaker.speak(agent.get_response(text), trace_id)
+        speaker.wait_done()
+
+    turns = split_utterances = 0
+    t_start = time()
+    while True:
+        trace_id = ms.new_trace_id()
+        transcript = cpu.measure("speech_to_text", vcap.listen_once)
+        if transcript is None:
+            break  # out of audio
+        speech_end = stream.speech_ended()
+        if speech_end is None:
+            split_utterances += 1
+        else:
+            turns += 1
+            tracer.record(trace_id, "end_of_speech", speech_end, time() - speech_end, words=len(transcript.words))
+
+        respond_start = time()
+        cpu.measure("respond_and_speak", respond, transcript.text, trace_id)
+        tracer.record_timings(trace_id, agent.last_timings)
+        tracer.record(trace_id, "respond", respond_start, time() - respond_start)
+        while not tracer.pending.empty():
+            collector.add(span_record(tracer.pending.get()))
+    run_s = time() - t_start
+
+    speaker.shut_down()
+    sink.close()
+    vcap.shut_down_pyaudio()
+    collector.close()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # report
+    memory_done = memory_mb()
+    print("{} files, {:.1f}s of speech, {} turns ({} utterances ended early at a pause in a file)".format(
+        len(paths), stream.speech_s, turns, split_utterances))
+    print(collector.report())
+    print("{:<32s} {:8.2f}s".format("load models", load_s))
+    print("{:<32s} {:8.2f}s".format("replay", run_s))
+    if run_s > 0:
+        print("{:<32s} {:8.2f}".format("turns per second", turns / run_s))
+    if cpu.seconds.get("speech_to_text"):
+        print("{:<32s} {:8.2f}x".format("speech audio per CPU second", stream.speech_s / cpu.seconds["speech_to_text"]))
+    print("{:<32s} {:8.2f}s in {} chunks".format("audio played (null sink)", sink.played_s, sink.chunks))
+    for stage, seconds in cpu.seconds.items():
+        print("{:<32s} {:8.2f}s".format("cpu " + stage, seconds))
+    for label, (current, peak) in [("after loading", memory_loaded), ("at the end", memory_done)]:
+        print("{:<32s} {:>8s} MB current, {:>8s} MB peak".format(
+            "rss " + label, "-" if current is None else "{:.0f}".format(current),
+            "-" if peak is None else "{:.0f}".format(peak)))
+    return collector
+
+
+if __name__ == "__main__":
+    benchmark_main(sys.argv[1] if len(sys.argv) > 1 else "../benchmarks/utterances")
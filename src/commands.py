@@ -0,0 +1,69 @@
+""" Voice commands: the handful of phrases the system acts on itself instead of passing them to the agent.
+
+The speech to text process spots them in the partial transcript as soon as the user pauses after one (see
+CommandSpotter in speech_to_text.py), and the control module matches every final transcript against the same phrases
+with a CommandIndex, which also catches near misses like "goodnight rosie".
+"""
+import difflib
+import re
+
+DEFAULT_COMMANDS = {
+    "shutdown": ["go to sleep rose", "good night rose", "goodnight rose", "good bye rose", "goodbye rose",
+                 "sweet dreams rose"],
+    "stop": ["stop", "stop talking", "be quiet", "never mind"],
+    "repeat": ["repeat", "repeat that", "say that again", "what did you say"],
+    "louder": ["louder", "speak up", "turn it up"],
+    "quieter": ["quieter", "turn it down"],
+}
+
+# words that don't change what a command means
+FILLER_WORDS = {"please", "um", "uh", "er", "oh", "okay", "ok"}
+
+
+def normalize(text: str):
+    """ lower case words only, without fillers"""
+    words = re.sub(r"[^a-z' ]+", " ", text.lower()).split()
+    return " ".join(w for w in words if w not in FILLER_WORDS)
+
+
+class CommandIndex:
+    """ Precompiled lookup from what was said to the command it means.
+
+    Phrases are keyed normalized and with the spaces taken out, so "good night" and "goodnight" or "please stop" and
+    "stop" are the same key and an exact match is one dict lookup. Failing that, fuzzy matching is a difflib ratio
+    against the keys, but only the long ones of fuzzy_commands: short commands like "stop" are one letter away from
+    ordinary words, and "what did you say" from the ordinary question "what do you say". The shutdown phrases have
+    the name in them, which is what the recognizer tends to get slightly wrong ("good night rosie")."""
+
+    def __init__(self, commands=None, cutoff=0.85, min_fuzzy_chars=8, fuzzy_commands=("shutdown",)):
+        """
+        :param commands: dict of command name -> list of phrases, DEFAULT_COMMANDS if None
+        :param cutoff: difflib similarity a fuzzy match needs
+        :param min_fuzzy_chars: keys shorter than this only match exactly
+        :param fuzzy_commands: the commands whose phrases are matched fuzzily, the rest only match exactly
+        """
+        self.commands = DEFAULT_COMMANDS if commands is None else commands
+        self.cutoff = cutoff
+        self.index = {}  # key -> command name
+        for name, phrases in self.commands.items():
+            for phrase in phrases:
+                self.index[self.key(phrase)] = name
+        self.fuzzy_keys = [key for key, name in self.index.items()
+                           if len(key) >= min_fuzzy_chars and name in fuzzy_commands]
+
+    @staticmethod
+    def key(text: str):
+        return normalize(text).replace(" ", "")
+
+    def match(self, text: str, fuzzy=True):
+        """ the name of the command text is, or None"""
+        key = self.key(text)
+        if not key:
+            return None
+        if key in self.index:
+            return self.index[key]
+        if fuzzy:
+            close = difflib.get_close_matches(key, self.fuzzy_keys, n=1, cutoff=self.cutoff)
+            if close:
+                return self.index[close[0]]
+        return None
@@ -1,125 +1,1098 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import copy
 from time import sleep, time
+from threading import Thread, Lock, Event
+import re
 import zmq
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import transformers
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+from transformers import StoppingCriteria, StoppingCriteriaList
 from transformers import BlenderbotTokenizer, BlenderbotForConditionalGeneration
 import torch
+import message_schema as ms
+from startup import StartupTimer, load_pretrained, load_in_background
+from inference_backends import apply_backend
+from endpoints import make_endpoints
+from tracing import Tracer, Timings
+from supervisor import Heartbeat
+from event_loop import POLL_TIMEOUT_MS
+from commands import DEFAULT_COMMANDS, CommandIndex
+from agent_registry import load_dialogue_config, make_routed_agent
 
 
-def listen_for_speech(sock):
-    """ This is designed to block. For now, this bot is turn based"""
-    sock.send(b"LISTEN_ONCE")
-    msg = sock.recv()
-    captured_speech = eval(msg.decode())["text"]
-    return captured_speech
+def listen_for_speech(sock, subscriber=None, on_partial=None, trace_id=0, on_tick=None, tick_s=0.05, system=None,
+                      drain=None, restarts=None):
+    """ This is designed to block. For now, this bot is turn based
 
+    :param sock: REQ socket connected to the speech to text process
+    :param subscriber: optional SUB socket subscribed to STT_PARTIAL. While waiting for the final transcript, partial
+        hypotheses arriving on it are handed to on_partial so speculative work can start early
+    :param on_partial: function(partial_text: str)
+    :param trace_id: id of this dialogue turn
+    :param on_tick: optional function() called at least every tick_s seconds while waiting. Partials are only sent
+        when they change, so this is how a partial that has stopped changing gets noticed
+    :param tick_s: seconds between on_tick calls
+    :param system: optional SUB socket subscribed to SYSTEM and VAD. A DRAIN on it sets drain and stops the listening,
+        unless the user has already started talking, in which case their turn is finished first
+    :param drain: Event, needed with system
+    :param restarts: optional SUB socket subscribed to SUPERVISOR, see request_reply
+    :return: the TRANSCRIPT message, or None if stopped by a DRAIN
+    """
+    request = ms.encode(ms.Message(ms.LISTEN_ONCE, trace_id=trace_id))
+    sock.send(request)
+    listen_start = time()
+    heard = False  # has the user started talking
+    poller = zmq.Poller()
+    for s in [sock, subscriber, system, restarts]:
+        if s is not None:
+            poller.register(s, zmq.POLLIN)
+    timeout_ms = None if on_tick is None else int(tick_s * 1000)
+    while True:
+        socks = dict(poller.poll(timeout_ms))
+        if subscriber is not None and subscriber in socks:
+            topic, message = subscriber.recv_multipart()
+            if topic == b"STT_PARTIAL":
+                heard = True
+                if on_partial is not None:
+                    on_partial(ms.decode(message).text)
+        if system is not None and system in socks:
+            topic, message = system.recv_multipart()
+            msg = ms.decode(message)
+            if msg.msg_type == ms.VAD_EVENT and msg.text == "SPEECH_START" and msg.timestamp >= listen_start:
+                heard = True
+            elif msg.msg_type == ms.DRAIN:
+                drain.set()
+            if drain.is_set() and not heard:
+                return None
+        if restarts is not None and restarts in socks:
+            topic, message = restarts.recv_multipart()
+            if ms.decode(message).text == "SPEECH TO TEXT MODULE":
+                sock.send(request)  # it went down with the old process
+        if on_tick is not None:
+            on_tick()
+        if sock in socks:
+            break
+    return ms.decode(sock.recv())
+
+
+def request_reply(sock, request: bytes, restarts=None, peer="TEXT TO SPEECH MODULE"):
+    """ Send request on the REQ socket sock and block for the reply. If restarts (a SUB socket subscribed to
+    SUPERVISOR) says that peer was restarted while we wait, the request went down with the old process and is sent
+    again, which needs REQ_RELAXED and REQ_CORRELATE on sock
+
+    :return: the reply Message
+    """
+    sock.send(request)
+    if restarts is None:
+        return ms.decode(sock.recv())
+    poller = zmq.Poller()
+    poller.register(sock, zmq.POLLIN)
+    poller.register(restarts, zmq.POLLIN)
+    while True:
+        socks = dict(poller.poll())
+        if restarts in socks:
+            topic, message = restarts.recv_multipart()
+            if ms.decode(message).text == peer:
+                sock.send(request)
+        if sock in socks:
+            return ms.decode(sock.recv())
+
+
+def speak_text(text: str, sock, trace_id=0, restarts=None):
+    """ This is designed to block. For now, this bot is turn based
+
+    :return: True if it was all spoken, False if the user interrupted (barge-in)
+    """
+    msg = request_reply(sock, ms.encode(ms.Message(ms.SPEAK, text, trace_id=trace_id)), restarts)
+    return msg.text != "interrupted"
 
-def speak_text(text: str, sock):
-    """ This is designed to block. For now, this bot is turn based """
-    sock.send(bytearray(text, 'utf8'))
-    msg = sock.recv()
+
+def prewarm_speech(phrases, sock, restarts=None):
+    """ Ask the text to speech process to synthesize phrases ahead of time so they're cached when we need them"""
+    request_reply(sock, ms.encode(ms.Message(ms.PREWARM, "\n".join(phrases))), restarts)
     return
 
 
+def speak_text_stream(text_chunks, sock, trace_id=0, restarts=None):
+    """ Streams chunks of text to the text to speech process as they are produced. Each chunk is acknowledged as soon
+    as it is queued, so the text to speech process can synthesize and play chunk N while chunk N+1 is still being
+    generated. The final STREAM_END request blocks until everything has been spoken.
+
+    :param text_chunks: iterable of text chunks, e.g. from an agent's get_response_stream
+    :param sock: REQ socket connected to the text to speech process
+    :param trace_id: id of this dialogue turn
+    :param restarts: optional SUB socket subscribed to SUPERVISOR, see request_reply
+    :return: (the text that was queued, True if it was all spoken or False if the user interrupted)
+    """
+    spoken = []
+    for chunk in text_chunks:
+        msg = request_reply(sock, ms.encode(ms.Message(ms.STREAM_CHUNK, chunk, trace_id=trace_id)), restarts)
+        if msg.text == "interrupted":
+            # closing an agent's stream stops the generation, see stream_generate
+            if hasattr(text_chunks, "close"):
+                text_chunks.close()
+            return " ".join(spoken), False
+        spoken.append(chunk)
+    msg = request_reply(sock, ms.encode(ms.Message(ms.STREAM_END, trace_id=trace_id)), restarts)
+    return " ".join(spoken), msg.text != "interrupted"
+
+
+class ClauseChunker:
+    """ Groups streamed text into sentence or clause sized chunks. Sentence ends are always emitted, clause breaks
+    (commas, semicolons ...) only once enough text has been buffered that it's worth a separate synthesis call."""
+
+    def __init__(self, min_clause_chars=20, sentence_ends=".!?", clause_breaks=",;:"):
+        self.min_clause_chars = min_clause_chars
+        self.sentence_ends = sentence_ends
+        self.clause_breaks = clause_breaks
+        self.buffer = ""
+
+    def _find_break(self):
+        """ index just after the first usable break in the buffer, or -1"""
+        for i in range(len(self.buffer) - 1):
+            char = self.buffer[i]
+            if not self.buffer[i + 1].isspace():
+                continue
+            if char in self.sentence_ends:
+                return i + 1
+            if char in self.clause_breaks and i + 1 >= self.min_clause_chars:
+                return i + 1
+        return -1
+
+    def feed(self, text: str):
+        """ add newly generated text and return the list of chunks that are ready to be spoken. A whole reply fed in
+        one go comes back as all its chunks, less whatever follows the last break (see flush)"""
+        self.buffer += text
+        chunks = []
+        idx = self._find_break()
+        while idx >= 0:
+            chunk, self.buffer = self.buffer[:idx].strip(), self.buffer[idx:].lstrip()
+            if chunk:
+                chunks.append(chunk)
+            idx = self._find_break()
+        return chunks
+
+    def flush(self):
+        """ return whatever is left in the buffer"""
+        chunk, self.buffer = self.buffer.strip(), ""
+        return [chunk] if chunk else []
+
+
+class CancelGeneration(StoppingCriteria):
+    """ Stops a generate call as soon as the event is set, checked after every generated token"""
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+def cancel_kwargs(stop_event=None):
+    """ generate arguments that make the generation stop when stop_event is set"""
+    if stop_event is None:
+        return {}
+    return dict(stopping_criteria=StoppingCriteriaList([CancelGeneration(stop_event)]))
+
+
+def count_tokens(timings, n_tokens: int):
+    """ add the number of generated tokens and the generation speed to the generate stage of an agent's timings"""
+    start, duration, attrs = timings["generate"]
+    attrs.update(new_tokens=n_tokens, tokens_per_s=n_tokens / duration if duration > 0 else 0.0)
+
+
+def stream_generate(model, tokenizer, generate_kwargs, result=None, chunker=None, skip_prompt=False):
+    """ Runs model.generate in a background thread and yields clause sized chunks of text as tokens are produced.
+
+    Closing the generator (e.g. when the user barges in) stops the generation within a token and waits for the thread,
+    so nothing carries on generating in the background. result["output"] then holds the cut short output. If generate
+    fails, the error is raised here once the text produced before it has been yielded.
+
+    :param model: huggingface model
+    :param tokenizer: the model's tokenizer, used by the streamer for incremental decoding
+    :param generate_kwargs: keyword arguments for model.generate
+    :param result: optional dict, the raw generate output is stored in result["output"] once generation is done
+    :param chunker: ClauseChunker instance, a default one is made if None
+    :param skip_prompt: True for decoder only models, where the prompt is part of the generated sequence
+    :return: generator of text chunks
+    """
+    if chunker is None:
+        chunker = ClauseChunker()
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=skip_prompt, skip_special_tokens=True)
+    stop_event = Event()
+    errors = []
+
+    def _generate():
+        try:
+            output = model.generate(streamer=streamer, **generate_kwargs, **cancel_kwargs(stop_event))
+            if result is not None:
+                result["output"] = output
+        except Exception as e:
+            errors.append(e)
+            streamer.end()  # generate only ends the stream when it finishes, without this the loop below waits forever
+
+    thread = Thread(target=_generate, daemon=True)
+    thread.start()
+    try:
+        for new_text in streamer:
+            for chunk in chunker.feed(new_text):
+                yield chunk
+        thread.join()
+        if errors:
+            raise errors[0]
+        for chunk in chunker.flush():
+            yield chunk
+    finally:
+        stop_event.set()  # only makes a difference if we were closed early
+        thread.join()
+
+
+class DialogueState:
+    """ Per conversation state for agents that remember the conversation (currently just DialogueGPT)
+
+    past_key_values is the model's attention cache for chat_history_ids minus its last token (the last generated token
+    is never fed back through the model). It is only valid while chat_history_ids is exactly the sequence it was built
+    from, so anything that rewrites the history has to call invalidate_cache().
+    """
+
+    def __init__(self, chat_history_ids=None):
+        self.chat_history_ids = chat_history_ids
+        self.past_key_values = None
+
+    def invalidate_cache(self):
+        self.past_key_values = None
+
+    def fork(self):
+        """ a copy that can be generated from without touching this state. The attention cache is copied as well, as
+        newer transformers versions extend it in place"""
+        forked = DialogueState(self.chat_history_ids)
+        forked.past_key_values = copy.deepcopy(self.past_key_values)
+        return forked
+
+    def adopt(self, other):
+        """ take over the history and cache of a forked state, e.g. once a speculative reply has been used"""
+        self.chat_history_ids = other.chat_history_ids
+        self.past_key_values = other.past_key_values
+
+
+def slices_cached_inputs():
+    """ whether generate runs all the input ids past the cache through the model. Before transformers 4.42 GPT-2 only
+    took the last one when given a cache, which would drop all but the last token of the user's words"""
+    major, minor = (int(part) for part in re.findall(r"\d+", transformers.__version__)[:2])
+    if (major, minor) >= (4, 42):
+        return True
+    print("DIALOGUE: transformers {} is too old to reuse the attention cache between turns, "
+          "pip install 'transformers>=4.42'".format(transformers.__version__))
+    return False
+
+
 class DialogueGPTAgent:
 
-    def __init__(self, starting_message: str):
-        # TODO figure out how to cache these
-        self.tokenizer = AutoTokenizer.from_pretrained("microsoft/DialoGPT-medium")
-        self.model = AutoModelForCausalLM.from_pretrained("microsoft/DialoGPT-medium")
-        self.chat_history_ids = self.tokenizer.encode(starting_message + self.tokenizer.eos_token, return_tensors='pt')
+    def __init__(self, starting_message: str, reuse_kv_cache=True, max_history_tokens=800, trim_to_tokens=500,
+                 max_new_tokens=200, backend="reference", timer=None, model_name="microsoft/DialoGPT-medium"):
+        """
+        :param starting_message: seeds the conversation history
+        :param reuse_kv_cache: keep the attention cache between turns so only the new tokens are run through the model.
+            Costs memory per conversation (roughly 200kB per token of history for DialoGPT-medium)
+        :param max_history_tokens: once the history would get longer than this, the oldest turns are dropped ...
+        :param trim_to_tokens: ... until it is at most this long. Dropping a chunk at a time rather than a turn at a
+            time means the cache (which has to be rebuilt after a trim) is only rebuilt every few turns
+        :param max_new_tokens: longest reply
+        :param backend: inference backend, see inference_backends.py
+        :param timer: optional StartupTimer
+        :param model_name: huggingface hub name of a DialoGPT model, e.g. microsoft/DialoGPT-small for a quicker one
+        """
+        # loaded from a local snapshot after the first run, see startup.py
+        self.tokenizer, self.model = load_pretrained(AutoTokenizer, AutoModelForCausalLM, model_name, timer=timer)
+        self.model = apply_backend(self.model, backend, model_name)
+        self.starting_message = starting_message
+        self.reuse_kv_cache = reuse_kv_cache and slices_cached_inputs()
+        self.max_history_tokens = max_history_tokens
+        self.trim_to_tokens = trim_to_tokens
+        self.max_new_tokens = max_new_tokens
+        self.state = self.new_state()  # used when no state is passed in, i.e. the single local conversation
+        self.last_timings = Timings()  # how long each stage of the last reply took, see tracing.py
+
+    def new_state(self):
+        """ state for a new conversation, seeded with the starting message"""
+        return DialogueState(self.tokenizer.encode(self.starting_message + self.tokenizer.eos_token,
+                                                   return_tensors='pt'))
+
+    def _trim_history(self, state: DialogueState, incoming_tokens: int):
+        """ sliding window over the conversation: drop the oldest whole turns once the history gets too long.
 
-    def get_response(self, new_query: str):
+        GPT-2 style models use absolute positions, so once the front of the history is cut off the cached keys and
+        values are for the wrong positions and the cache has to go.
+        """
+        history = state.chat_history_ids[0]
+        if len(history) + incoming_tokens <= self.max_history_tokens:
+            return
+        keep = max(self.trim_to_tokens - incoming_tokens, 0)
+        # cut just after an eos so we only ever drop whole turns
+        turn_starts = (history == self.tokenizer.eos_token_id).nonzero()[:, 0] + 1
+        cuts = turn_starts[turn_starts >= len(history) - keep]
+        cut = cuts[0].item() if len(cuts) > 0 else len(history) - keep
+        state.chat_history_ids = state.chat_history_ids[:, cut:]
+        state.invalidate_cache()
+
+    def _bot_input_ids(self, new_query: str, state: DialogueState):
         # encode the new user input, add the eos_token and return a tensor in Pytorch
         new_user_input_ids = self.tokenizer.encode(new_query + self.tokenizer.eos_token, return_tensors='pt')
+        self._trim_history(state, new_user_input_ids.shape[-1] + self.max_new_tokens)
 
         # append the new user input tokens to the chat history
-        bot_input_ids = torch.cat([self.chat_history_ids, new_user_input_ids], dim=-1)
+        return torch.cat([state.chat_history_ids, new_user_input_ids], dim=-1)
+
+    def _cached_generate_kwargs(self, state: DialogueState):
+        """ generate arguments that pick up from (and hand back) the conversation's attention cache"""
+        if not self.reuse_kv_cache:
+            return {}
+        # generate works out from the cache length which of the input ids it still has to run through the model
+        return dict(past_key_values=state.past_key_values, use_cache=True, return_dict_in_generate=True)
+
+    def _store_output(self, output, state: DialogueState):
+        """ keep the new history (and cache) from a generate call"""
+        if self.reuse_kv_cache:
+            state.chat_history_ids = output.sequences
+            state.past_key_values = output.past_key_values
+        else:
+            state.chat_history_ids = output
+
+    def get_response(self, new_query: str, state=None, stop_event=None):
+        """
+        :param new_query: what the user said
+        :param state: DialogueState of the conversation, the agent's own if None
+        :param stop_event: optional threading.Event, generation stops early once it is set
+        """
+        state = self.state if state is None else state
+        timings = Timings()
+        with timings.stage("tokenize"):
+            bot_input_ids = self._bot_input_ids(new_query, state)
 
-        # generated a response while limiting the total chat history to 1000 tokens,
-        self.chat_history_ids = self.model.generate(bot_input_ids, min_length=25, max_length=1000,
-                                                    pad_token_id=self.tokenizer.eos_token_id,
-                                                    no_repeat_ngram_size=3,
-                                                    do_sample=True, top_p=0.95)
+        # generate a response. The history is kept to max_history_tokens by _trim_history
+        with timings.stage("generate"):
+            output = self.model.generate(bot_input_ids, **self._generate_kwargs(),
+                                         **self._cached_generate_kwargs(state), **cancel_kwargs(stop_event))
+        self._store_output(output, state)
+        count_tokens(timings, state.chat_history_ids.shape[-1] - bot_input_ids.shape[-1])
 
-        reply = self.tokenizer.decode(self.chat_history_ids[:, bot_input_ids.shape[-1]:][0],
-                                      skip_special_tokens=True)
+        with timings.stage("decode"):
+            reply = self.tokenizer.decode(state.chat_history_ids[:, bot_input_ids.shape[-1]:][0],
+                                          skip_special_tokens=True)
+        self.last_timings = timings
 
         return reply
 
+    def get_responses(self, queries, states):
+        """ Batched get_response for several conversations at once (see generation_scheduler.py).
+
+        The prompts are different lengths so they're left padded, which is what a decoder only model needs for the
+        generated tokens to line up at the end. Batches don't use the per conversation attention caches.
+        """
+        states = [self.state if state is None else state for state in states]
+        prompts = [self._bot_input_ids(query, state)[0] for query, state in zip(queries, states)]
+        pad_id = self.tokenizer.eos_token_id
+        prompt_length = max(len(prompt) for prompt in prompts)
+
+        input_ids = torch.full((len(prompts), prompt_length), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts), prompt_length), dtype=torch.long)
+        for i, prompt in enumerate(prompts):
+            input_ids[i, prompt_length - len(prompt):] = prompt
+            attention_mask[i, prompt_length - len(prompt):] = 1
+
+        output = self.model.generate(input_ids, attention_mask=attention_mask, **self._generate_kwargs())
+
+        replies = []
+        for i, (prompt, state) in enumerate(zip(prompts, states)):
+            new_ids = output[i, prompt_length:]
+            # keep the reply up to and including its eos, the rest is padding
+            eos_positions = (new_ids == pad_id).nonzero()
+            if len(eos_positions) > 0:
+                new_ids = new_ids[:eos_positions[0].item() + 1]
+            state.chat_history_ids = torch.cat([prompt, new_ids]).unsqueeze(0)
+            state.invalidate_cache()  # the batch was run without it, and left padding shifts the positions anyway
+            replies.append(self.tokenizer.decode(new_ids, skip_special_tokens=True))
+        return replies
+
+    def context_key(self, state=None, turns=1, query=None):
+        """ the last few turns of the conversation as a hashable key, for the response cache"""
+        state = self.state if state is None else state
+        history = state.chat_history_ids[0]
+        turn_starts = ((history == self.tokenizer.eos_token_id).nonzero()[:, 0] + 1).tolist()
+        # the history ends with an eos, so the start of the last `turns` turns is turns + 1 eos back
+        start = turn_starts[-turns - 1] if len(turn_starts) > turns else 0
+        return tuple(history[start:].tolist())
+
+    def record_exchange(self, new_query: str, reply: str, state=None):
+        """ add a turn to the history without generating it, e.g. when the reply came from the response cache.
+        Only new tokens are appended, so the attention cache stays valid"""
+        state = self.state if state is None else state
+        exchange_ids = self.tokenizer.encode(new_query + self.tokenizer.eos_token + reply + self.tokenizer.eos_token,
+                                             return_tensors='pt')
+        self._trim_history(state, exchange_ids.shape[-1] + self.max_new_tokens)
+        state.chat_history_ids = torch.cat([state.chat_history_ids, exchange_ids], dim=-1)
+
+    def _generate_kwargs(self):
+        return dict(max_new_tokens=self.max_new_tokens, pad_token_id=self.tokenizer.eos_token_id,
+                    no_repeat_ngram_size=3, do_sample=True, top_p=0.95)
+
+    def get_response_stream(self, new_query: str, state=None):
+        """ Same as get_response but yields the reply in clause sized chunks while it is being generated"""
+        state = self.state if state is None else state
+        timings = Timings()
+        with timings.stage("tokenize"):
+            bot_input_ids = self._bot_input_ids(new_query, state)
+
+        result = {}
+        history = state.chat_history_ids  # after any trim
+        generated = []
+        generate_kwargs = dict(inputs=bot_input_ids, **self._generate_kwargs(), **self._cached_generate_kwargs(state))
+        generate_start = time()
+        with timings.stage("generate") as attrs:
+            stream = stream_generate(self.model, self.tokenizer, generate_kwargs, result=result, skip_prompt=True)
+            try:
+                for chunk in stream:
+                    attrs.setdefault("first_chunk_s", time() - generate_start)
+                    generated.append(chunk)
+                    yield chunk
+            except GeneratorExit:
+                stream.close()  # waits for generate to stop
+                # interrupted: the cache may have been extended in place past the history, so start it over and
+                # only keep the part of the reply that was handed out (the last chunk never got queued)
+                state.chat_history_ids = history
+                state.invalidate_cache()
+                self.record_exchange(new_query, " ".join(generated[:-1]), state)
+                raise
+        self._store_output(result["output"], state)
+        count_tokens(timings, state.chat_history_ids.shape[-1] - bot_input_ids.shape[-1])
+        self.last_timings = timings
+
 
 class BlenderBotAgent:
     """ This is the default as it works better (IMHO)"""
 
-    def __init__(self):
+    def __init__(self, backend="reference", timer=None, model_name="facebook/blenderbot-400M-distill"):
+        """
+        :param backend: inference backend for running on the CPU, see inference_backends.py. Ignored with a GPU
+        :param timer: optional StartupTimer
+        :param model_name: huggingface hub name, e.g. facebook/blenderbot-1B-distill for the bigger distillation
+        """
         self.use_cuda = torch.cuda.is_available()
-        # Note: you can try the 1 Billion distillation of BlenderBot as well: facebook/blenderbot-1B-distill
-        self.tokenizer = BlenderbotTokenizer.from_pretrained("facebook/blenderbot-400M-distill")
-        self.model = BlenderbotForConditionalGeneration.from_pretrained("facebook/blenderbot-400M-distill")
+        # loaded from a local snapshot after the first run, see startup.py
+        self.tokenizer, self.model = load_pretrained(BlenderbotTokenizer, BlenderbotForConditionalGeneration,
+                                                     model_name, timer=timer)
         if self.use_cuda:
             self.model = self.model.to("cuda")
+        else:
+            self.model = apply_backend(self.model, backend, model_name)
+        self.last_timings = Timings()  # how long each stage of the last reply took, see tracing.py
+
+    def new_state(self):
+        """ BlenderBot answers each utterance on its own, so there is no per conversation state"""
+        return None
+
+    def context_key(self, state=None, turns=1, query=None):
+        """ BlenderBot only ever sees the latest utterance, so the reply doesn't depend on any context"""
+        return ()
+
+    def record_exchange(self, query: str, reply: str, state=None):
+        pass
+
+    def get_response(self, query: str, state=None, stop_event=None):
 
-    def get_response(self, query: str):
+        timings = Timings()
+        with timings.stage("tokenize"):
+            inputs = self.tokenizer.encode(query + self.tokenizer.eos_token, return_tensors='pt')
+            if self.use_cuda:
+                inputs = inputs.to("cuda")
 
-        inputs = self.tokenizer.encode(query + self.tokenizer.eos_token, return_tensors='pt')
+        with timings.stage("generate"):
+            reply_ids = self.model.generate(inputs, **self._generate_kwargs(), **cancel_kwargs(stop_event))
+        count_tokens(timings, len(reply_ids[0]))
+
+        with timings.stage("decode"):
+            reply = self.tokenizer.decode(reply_ids[0], skip_special_tokens=True)
+        self.last_timings = timings
+
+        return reply
+
+    def get_responses(self, queries, states=None):
+        """ Batched get_response, one padded generate call for all the queries (see generation_scheduler.py)"""
+        inputs = self.tokenizer([query + self.tokenizer.eos_token for query in queries], return_tensors='pt',
+                                padding=True)
         if self.use_cuda:
             inputs = inputs.to("cuda")
 
-        reply_ids = self.model.generate(inputs, min_length=25, max_length=500,
-                                        pad_token_id=self.tokenizer.eos_token_id,
-                                        do_sample=True, top_p=0.95, temperature=1.2)
+        reply_ids = self.model.generate(**inputs, **self._generate_kwargs())
+        return self.tokenizer.batch_decode(reply_ids, skip_special_tokens=True)
+
+    def _generate_kwargs(self):
+        return dict(min_length=25, max_length=500, pad_token_id=self.tokenizer.eos_token_id,
+                    do_sample=True, top_p=0.95, temperature=1.2)
 
-        print(len(reply_ids[0]))
-        reply = self.tokenizer.decode(reply_ids[0], skip_special_tokens=True)
+    def get_response_stream(self, query: str, state=None):
+        """ Same as get_response but yields the reply in clause sized chunks while it is being generated"""
+        timings = Timings()
+        with timings.stage("tokenize"):
+            inputs = self.tokenizer.encode(query + self.tokenizer.eos_token, return_tensors='pt')
+            if self.use_cuda:
+                inputs = inputs.to("cuda")
 
+        result = {}
+        generate_kwargs = dict(inputs=inputs, **self._generate_kwargs())
+        generate_start = time()
+        with timings.stage("generate") as attrs:
+            stream = stream_generate(self.model, self.tokenizer, generate_kwargs, result=result)
+            try:
+                for chunk in stream:
+                    attrs.setdefault("first_chunk_s", time() - generate_start)
+                    yield chunk
+            finally:
+                stream.close()  # stops the generation if we were closed early
+        count_tokens(timings, len(result["output"][0]))
+        self.last_timings = timings
+
+
+class RemoteAgent:
+    """ Stands in for a local agent when the model lives in a shared dialogue server (see dialogue_server.py).
+
+    Talks to the server's ROUTER socket through a DEALER socket. The REQ style empty delimiter frame is kept so the
+    server sees the usual [identity, b"", payload] envelope. If the server doesn't reply within timeout_s the request is
+    sent again on a new socket, like the worker pool clients do (see PoolClient in worker_pool.py), and if that doesn't
+    get a reply either the turn is answered with fallback_reply rather than wait for a server that may be gone."""
+
+    def __init__(self, context, server_address: str, session_id: int, agent_name=None, timeout_s=30.0, retries=1,
+                 fallback_reply="Sorry, I can't think of anything to say right now."):
+        """
+        :param context: zmq context to make the socket in
+        :param server_address: address of the dialogue server's ROUTER socket
+        :param session_id: id of this conversation on the server
+        :param agent_name: which of the server's agents this session talks to (see agent_registry.py), None for its
+            default
+        :param timeout_s: how long to wait for a reply. Generous, the server may be loading the model
+        :param retries: how many times to send a request again before giving up
+        :param fallback_reply: what to say when the server doesn't answer
+        """
+        self.context = context
+        self.server_address = server_address
+        self.session_id = session_id
+        self.agent_name = agent_name
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.fallback_reply = fallback_reply
+        self.socket = None
+        self._connect()
+        self.last_timings = Timings()
+
+    def _connect(self):
+        if self.socket is not None:
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.close()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.IDENTITY, "session-{}".format(self.session_id).encode())
+        self.socket.connect(self.server_address)
+
+    def new_state(self):
+        """ the server keeps the conversation state"""
+        return None
+
+    def get_response(self, query: str, state=None, trace_id=0):
+        request = ms.Message(ms.DIALOGUE_REQUEST, query, trace_id=trace_id, session_id=self.session_id,
+                             data=self.agent_name.encode() if self.agent_name is not None else b"")
+        timings = Timings()
+        with timings.stage("remote_response"):
+            reply = self._request(request)
+        self.last_timings = timings
         return reply
 
+    def _request(self, request):
+        for attempt in range(self.retries + 1):
+            self.socket.send_multipart([b"", ms.encode(request)])
+            if self.socket.poll(int(self.timeout_s * 1000)):
+                empty, payload = self.socket.recv_multipart()
+                return ms.decode(payload).text
+            print("no reply from the dialogue server at {} after {:.0f}s".format(self.server_address, self.timeout_s))
+            self._connect()  # so a late reply to this request can't be taken for the reply to the next
+        return self.fallback_reply
+
+    def get_response_stream(self, query: str, state=None, trace_id=0):
+        """ the server replies in one go, but chunking the reply still lets the text to speech process play the
+        first clause while it synthesizes the rest"""
+        chunker = ClauseChunker()
+        for chunk in chunker.feed(self.get_response(query, state, trace_id) + " ") + chunker.flush():
+            yield chunk
+
+    def end_session(self):
+        self.socket.send_multipart([b"", ms.encode(ms.Message(ms.SESSION_END, session_id=self.session_id))])
+
+    def close(self):
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()
 
-def control_main(port_config=None, dialogue_config=None):
-    if port_config is None:
-        port_config = {"system_sync_port": 5553,  # report for system to check that modules are synced properly
-                       "pub_to_proxy_port": 5554,  # port to publish to proxy so in the proxy it is xsub
-                       "sub_to_proxy_port": 5555,  # port to subscribe to the proxy so in the proxy it is xpub
-                       "stt_req_rep_port": 5556,  # REQ-REP control port for the stt pub sub
-                       "tts_req_rep_port": 5557,  # REQ-REP port for the text to speech
-                       }
 
-    chatbot_model = "BlenderBot"
+class StubAgent:
+    """ Deterministic stand in for a model, for benchmarks and for running the rest of the system without the
+    transformers download. Replies by repeating the query back, and can pretend to generate at a given speed so the
+    timings look like a real agent's."""
 
-    # TODO: implement the optional input of the dialogue config
-    if dialogue_config is None:
-        hello_message = "Hello! My name is Rose. How are you today? What would you like to talk about?"
-        shutdown_commands = ["go to sleep rose", "good night rose", "goodnight rose", "good bye rose",
-                             "goodbye rose", "sweet dreams rose"]
+    def __init__(self, tokens_per_s=0.0):
+        """
+        :param tokens_per_s: simulated generation speed, one token per word of the reply. 0 to reply instantly
+        """
+        self.tokens_per_s = tokens_per_s
+        self.last_timings = Timings()
+
+    def new_state(self):
+        return None
+
+    def context_key(self, state=None, turns=1, query=None):
+        return ()
+
+    def record_exchange(self, query: str, reply: str, state=None):
+        pass
+
+    def _reply(self, query: str):
+        return "You said {}.".format(query) if query else "I didn't catch that."
+
+    def get_response(self, query: str, state=None, stop_event=None):
+        reply = self._reply(query)
+        timings = Timings()
+        with timings.stage("generate"):
+            n_tokens = len(reply.split())
+            if self.tokens_per_s > 0:
+                if stop_event is not None:
+                    stop_event.wait(n_tokens / self.tokens_per_s)
+                else:
+                    sleep(n_tokens / self.tokens_per_s)
+        count_tokens(timings, n_tokens)
+        self.last_timings = timings
+        return reply
+
+    def get_responses(self, queries, states=None):
+        return [self.get_response(query) for query in queries]
+
+    def get_response_stream(self, query: str, state=None):
+        chunker = ClauseChunker()
+        for chunk in chunker.feed(self.get_response(query, state) + " ") + chunker.flush():
+            yield chunk
+
+
+class ResponseCache:
+    """ LRU cache of agent replies keyed on the normalized utterance plus the recent conversation context.
+
+    Entries older than ttl_s are dropped when they're looked up. Models that sample their replies would sound canned if
+    the same reply came back every time, so each entry collects up to candidates_per_key different replies (one per
+    miss) before it starts serving hits, and then rotates through them.
+    """
+
+    def __init__(self, max_entries=512, ttl_s=3600.0, candidates_per_key=3):
+        """
+        :param max_entries: most keys kept, least recently used are evicted first
+        :param ttl_s: seconds an entry stays valid after it was created
+        :param candidates_per_key: replies collected per key, 1 for deterministic (greedy) models
+        """
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.candidates_per_key = candidates_per_key
+        self.entries = OrderedDict()  # key -> [created, replies, next reply to serve]
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(text: str):
+        """ lower case, no punctuation, single spaces: 'What?' and 'what' are the same utterance"""
+        return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+    def make_key(self, text: str, context=()):
+        return self.normalize(text), context
+
+    def get(self, key):
+        """ the next cached reply for key, or None if generation is needed"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time() - entry[0] > self.ttl_s:
+                del self.entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None or len(entry[1]) < self.candidates_per_key:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            created, replies, index = entry
+            entry[2] = (index + 1) % len(replies)
+            return replies[index]
+
+    def put(self, key, reply: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [time(), [], 0]
+            if reply not in entry[1] and len(entry[1]) < self.candidates_per_key:
+                entry[1].append(reply)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0, "expired": self.expired,
+                "evictions": self.evictions}
+
+
+class CachedAgent:
+    """ Wraps an agent so repeated utterances are answered from a ResponseCache without running the model.
+
+    The agent has to provide context_key(state, turns, query) and record_exchange(query, reply, state), so that a
+    cached reply is only used in the same conversational context and still ends up in the conversation history. A
+    context_key of None means the context isn't known without loading something, the query then bypasses the cache.
+    """
+
+    def __init__(self, agent, cache: ResponseCache, context_turns=1):
+        """
+        :param agent: DialogueGPTAgent or BlenderBotAgent
+        :param cache: the ResponseCache
+        :param context_turns: how many of the previous turns are part of the cache key
+        """
+        self.agent = agent
+        self.cache = cache
+        self.context_turns = context_turns
+        self.last_timings = Timings()
+
+    def new_state(self):
+        return self.agent.new_state()
+
+    def _key(self, query: str, state):
+        context = self.agent.context_key(state, self.context_turns, query=query)
+        return None if context is None else self.cache.make_key(query, context)
+
+    def _lookup(self, key):
+        return None if key is None else self.cache.get(key)
+
+    def _store(self, key, reply: str):
+        if key is not None:
+            self.cache.put(key, reply)
+
+    def get_response(self, query: str, state=None, stop_event=None):
+        key = self._key(query, state)
+        timings = Timings()
+        with timings.stage("response_cache"):
+            reply = self._lookup(key)
+        if reply is not None:
+            self.agent.record_exchange(query, reply, state)
+            self.last_timings = timings
+            return reply
+        if stop_event is None:
+            reply = self.agent.get_response(query, state)
+        else:
+            reply = self.agent.get_response(query, state, stop_event=stop_event)
+        self.last_timings = self.agent.last_timings
+        if stop_event is None or not stop_event.is_set():  # a cancelled reply is cut short, don't keep it
+            self._store(key, reply)
+        return reply
+
+    def get_responses(self, queries, states=None):
+        states = [None] * len(queries) if states is None else states
+        return [self.get_response(query, state) for query, state in zip(queries, states)]
+
+    def get_response_stream(self, query: str, state=None):
+        key = self._key(query, state)
+        timings = Timings()
+        with timings.stage("response_cache"):
+            reply = self._lookup(key)
+        if reply is not None:
+            self.agent.record_exchange(query, reply, state)
+            self.last_timings = timings
+            chunker = ClauseChunker()
+            for chunk in chunker.feed(reply + " ") + chunker.flush():
+                yield chunk
+            return
+        chunks = []
+        stream = self.agent.get_response_stream(query, state)
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            stream.close()  # stops the generation if we were closed early, and a cut short reply isn't cached
+        self.last_timings = self.agent.last_timings
+        self._store(key, " ".join(chunks))
+
+
+class SpeculativePrefetcher:
+    """ Starts generating a reply from the partial transcript before the user has finished speaking.
+
+    Once a partial hypothesis has stayed the same for stable_s seconds, the agent is asked for a reply to it on a
+    background thread, working on a fork of the conversation state. When the final transcript arrives, take() hands
+    back the speculative reply if the final text (normalized) is what was speculated on, waiting for the generation to
+    finish if need be; otherwise the speculation is cancelled through a stopping criterion and thrown away, and the
+    conversation state is left as it was. A cancelled speculation is waited for before take() returns without a reply,
+    so it's never still on the model (or writing the agent's last_timings) while the real reply is generated.
+
+    Metrics: how many speculations were started, how many were used, and the generation time spent on ones that
+    weren't (wasted) or that was already done by the time the final transcript came in (saved).
+    """
+
+    def __init__(self, agent, stable_s=0.4):
+        """
+        :param agent: agent whose get_response takes a stop_event, i.e. a local agent. Not the CachedAgent, so
+            speculation doesn't show up in the response cache's hit rate
+        :param stable_s: seconds a partial has to stay unchanged before generation starts. Wants to be shorter than
+            the speech to text end pointing's stable partial time, or the final transcript always gets there first
+        """
+        self.agent = agent
+        self.stable_s = stable_s
+        self.pool = ThreadPoolExecutor(max_workers=1)  # one speculation at a time, a cancelled one stops within a token
+        self.partial_key = ""
+        self.partial_since = 0.0
+        self.speculation = None  # (key, forked state, stop event, future, start time)
+        self.last_future = None  # of the last speculation started, the pool runs them one after the other
+        self.state = None
+
+        # metrics
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.wasted_s = 0.0
+        self.saved_s = 0.0
+
+    def begin_turn(self, state):
+        """ call before listening, with the conversation state the real reply will use"""
+        self.state = state
+        self.partial_key = ""
+
+    def on_partial(self, partial_text: str):
+        key = ResponseCache.normalize(partial_text)
+        if key != self.partial_key:
+            self.partial_key = key
+            self.partial_since = time()
+        self.on_tick()
+
+    def on_tick(self):
+        """ start speculating once the partial has been stable for long enough"""
+        if not self.partial_key or time() - self.partial_since < self.stable_s:
+            return
+        if self.speculation is not None and self.speculation[0] == self.partial_key:
+            return
+        self._cancel()
+        forked = None if self.state is None else self.state.fork()
+        stop_event = Event()
+        future = self.pool.submit(self._generate, self.partial_key, forked, stop_event)
+        self.last_future = future
+        self.speculation = (self.partial_key, forked, stop_event, future, time())
+        self.started += 1
+
+    def _generate(self, text, forked_state, stop_event):
+        start = time()
+        reply = self.agent.get_response(text, forked_state, stop_event=stop_event)
+        return reply, time() - start
+
+    def _cancel(self):
+        if self.speculation is None:
+            return
+        key, forked, stop_event, future, started_at = self.speculation
+        stop_event.set()
+        future.add_done_callback(self._count_waste)
+        self.misses += 1
+        self.speculation = None
+
+    def _count_waste(self, future):
+        if future.exception() is None:
+            self.wasted_s += future.result()[1]
+
+    def _wait_cancelled(self):
+        """ wait for cancelled speculations to stop, they stop within a token"""
+        if self.last_future is not None:
+            wait([self.last_future])
+
+    def take(self, final_text: str):
+        """ the speculative reply for the final transcript, or None if there isn't one (the speculation, if any, is
+        cancelled). On a hit the conversation state takes over the forked state the reply was generated in."""
+        if self.speculation is None:
+            self._wait_cancelled()
+            return None
+        key, forked, stop_event, future, started_at = self.speculation
+        if key != ResponseCache.normalize(final_text):
+            self._cancel()
+            self._wait_cancelled()
+            return None
+        self.speculation = None
+        self.saved_s += time() - started_at
+        try:
+            reply, _ = future.result()
+        except Exception as e:
+            print("speculative generation failed:", e)
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.state is not None:
+            self.state.adopt(forked)
+        return reply
+
+    def cancel(self):
+        """ throw the speculation away, e.g. for a turn that isn't going to the agent"""
+        self._cancel()
+
+    def stats(self):
+        return {"started": self.started, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / self.started if self.started else 0.0,
+                "wasted_generate_s": self.wasted_s, "saved_s": self.saved_s}
+
+    def shut_down(self):
+        self._cancel()
+        self.pool.shutdown(wait=True)
+
+
+class RepromptPolicy:
+    """ Decides when a transcript is too unsure to be worth answering, so the user is asked to say it again instead of
+    the agent spending a generate call on what is most likely garbage. Goes on the per word confidences the speech to
+    text process sends with every transcript."""
+
+    def __init__(self, min_confidence=0.6, min_word_confidence=0.35, max_low_fraction=0.5, max_reprompts=2):
+        """
+        :param min_confidence: reprompt when the mean word confidence is below this
+        :param min_word_confidence: words below this count as low confidence
+        :param max_low_fraction: reprompt when more than this fraction of the words are low confidence
+        :param max_reprompts: in a row. After that we go with what we've got rather than keep on asking
+        """
+        self.min_confidence = min_confidence
+        self.min_word_confidence = min_word_confidence
+        self.max_low_fraction = max_low_fraction
+        self.max_reprompts = max_reprompts
+        self.reprompts_in_a_row = 0
+        self.reprompts = 0
+
+    def should_reprompt(self, transcript):
+        """
+        :param transcript: TRANSCRIPT message. One without words (no word confidences to go on) is never reprompted
+        """
+        low_words = [w for w in transcript.words if w.confidence < self.min_word_confidence]
+        unsure = len(transcript.words) > 0 and (transcript.confidence < self.min_confidence
+                                                or len(low_words) > self.max_low_fraction * len(transcript.words))
+        if unsure and self.reprompts_in_a_row < self.max_reprompts:
+            self.reprompts_in_a_row += 1
+            self.reprompts += 1
+            return True
+        self.reprompts_in_a_row = 0
+        return False
+
+
+def make_agent(chatbot_model: str, hello_message: str, backend="reference", timer=None, model_name=None):
+    """ load the named agent: 'DialogueGPT', 'BlenderBot' or 'Stub', running on the given inference backend. model_name
+    picks the huggingface model, the agent's usual one if None"""
+    model_kwargs = {} if model_name is None else {"model_name": model_name}
+    if chatbot_model == 'Stub':
+        return StubAgent()
+    if chatbot_model == 'DialogueGPT':
+        return DialogueGPTAgent(hello_message, backend=backend, timer=timer, **model_kwargs)
+    return BlenderBotAgent(backend=backend, timer=timer, **model_kwargs)
+
+
+def agent_factory(hello_message: str, backend="reference", timer=None):
+    """ make_agent for the agent specs of a dialogue config (see agent_registry.py), which can also set the backend"""
+    def factory(spec):
+        if spec["type"] == "Stub":
+            return StubAgent(spec.get("tokens_per_s", 0.0))
+        return make_agent(spec["type"], hello_message, spec.get("backend", backend), timer, spec.get("model_name"))
+    return factory
+
+
+def control_main(port_config=None, dialogue_config=None, session_id=None, endpoints=None, context=None):
+    """ The turn loop: listen, get a response from the agent, speak it.
+
+    :param port_config: dict of tcp ports, used when no endpoints are given
+    :param dialogue_config: JSON file with the messages and agents to use, see agent_registry.py. The defaults if None
+    :param session_id: if given, use the shared model in the dialogue server under this session id instead of
+        loading a model in this process
+    :param endpoints: EndpointConfig with the socket addresses, see endpoints.py
+    :param context: zmq context to use, e.g. the launcher's when running as a thread. One is made if None
+    """
+    timer = StartupTimer("CONTROL MODULE")
+    endpoints = make_endpoints(port_config, endpoints)
+    tracer = Tracer("control")
+
+    # int8 is a lot quicker on the CPU for nearly the same replies, "reference" for the plain fp32 model. Run
+    # inference_backends.py for the parity and latency comparison
+    inference_backend = "int8"
+    stream_responses = True  # speak the reply clause by clause while it's still being generated
+    cache_responses = True  # answer repeated utterances ("hello", "what?") from a ResponseCache
+    speculate = True  # start generating on a stable partial transcript, before the user has finished
+    # ask the user to say it again rather than answer a transcript the recognizer wasn't sure of, None to always answer
+    reprompt_policy = RepromptPolicy(min_confidence=0.6)
+
+    # the messages, voice commands and agents, from the dialogue config file if there is one
+    config = load_dialogue_config(dialogue_config)
+    hello_message = config["hello_message"]
+    commands = config["commands"] or DEFAULT_COMMANDS  # command name -> phrases, see commands.py
+    shutdown_message = config["shutdown_message"]
+    reprompt_message = config["reprompt_message"]
+    okay_message = config["okay_message"]
+    volume_step_db = 6.0  # how much louder or quieter "louder" and "quieter" make it
+    command_index = CommandIndex(commands)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # start loading the default agent straight away, it's by far the slowest part and can carry on while we connect
+    # sockets. The others are loaded when a request is first routed to them
+    if session_id is None:
+        routed_agent = make_routed_agent(config, agent_factory(hello_message, inference_backend, timer))
+        agent_future = load_in_background(routed_agent.registry.get, config["default_agent"])
 
     # ------------------------------------------------------------------------------------------------------------------
     # define the contexts and sockets of main control process
-    context = zmq.Context()
+    own_context = context is None
+    if own_context:
+        context = zmq.Context()
     sockets_list = []
 
     # reply socket to system
     socket_system_sync = context.socket(zmq.REQ)
-    socket_system_sync.connect("tcp://localhost:{}".format(port_config["system_sync_port"]))
+    socket_system_sync.connect(endpoints.connect("system_sync"))
     sockets_list.append(socket_system_sync)
 
     # socket for publishing to proxy
     socket_publisher = context.socket(zmq.PUB)
-    socket_publisher.connect("tcp://localhost:{}".format(port_config["pub_to_proxy_port"]))
+    socket_publisher.connect(endpoints.connect("pub_to_proxy"))
     sockets_list.append(socket_publisher)
 
     # socket for subscribing to proxy
     socket_subscriber = context.socket(zmq.SUB)
-    socket_subscriber.connect("tcp://localhost:{}".format(port_config["sub_to_proxy_port"]))
+    socket_subscriber.connect(endpoints.connect("sub_to_proxy"))
     socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"SYSTEM")
     socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"SPEECH_TO_TEXT")
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"VAD")  # so a drain doesn't cut off a user who has started talking
     sockets_list.append(socket_subscriber)
 
-    # # # open stt socket
+    # socket for partial transcripts, kept separate so they don't queue up on the main subscriber between turns
+    socket_partial_subscriber = context.socket(zmq.SUB)
+    socket_partial_subscriber.connect(endpoints.connect("sub_to_proxy"))
+    socket_partial_subscriber.setsockopt(zmq.SUBSCRIBE, b"STT_PARTIAL")
+    sockets_list.append(socket_partial_subscriber)
+
+    # socket for hearing about restarted modules, so requests that went down with them can be sent again
+    socket_restart_subscriber = context.socket(zmq.SUB)
+    socket_restart_subscriber.connect(endpoints.connect("sub_to_proxy"))
+    socket_restart_subscriber.setsockopt(zmq.SUBSCRIBE, b"SUPERVISOR")
+    sockets_list.append(socket_restart_subscriber)
+
+    # # # open stt socket. Relaxed so a request can be sent again if the other end is restarted
     socket_speech_to_text = context.socket(zmq.REQ)
-    socket_speech_to_text.connect("tcp://localhost:{}".format(port_config["stt_req_rep_port"]))
+    socket_speech_to_text.setsockopt(zmq.REQ_RELAXED, 1)
+    socket_speech_to_text.setsockopt(zmq.REQ_CORRELATE, 1)
+    socket_speech_to_text.connect(endpoints.connect("stt_req_rep"))
+    sockets_list.append(socket_speech_to_text)
     #
     # # open tts socket:
     socket_text_to_speech = context.socket(zmq.REQ)
-    socket_text_to_speech.connect("tcp://localhost:{}".format(port_config["tts_req_rep_port"]))
+    socket_text_to_speech.setsockopt(zmq.REQ_RELAXED, 1)
+    socket_text_to_speech.setsockopt(zmq.REQ_CORRELATE, 1)
+    socket_text_to_speech.connect(endpoints.connect("tts_req_rep"))
+    sockets_list.append(socket_text_to_speech)
 
     # make the poller.
     # NOTE: this doesn't include the speech to text and text to speech sockets as they are intended to be blocking
@@ -128,55 +1101,183 @@ def control_main(port_config=None, dialogue_config=None):
     poller.register(socket_subscriber, zmq.POLLIN)
 
     # ------------------------------------------------------------------------------------------------------------------
+    timer.mark("connect sockets")
+
     # make the agent class instance
-    if chatbot_model == 'DialogueGPT':
-        agent = DialogueGPTAgent(hello_message)
+    if session_id is not None:
+        # the server's config decides what it has, the session asks for ours
+        agent = RemoteAgent(context, endpoints.connect("dialogue_server"), session_id, config["default_agent"])
     else:
-        agent = BlenderBotAgent()
+        agent_future.result()  # raises if the load failed
+        del agent_future  # it holds on to the agent, which would then stay in memory after the registry unloads it
+        agent = routed_agent
+        if cache_responses:
+            agent = CachedAgent(agent, ResponseCache())
+    timer.mark("wait for agent")
 
     # ------------------------------------------------------------------------------------------------------------------
     # inform the system that we have connected all sockets and are ready to go
-    socket_system_sync.send(b"CONTROL MODULE")
+    socket_system_sync.send(ms.encode(ms.Message(ms.SYNC, "CONTROL MODULE", data=timer.to_bytes())))
     msg = socket_system_sync.recv()  # this one can be blocking
+    heartbeat = Heartbeat(context, endpoints, "CONTROL MODULE").start()
 
     # ------------------------------------------------------------------------------------------------------------------
-    t_sleep = 0.1
-
     # Now wait for the System to tell us that all modules have connected their sockets and we can start running things
     while True:
+        heartbeat.beat()
+        if not socket_subscriber.poll(POLL_TIMEOUT_MS):
+            continue
         topic, msg = socket_subscriber.recv_multipart()
-        if topic == b"SYSTEM" and msg == b"START":
+        if topic == b"SYSTEM" and ms.decode(msg).msg_type == ms.START:
             break
-        else:
-            sleep(t_sleep)
-    sleep(t_sleep)
 
     # ------------------------------------------------------------------------------------------------------------------
     # now start actual running of the system
 
-    # send hello message
-    speak_text(hello_message, socket_text_to_speech)
-    sleep(t_sleep)
+    # make sure the fixed phrases are in the text to speech cache, then send hello message
+    restarts = socket_restart_subscriber
+    with heartbeat.busy():
+        prewarm_speech([hello_message, shutdown_message, reprompt_message, okay_message], socket_text_to_speech,
+                       restarts)
+        speak_text(hello_message, socket_text_to_speech, restarts=restarts)
+    last_reply = hello_message  # for "say that again"
+
+    # the conversation state is kept here rather than in the agent so speculation can fork it
+    state = agent.new_state()
+    # straight to the routed agent, speculating through the response cache would count as lookups in its hit rate
+    prefetcher = SpeculativePrefetcher(routed_agent) if speculate and session_id is None else None
+
+    def on_partial(partial_text):
+        # speculative work on the partial transcript while the user is still talking
+        if prefetcher is not None:
+            prefetcher.on_partial(partial_text)
+
+    def on_tick():
+        heartbeat.beat()  # listening is the one place we come round a loop often
+        if prefetcher is not None:
+            prefetcher.on_tick()
+
+    # set by a DRAIN from the supervisor: finish the turn in flight, then shut down as if the user had said goodbye
+    drain = Event()
 
     # and loop over waiting for speech, sending it to the agent and speaking the response
-    while True:
+    while not drain.is_set():
+
+        # every turn gets an id so it can be followed through all the processes
+        trace_id = ms.new_trace_id()
 
         # listen for speech
-        captured_speech = listen_for_speech(socket_speech_to_text)
-        print(captured_speech)
+        if prefetcher is not None:
+            prefetcher.begin_turn(state)
+        transcript = listen_for_speech(socket_speech_to_text, socket_partial_subscriber, on_partial, trace_id,
+                                       on_tick=on_tick,
+                                       system=socket_subscriber, drain=drain, restarts=restarts)
+        if transcript is None:
+            break  # drained while nobody was talking
+        # the agent's generating and the text to speech process (which is supervised itself) speaking, neither of
+        # which comes back round this loop for a while
+        with heartbeat.busy():
+            captured_speech = transcript.text
+            print(captured_speech)
 
-        # TODO: The shutdown message should be configurable as well
-        if captured_speech in shutdown_commands:
-            speak_text("I'm going to sleep now. Let's talk more soon.", socket_text_to_speech)
-            socket_publisher.send_multipart([b"CONTROL", b"SHUTDOWN"])
-            break
+            # voice commands are handled here rather than by the agent. The speech to text process spots them as they're
+            # said (a COMMAND instead of a TRANSCRIPT), the index catches the rest in the final transcript
+            if transcript.msg_type == ms.COMMAND:
+                command = transcript.text
+                if command not in commands:
+                    # speech to text spotting commands from another config, which mustn't shut us down
+                    print("ignoring command {}, not one of ours".format(command))
+                    if prefetcher is not None:
+                        prefetcher.cancel()
+                    continue
+            else:
+                command = command_index.match(captured_speech)
+            if command == "shutdown":
+                speak_text(shutdown_message, socket_text_to_speech, trace_id, restarts)
+                break
+            if command is not None:
+                print("command:", command)
+                if prefetcher is not None:
+                    prefetcher.cancel()
+                respond_start = time()
+                finished = True
+                if command == "repeat":
+                    finished = speak_text(last_reply, socket_text_to_speech, trace_id, restarts)
+                elif command in ("louder", "quieter"):
+                    gain_db = volume_step_db if command == "louder" else -volume_step_db
+                    request_reply(socket_text_to_speech, ms.encode(ms.Message(ms.VOLUME, str(gain_db))), restarts)
+                    finished = speak_text(okay_message, socket_text_to_speech, trace_id, restarts)
+                # "stop" needs nothing more: the user talking has already stopped the reply (barge-in)
+                tracer.record(trace_id, "respond", respond_start, time() - respond_start, command=command,
+                              interrupted=not finished)
+                tracer.publish(socket_publisher)
+                continue
+
+            # not sure what they said, ask again rather than have the agent answer it
+            if reprompt_policy is not None and reprompt_policy.should_reprompt(transcript):
+                print("low confidence {:.2f}, asking again".format(transcript.confidence))
+                if prefetcher is not None:
+                    prefetcher.cancel()
+                respond_start = time()
+                finished = speak_text(reprompt_message, socket_text_to_speech, trace_id, restarts)
+                tracer.record(trace_id, "respond", respond_start, time() - respond_start, reprompt=True,
+                              confidence=transcript.confidence, interrupted=not finished)
+                tracer.publish(socket_publisher)
+                continue
+
+            # ask the agent what to say in return and speak the response
+            # if the user talks over the reply (barge-in) the rest of it is dropped and we go straight to the next turn
+            respond_start = time()
+            timings_before = getattr(agent, "last_timings", None)
+            speculative_reply = prefetcher.take(captured_speech) if prefetcher is not None else None
+            if speculative_reply is not None and stream_responses:
+                chunker = ClauseChunker()
+                last_reply, finished = speak_text_stream(chunker.feed(speculative_reply + " ") + chunker.flush(),
+                                                         socket_text_to_speech, trace_id, restarts)
+            elif speculative_reply is not None:
+                last_reply = speculative_reply
+                finished = speak_text(speculative_reply, socket_text_to_speech, trace_id, restarts)
+            elif stream_responses:
+                last_reply, finished = speak_text_stream(agent.get_response_stream(captured_speech, state),
+                                                         socket_text_to_speech, trace_id, restarts)
+            else:
+                last_reply = agent.get_response(captured_speech, state)
+                finished = speak_text(last_reply, socket_text_to_speech, trace_id, restarts)
+
+            # timings of this turn, the agent's are only new if it generated the whole reply
+            if getattr(agent, "last_timings", None) is not timings_before and speculative_reply is None:
+                tracer.record_timings(trace_id, agent.last_timings)
+            tracer.record(trace_id, "respond", respond_start, time() - respond_start,
+                          speculative=speculative_reply is not None, interrupted=not finished)
+            tracer.publish(socket_publisher)
+            if not finished:
+                print("interrupted")
+            if session_id is None:
+                routed_agent.registry.unload_idle()
 
-        # ask the agent what to say in return
-        text_to_speak = agent.get_response(captured_speech)
+    # tell the system we're done, it shuts everything down
+    socket_publisher.send_multipart([b"CONTROL", ms.encode(ms.Message(ms.SHUTDOWN, trace_id=trace_id))])
+    if session_id is not None:
+        agent.end_session()
+    if isinstance(agent, CachedAgent):
+        print("response cache", agent.cache.stats())
+    if session_id is None:
+        print("agents", routed_agent.stats())
+    if prefetcher is not None:
+        prefetcher.shut_down()
+        print("speculation", prefetcher.stats())
+    if reprompt_policy is not None:
+        print("reprompts", reprompt_policy.reprompts)
 
-        # speak the response
-        speak_text(text_to_speak, socket_text_to_speech)
-        sleep(t_sleep)
+    # close up, the context may be shared with the other modules so sockets are closed one by one
+    heartbeat.stop()
+    if session_id is not None:
+        agent.close()
+    for sock in sockets_list:
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.close()
+    if own_context:
+        context.term()
 
 
 if __name__ == "__main__":
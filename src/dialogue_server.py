@@ -0,0 +1,178 @@
+from time import time
+from threading import Lock
+import zmq
+from dialogue_control import make_agent, agent_factory
+from agent_registry import load_dialogue_config, make_routed_agent, RoutedAgent
+from generation_scheduler import BatchScheduler
+import message_schema as ms
+from endpoints import make_endpoints
+
+
+class Session:
+    """ What the server remembers about one conversation"""
+
+    def __init__(self, state):
+        self.state = state
+        self.last_seen = time()
+        self.turns = 0
+
+
+def dialogue_server_main(port_config=None, chatbot_model="BlenderBot", inference_backend="int8",
+                         starting_message="Hello! My name is Rose. How are you today? What would you like to talk about?",
+                         session_timeout_s=1800.0, max_batch_size=8, max_batch_wait_s=0.02, metrics_interval_s=60.0,
+                         endpoints=None, dialogue_config=None, shutdown_with_system=True):
+    """ One loaded agent serving many conversations.
+
+    Each user's control process connects a DEALER socket (see RemoteAgent in dialogue_control.py) to the server's
+    ROUTER socket and sends DIALOGUE_REQUEST messages tagged with its session id. Conversation state, e.g. the
+    DialogueGPT chat history, is kept per session, so however many sessions there are only one copy of the model is
+    ever in memory. Sessions that have been quiet for session_timeout_s are forgotten.
+
+    Requests go through a BatchScheduler, so requests from different sessions that arrive close together are
+    generated in one batch. Finished replies come back from the scheduler thread over an inproc socket, which keeps
+    all the sending on the ROUTER socket in this thread.
+
+    :param port_config: dict of tcp ports, only dialogue_server_port is used, and only when no endpoints are given
+    :param chatbot_model: 'BlenderBot' or 'DialogueGPT'
+    :param inference_backend: see inference_backends.py
+    :param starting_message: seeds the conversation history of models that have one
+    :param session_timeout_s: idle time after which a session's state is dropped
+    :param max_batch_size: most requests generated together
+    :param max_batch_wait_s: how long a request waits for others to batch with
+    :param metrics_interval_s: how often to print the scheduler metrics
+    :param endpoints: EndpointConfig with the socket addresses, see endpoints.py. Use tcp or ipc, the server runs in
+        a process of its own
+    :param dialogue_config: JSON file of agents (see agent_registry.py) to serve instead of the one chatbot_model.
+        Sessions can then pick their agent and requests are routed, the agents are loaded when first asked for
+    :param shutdown_with_system: exit when the dialogue system at endpoints broadcasts SHUTDOWN. A DRAIN is ignored,
+        the control module may still want a reply for the turn it's finishing. False for a server shared by stacks
+    """
+    endpoints = make_endpoints(port_config, endpoints)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Make context and sockets
+    context = zmq.Context()
+
+    socket_router = context.socket(zmq.ROUTER)
+    # a client that gave up waiting reconnects under the same session identity, it takes over from the old connection
+    socket_router.setsockopt(zmq.ROUTER_HANDOVER, 1)
+    socket_router.bind(endpoints.bind("dialogue_server"))
+
+    # the system's SHUTDOWN, so the server doesn't outlive it
+    socket_system_subscriber = context.socket(zmq.SUB)
+    if shutdown_with_system:
+        socket_system_subscriber.connect(endpoints.connect("sub_to_proxy"))
+        socket_system_subscriber.setsockopt(zmq.SUBSCRIBE, b"SYSTEM")
+
+    # finished replies from the scheduler thread. add_done_callback runs the callback straight away in this thread if
+    # the future is already done, so sends on the push socket are guarded by a lock
+    socket_done_lock = Lock()
+    socket_done_pull = context.socket(zmq.PULL)
+    socket_done_pull.bind("inproc://dialogue_server_done")
+    socket_done_push = context.socket(zmq.PUSH)
+    socket_done_push.connect("inproc://dialogue_server_done")
+
+    poller = zmq.Poller()
+    poller.register(socket_router, zmq.POLLIN)
+    poller.register(socket_done_pull, zmq.POLLIN)
+    poller.register(socket_system_subscriber, zmq.POLLIN)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # load the one and only copy of the model, or of each of the configured ones when they're first needed
+    if dialogue_config is not None:
+        config = load_dialogue_config(dialogue_config)
+        agent = make_routed_agent(config, agent_factory(starting_message, inference_backend))
+        agent.registry.get(config["default_agent"])
+    else:
+        agent = make_agent(chatbot_model, starting_message, inference_backend)
+    scheduler = BatchScheduler(agent, max_batch_size, max_batch_wait_s)
+    sessions = {}
+
+    def make_done_callback(identity, request):
+        def on_done(future):
+            if future.exception() is not None:
+                print("generation failed for session {}: {}".format(request.session_id, future.exception()))
+                reply = request.reply(ms.DIALOGUE_REPLY, "")
+            else:
+                reply = request.reply(ms.DIALOGUE_REPLY, future.result())
+            with socket_done_lock:
+                socket_done_push.send_multipart([identity, ms.encode(reply)])
+        return on_done
+
+    def new_session_state(agent_name):
+        """ the state of a new session, on the agent it asks for if there's a choice"""
+        if not isinstance(agent, RoutedAgent) or not agent_name:
+            return agent.new_state()
+        if agent_name not in agent.registry.specs:
+            print("session asked for unknown agent {}, using {}".format(agent_name, agent.default))
+            return agent.new_state()
+        return agent.new_state(agent_name)
+
+    print("Dialogue server ready on {}".format(endpoints.connect("dialogue_server")))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # main loop
+    last_metrics = time()
+    try:
+        while True:
+            socks = dict(poller.poll(1000))
+
+            if socket_system_subscriber in socks and socks[socket_system_subscriber] == zmq.POLLIN:
+                topic, message = socket_system_subscriber.recv_multipart()
+                if ms.decode(message).msg_type == ms.SHUTDOWN:
+                    print("Dialogue server: the system is shutting down")
+                    break
+
+            if socket_router in socks and socks[socket_router] == zmq.POLLIN:
+                identity, empty, payload = socket_router.recv_multipart()
+                try:
+                    msg = ms.decode(payload)
+                except ms.MessageError as e:
+                    print("dropping bad message from {}: {}".format(identity, e))
+                    continue
+
+                if msg.msg_type == ms.DIALOGUE_REQUEST:
+                    session = sessions.get(msg.session_id)
+                    if session is None:
+                        session = sessions[msg.session_id] = Session(new_session_state(msg.data.decode()))
+                    session.last_seen = time()
+                    session.turns += 1
+                    future = scheduler.submit(msg.text, session.state)
+                    future.add_done_callback(make_done_callback(identity, msg))
+
+                elif msg.msg_type == ms.SESSION_END:
+                    sessions.pop(msg.session_id, None)
+
+            # pass finished replies back to whoever asked
+            if socket_done_pull in socks and socks[socket_done_pull] == zmq.POLLIN:
+                identity, payload = socket_done_pull.recv_multipart()
+                socket_router.send_multipart([identity, b"", payload])
+
+            now = time()
+            if now - last_metrics > metrics_interval_s:
+                print("dialogue server: {} sessions, scheduler {}".format(len(sessions), scheduler.metrics()))
+                if isinstance(agent, RoutedAgent):
+                    print("agents", agent.stats())
+                last_metrics = now
+            if isinstance(agent, RoutedAgent):
+                agent.registry.unload_idle(now)
+
+            # forget sessions nobody has talked to for a while
+            for session_id in [sid for sid, session in sessions.items()
+                               if now - session.last_seen > session_timeout_s]:
+                del sessions[session_id]
+
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Dialogue server shutting down, {} open sessions".format(len(sessions)))
+        scheduler.shut_down()
+        print("scheduler", scheduler.metrics())
+        for sock in [socket_router, socket_done_pull, socket_done_push, socket_system_subscriber]:
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.close()
+        context.term()
+
+
+if __name__ == "__main__":
+    dialogue_server_main()
@@ -0,0 +1,102 @@
+""" Where every socket in the system binds and connects.
+
+All the modules used to build "tcp://localhost:<port>" addresses from their own copy of the port dict. They now ask an
+EndpointConfig instead, which knows one set of names and can hand out addresses for three transports:
+
+    "tcp"     tcp://*:<port> / tcp://<host>:<port>. Needed when modules run on different machines
+    "ipc"     unix domain sockets in ipc_dir. Same host, multi process, no loopback TCP and no port numbers to collide
+    "inproc"  in process queues. Only works when the modules run as threads sharing one zmq context
+
+ipc and inproc addresses carry a stack name, so several stacks on one box stay out of each other's way without having
+to pick ports for them.
+"""
+import os
+import tempfile
+
+TRANSPORTS = ["tcp", "ipc", "inproc"]
+
+# the endpoint names. With tcp each one is on port_config[name + "_port"]
+ENDPOINT_NAMES = ["system_sync", "pub_to_proxy", "sub_to_proxy", "stt_req_rep", "tts_req_rep", "dialogue_server",
+                  "stt_pool", "stt_pool_workers", "tts_pool", "tts_pool_workers"]
+
+
+def default_port_config():
+    """ the tcp ports used when nobody says otherwise"""
+    return {"system_sync_port": 5553,  # report for system to check that modules are sync'ed properly
+            "pub_to_proxy_port": 5554,  # port to publish to proxy so in the proxy it is xsub
+            "sub_to_proxy_port": 5555,  # port to subscribe to the proxy so in the proxy it is xpub
+            "stt_req_rep_port": 5556,  # REQ-REP control port for the stt pub sub
+            "tts_req_rep_port": 5557,  # REQ-REP port for the text to speech
+            "dialogue_server_port": 5558,  # ROUTER port of the shared multi-session dialogue server
+            "stt_pool_port": 5559,  # clients of the recognizer worker pool broker, see worker_pool.py
+            "stt_pool_workers_port": 5560,  # recognizer workers
+            "tts_pool_port": 5561,  # clients of the synthesis worker pool broker
+            "tts_pool_workers_port": 5562,  # synthesis workers
+            "metrics_http_port": 9464,  # Prometheus text endpoint of the metrics collector (http), None for none
+            }
+
+
+class EndpointConfig:
+    """ Addresses of all the sockets of one dialogue system stack. Plain attributes only, so it can be handed to
+    spawned processes"""
+
+    def __init__(self, transport="tcp", port_config=None, host="localhost", stack_name=None, ipc_dir=None):
+        """
+        :param transport: "tcp", "ipc" or "inproc"
+        :param port_config: dict of tcp ports, missing entries come from default_port_config()
+        :param host: host to connect to with tcp
+        :param stack_name: prefix for ipc and inproc addresses and for the shared memory audio rings, defaults to one
+            based on the pid of the process that made the config (so every process of the stack gets the same one)
+        :param ipc_dir: directory for the ipc socket files, defaults to the temp directory
+        """
+        if transport not in TRANSPORTS:
+            raise ValueError("unknown transport {!r}, choose from {}".format(transport, TRANSPORTS))
+        self.transport = transport
+        self.port_config = default_port_config()
+        if port_config is not None:
+            self.port_config.update(port_config)
+        self.host = host
+        self.stack_name = "sv{}".format(os.getpid()) if stack_name is None else stack_name
+        self.ipc_dir = tempfile.gettempdir() if ipc_dir is None else ipc_dir
+
+    def _check(self, name):
+        if name not in ENDPOINT_NAMES:
+            raise KeyError("unknown endpoint {!r}, choose from {}".format(name, ENDPOINT_NAMES))
+
+    def _local_address(self, name):
+        if self.transport == "ipc":
+            return "ipc://{}".format(os.path.join(self.ipc_dir, "{}-{}".format(self.stack_name, name)))
+        return "inproc://{}-{}".format(self.stack_name, name)
+
+    def bind(self, name: str):
+        """ address for the socket that binds the endpoint"""
+        self._check(name)
+        if self.transport == "tcp":
+            return "tcp://*:{}".format(self.port_config[name + "_port"])
+        return self._local_address(name)
+
+    def connect(self, name: str):
+        """ address for sockets connecting to the endpoint"""
+        self._check(name)
+        if self.transport == "tcp":
+            return "tcp://{}:{}".format(self.host, self.port_config[name + "_port"])
+        return self._local_address(name)
+
+    def cleanup(self):
+        """ remove ipc socket files left behind"""
+        if self.transport != "ipc":
+            return
+        for name in ENDPOINT_NAMES:
+            path = os.path.join(self.ipc_dir, "{}-{}".format(self.stack_name, name))
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __repr__(self):
+        return "EndpointConfig({}, {})".format(self.transport, self.connect("system_sync"))
+
+
+def make_endpoints(port_config=None, endpoints=None):
+    """ the EndpointConfig a module main should use: the one it was given, else tcp on the given ports"""
+    if endpoints is not None:
+        return endpoints
+    return EndpointConfig("tcp", port_config)
@@ -0,0 +1,113 @@
+from concurrent.futures import Future
+from threading import Thread
+from time import time
+import queue
+
+
+class BatchScheduler:
+    """ Collects queries from many callers and runs them through the agent in batches.
+
+    A single worker thread waits for the first pending query, then keeps collecting for up to max_wait_s or until
+    max_batch_size queries are waiting, and runs them all with one call to agent.get_responses (one padded generate).
+    Each caller gets a concurrent.futures.Future for its own reply. Two queries for the same conversation state are
+    never put in the same batch, the second one waits for the next batch.
+    """
+
+    def __init__(self, agent, max_batch_size=8, max_wait_s=0.02):
+        """
+        :param agent: agent with get_responses(queries, states)
+        :param max_batch_size: most queries in one generate call
+        :param max_wait_s: longest a query waits for others to batch with, once the worker is free
+        """
+        self.agent = agent
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+        self.queue = queue.Queue()
+        self.deferred = []
+
+        # metrics
+        self.submitted = 0
+        self.batches = 0
+        self.batched_queries = 0
+        self.max_queue_depth = 0
+        self.total_queue_wait_s = 0.0
+        self.total_generate_s = 0.0
+
+        self.running = True
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, query: str, state=None):
+        """ queue a query, returns a Future that will hold the reply"""
+        future = Future()
+        self.submitted += 1
+        self.queue.put((query, state, future, time()))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return future
+
+    def _collect_batch(self):
+        """ block for the first query, then gather more until the batch is full or max_wait_s has passed"""
+        carried, self.deferred = self.deferred, []
+        batch = []
+        state_ids = set()
+
+        def add(item):
+            state = item[1]
+            if len(batch) >= self.max_batch_size or (state is not None and id(state) in state_ids):
+                self.deferred.append(item)
+                return
+            if state is not None:
+                state_ids.add(id(state))
+            batch.append(item)
+
+        for item in carried:
+            add(item)
+        if not batch:
+            try:
+                add(self.queue.get(timeout=0.5))
+            except queue.Empty:
+                return []
+
+        deadline = time() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time()
+            try:
+                # once the wait is over, still take whatever is already queued
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            add(item)
+        return batch
+
+    def _run(self):
+        while self.running:
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            start = time()
+            for _, _, _, submitted_at in batch:
+                self.total_queue_wait_s += start - submitted_at
+            try:
+                replies = self.agent.get_responses([item[0] for item in batch], [item[1] for item in batch])
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            self.total_generate_s += time() - start
+            self.batches += 1
+            self.batched_queries += len(batch)
+            for (_, _, future, _), reply in zip(batch, replies):
+                future.set_result(reply)
+
+    def metrics(self):
+        return {"queue_depth": self.queue.qsize() + len(self.deferred),
+                "max_queue_depth": self.max_queue_depth,
+                "submitted": self.submitted,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_queries / self.batches if self.batches else 0.0,
+                "mean_queue_wait_s": self.total_queue_wait_s / self.batched_queries if self.batched_queries else 0.0,
+                "mean_generate_s": self.total_generate_s / self.batches if self.batches else 0.0}
+
+    def shut_down(self):
+        self.running = False
+        self.thread.join()
@@ -0,0 +1,168 @@
+""" Faster CPU inference for the dialogue agents.
+
+The agents run their model in fp32 on the CPU whenever there's no GPU. This module swaps in a faster backend:
+
+    "reference"  the model as loaded, fp32
+    "int8"       torch dynamic quantization of the Linear layers to int8 (weights int8, activations quantized on the
+                 fly). Usually the biggest CPU win for transformer models, for a small change in outputs. GPT-2 style
+                 models (DialoGPT) use Conv1D layers rather than Linear, those are turned into Linear layers first
+    "compile"    torch.compile of the model's forward pass (needs torch 2). TorchScript isn't offered as generate()
+                 with a growing decoder cache doesn't trace
+    "onnx"       export to ONNX and run with ONNX Runtime through optimum (pip install optimum[onnxruntime])
+
+All backends keep the huggingface generate() interface, so the agents don't need to know which one they have.
+
+Running this file compares every backend against the reference on a few prompts: greedy decoding so the outputs
+are deterministic, token level agreement with the reference as the parity check, and mean latency per reply.
+"""
+from time import time
+import torch
+
+BACKENDS = ["reference", "int8", "compile", "onnx"]
+
+# optimum is optional, only needed for the onnx backend
+try:
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTModelForCausalLM
+except ImportError:
+    ORTModelForSeq2SeqLM = ORTModelForCausalLM = None
+
+
+def apply_backend(model, backend: str, model_source=None):
+    """ Return the model running on the given backend.
+
+    :param model: huggingface model, as loaded
+    :param backend: one of BACKENDS
+    :param model_source: hub name or local directory the model was loaded from, needed for the onnx export
+    """
+    if backend == "reference":
+        return model
+
+    if backend == "int8":
+        converted = conv1d_to_linear(model)
+        if converted:
+            print("BACKEND: {} Conv1D layers turned into Linear for int8".format(converted))
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if backend == "compile":
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("the compile backend needs torch 2 or later")
+        model.forward = torch.compile(model.forward, dynamic=True)
+        return model
+
+    if backend == "onnx":
+        if ORTModelForSeq2SeqLM is None:
+            raise RuntimeError("the onnx backend needs optimum: pip install optimum[onnxruntime]")
+        if model_source is None:
+            raise ValueError("the onnx backend needs model_source to export from")
+        ort_class = ORTModelForSeq2SeqLM if model.config.is_encoder_decoder else ORTModelForCausalLM
+        return ort_class.from_pretrained(model_source, export=True)
+
+    raise ValueError("unknown inference backend {!r}, choose from {}".format(backend, BACKENDS))
+
+
+def conv1d_to_linear(model):
+    """ Replace the GPT-2 style Conv1D layers of model (transformers' Conv1D, a Linear with its weight transposed)
+    by the equivalent torch.nn.Linear, so quantize_dynamic picks them up.
+
+    :return: the number of layers replaced
+    """
+    replaced = 0
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            # by class name, transformers moved Conv1D between modules over its versions
+            if type(child).__name__ != "Conv1D":
+                continue
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features, bias=child.bias is not None)
+            with torch.no_grad():
+                linear.weight.copy_(child.weight.t())
+                if child.bias is not None:
+                    linear.bias.copy_(child.bias)
+            setattr(parent, name, linear)
+            replaced += 1
+    return replaced
+
+
+def greedy_replies(model, tokenizer, prompts, max_new_tokens=40):
+    """ deterministic replies for parity checks, with the time each one took"""
+    replies = []
+    for prompt in prompts:
+        inputs = tokenizer(prompt + tokenizer.eos_token, return_tensors='pt')
+        start = time()
+        with torch.no_grad():
+            output = model.generate(**inputs, do_sample=False, num_beams=1, max_new_tokens=max_new_tokens,
+                                    pad_token_id=tokenizer.eos_token_id)
+        elapsed = time() - start
+        if not model.config.is_encoder_decoder:
+            output = output[:, inputs["input_ids"].shape[-1]:]
+        replies.append((output[0].tolist(), elapsed))
+    return replies
+
+
+def token_agreement(reference_ids, candidate_ids):
+    """ fraction of positions where two token sequences agree, over the longer of the two"""
+    length = max(len(reference_ids), len(candidate_ids))
+    if length == 0:
+        return 1.0
+    matches = sum(1 for a, b in zip(reference_ids, candidate_ids) if a == b)
+    return matches / length
+
+
+def compare_backends(tokenizer_class, model_class, model_name: str, prompts, backends=None, max_new_tokens=40):
+    """ Parity and latency report for each backend against the fp32 reference.
+
+    :return: list of dicts with backend, mean latency, speed up over reference, mean token agreement and exact match
+        rate. Backends that aren't available here are reported with their error.
+    """
+    from startup import load_pretrained  # here rather than at the top so the agents can import this module cheaply
+
+    backends = BACKENDS if backends is None else backends
+    tokenizer, reference_model = load_pretrained(tokenizer_class, model_class, model_name)
+    reference_model.eval()
+    reference = greedy_replies(reference_model, tokenizer, prompts, max_new_tokens)
+    reference_latency = sum(t for _, t in reference) / len(reference)
+
+    report = []
+    for backend in backends:
+        if backend == "reference":
+            replies = reference
+        else:
+            try:
+                # fresh copy of the model each time, quantize and compile modify it
+                _, model = load_pretrained(tokenizer_class, model_class, model_name)
+                model = apply_backend(model, backend, model_name)
+                greedy_replies(model, tokenizer, prompts[:1], max_new_tokens)  # warm up (compile happens here)
+                replies = greedy_replies(model, tokenizer, prompts, max_new_tokens)
+            except Exception as e:
+                report.append({"backend": backend, "error": str(e)})
+                continue
+        latency = sum(t for _, t in replies) / len(replies)
+        agreement = [token_agreement(ref_ids, ids) for (ref_ids, _), (ids, _) in zip(reference, replies)]
+        report.append({"backend": backend,
+                       "mean_latency_s": latency,
+                       "speed_up": reference_latency / latency,
+                       "token_agreement": sum(agreement) / len(agreement),
+                       "exact_match": sum(1 for a in agreement if a == 1.0) / len(agreement)})
+    return report
+
+
+def print_report(report):
+    print("{:<10s} {:>10s} {:>9s} {:>10s} {:>8s}".format("backend", "latency", "speed up", "agreement", "exact"))
+    for row in report:
+        if "error" in row:
+            print("{:<10s} unavailable: {}".format(row["backend"], row["error"]))
+        else:
+            print("{:<10s} {:>9.3f}s {:>8.2f}x {:>9.1%} {:>7.1%}".format(
+                row["backend"], row["mean_latency_s"], row["speed_up"], row["token_agreement"], row["exact_match"]))
+
+
+if __name__ == "__main__":
+    from transformers import BlenderbotTokenizer, BlenderbotForConditionalGeneration
+
+    parity_prompts = ["Hello! How are you today?",
+                      "What would you like to talk about?",
+                      "I just got back from a hike in the mountains.",
+                      "Do you have any pets?",
+                      "What's your favourite book?"]
+    print_report(compare_backends(BlenderbotTokenizer, BlenderbotForConditionalGeneration,
+                                  "facebook/blenderbot-400M-distill", parity_prompts))
@@ -0,0 +1,186 @@
+""" The one message format used between the processes.
+
+Every zmq payload (pub/sub topics stay as plain byte strings so subscriptions keep working) is a Message packed as a
+fixed size struct header followed by the variable length parts:
+
+    header  magic, schema version, message type, message id, trace id, session id, timestamp,
+            confidence, number of words, text length, data length
+    text    utf8
+    words   per word: start, end, confidence, length, then the utf8 word
+    data    opaque bytes for anything that doesn't fit the above
+
+Parsing is struct.unpack_from over a memoryview, so there is no eval, no JSON and no guessing what a byte string
+means. A message from a different schema version or that isn't a Message at all raises MessageError.
+"""
+from collections import namedtuple
+from itertools import count
+import json
+import os
+import random
+import struct
+from time import time
+
+MAGIC = b"SV"
+SCHEMA_VERSION = 2  # 2 added the session id
+
+_HEADER = struct.Struct("!2sBBQQQdfHII")
+_WORD = struct.Struct("!fffH")
+
+# message types
+SYNC = 1            # module -> system: sockets connected and ready, text is the module name
+START = 2           # system -> all: everyone is ready, start running
+SHUTDOWN = 3        # shut the system down
+LISTEN_ONCE = 4     # control -> speech to text: listen for one utterance
+TRANSCRIPT = 5      # speech to text -> control: final transcript with confidence and word timings
+PARTIAL = 6         # speech to text -> all: partial hypothesis while the user is still talking
+VAD_EVENT = 7       # speech to text -> all: text is SPEECH_START or SPEECH_END
+SPEAK = 8           # control -> text to speech: speak text and reply once it has been spoken
+STREAM_CHUNK = 9    # control -> text to speech: queue a chunk of a streamed reply, replied to straight away
+STREAM_END = 10     # control -> text to speech: reply once everything streamed has been spoken
+PREWARM = 11        # control -> text to speech: cache the newline separated phrases in text
+ACK = 12            # generic reply, text says what happened
+DIALOGUE_REQUEST = 13   # control -> dialogue server: text is the user's utterance for session session_id, data the
+                        # name of the agent the session wants (see agent_registry.py), empty for the default
+DIALOGUE_REPLY = 14     # dialogue server -> control: text is the agent's reply
+SESSION_END = 15        # control -> dialogue server: forget everything about session_id
+PLAYBACK = 16           # text to speech -> all: text is PLAYBACK_START or PLAYBACK_END of a spoken reply
+INTERRUPT = 17          # speech to text -> all: the user has started talking over the reply
+AUDIO = 18              # audio producer -> all: text is a shared memory ring name, data a span of it (see audio_bus.py)
+SPAN = 19               # any -> metrics collector: text is the stage, timestamp its start, data json (see tracing.py)
+HEARTBEAT = 20          # worker <-> pool broker: still alive (see worker_pool.py)
+READY = 21              # worker -> pool broker: ready for requests
+RECOGNIZE = 22          # speech to text -> recognizer pool: data is a whole utterance of int16 PCM, text its rate
+SYNTHESIZE = 23         # text to speech -> synthesis pool: text to synthesize, the reply's data is a .wav file
+WORKER_LOST = 24        # pool broker -> supervisor: text is the identity of a worker that died or hung
+DRAIN = 25              # supervisor -> all: finish the turn in flight, then shut down (see supervisor.py)
+RESTARTED = 26          # supervisor -> all: text is the name of a module that was restarted and has synced again
+COMMAND = 27            # speech to text -> control: instead of a TRANSCRIPT, text is a voice command (see commands.py)
+VOLUME = 28             # control -> text to speech: text is the change of playback volume in dB
+
+TYPE_NAMES = {SYNC: "SYNC", START: "START", SHUTDOWN: "SHUTDOWN", LISTEN_ONCE: "LISTEN_ONCE",
+              TRANSCRIPT: "TRANSCRIPT", PARTIAL: "PARTIAL", VAD_EVENT: "VAD_EVENT", SPEAK: "SPEAK",
+              STREAM_CHUNK: "STREAM_CHUNK", STREAM_END: "STREAM_END", PREWARM: "PREWARM", ACK: "ACK",
+              DIALOGUE_REQUEST: "DIALOGUE_REQUEST", DIALOGUE_REPLY: "DIALOGUE_REPLY", SESSION_END: "SESSION_END",
+              PLAYBACK: "PLAYBACK", INTERRUPT: "INTERRUPT", AUDIO: "AUDIO",
+              SPAN: "SPAN", HEARTBEAT: "HEARTBEAT", READY: "READY", RECOGNIZE: "RECOGNIZE", SYNTHESIZE: "SYNTHESIZE",
+              WORKER_LOST: "WORKER_LOST", DRAIN: "DRAIN", RESTARTED: "RESTARTED",
+              COMMAND: "COMMAND", VOLUME: "VOLUME"}
+
+Word = namedtuple("Word", ["word", "start", "end", "confidence"])
+
+# message ids are unique per process without any coordination: pid in the top half, a counter in the bottom
+_message_ids = count(1)
+
+
+class MessageError(ValueError):
+    """ raised when a payload can't be parsed as a Message"""
+    pass
+
+
+def new_message_id():
+    return ((os.getpid() & 0xFFFFFFFF) << 32) | (next(_message_ids) & 0xFFFFFFFF)
+
+
+def new_trace_id():
+    """ a random id for following one dialogue turn through all the processes"""
+    return random.getrandbits(64)
+
+
+class Message:
+
+    __slots__ = ("msg_type", "text", "confidence", "words", "data", "msg_id", "trace_id", "session_id", "timestamp")
+
+    def __init__(self, msg_type: int, text="", confidence=1.0, words=(), data=b"", msg_id=None, trace_id=0,
+                 session_id=0, timestamp=None):
+        """
+        :param msg_type: one of the message type constants in this module
+        :param text: utf8 text, e.g. a transcript or the text to speak
+        :param confidence: overall confidence, 1.0 when not applicable
+        :param words: sequence of Word
+        :param data: opaque bytes
+        :param msg_id: unique id, generated if None
+        :param trace_id: id of the dialogue turn this message belongs to, 0 if none
+        :param session_id: id of the conversation this message belongs to, 0 for the single local session
+        :param timestamp: seconds since the epoch, now if None
+        """
+        self.msg_type = msg_type
+        self.text = text
+        self.confidence = confidence
+        self.words = words
+        self.data = data
+        self.msg_id = new_message_id() if msg_id is None else msg_id
+        self.trace_id = trace_id
+        self.session_id = session_id
+        self.timestamp = time() if timestamp is None else timestamp
+
+    def reply(self, msg_type: int, text="", **kwargs):
+        """ a new message that belongs to the same trace and session as this one"""
+        return Message(msg_type, text, trace_id=self.trace_id, session_id=self.session_id, **kwargs)
+
+    def __repr__(self):
+        return "Message({}, text={!r}, confidence={:.2f}, words={}, trace_id={:x})".format(
+            TYPE_NAMES.get(self.msg_type, self.msg_type), self.text, self.confidence, len(self.words), self.trace_id)
+
+
+def encode(msg: Message):
+    """ pack a Message into bytes"""
+    text = msg.text.encode('utf8')
+    parts = [_HEADER.pack(MAGIC, SCHEMA_VERSION, msg.msg_type, msg.msg_id, msg.trace_id, msg.session_id,
+                          msg.timestamp, msg.confidence, len(msg.words), len(text), len(msg.data)), text]
+    for word in msg.words:
+        word_bytes = word.word.encode('utf8')
+        parts.append(_WORD.pack(word.start, word.end, word.confidence, len(word_bytes)))
+        parts.append(word_bytes)
+    parts.append(msg.data)
+    return b"".join(parts)
+
+
+def decode(payload):
+    """ unpack bytes (or any buffer, e.g. a zmq Frame) into a Message
+
+    :raises MessageError: if the payload isn't a Message of this schema version
+    """
+    buf = memoryview(payload)
+    try:
+        magic, version, msg_type, msg_id, trace_id, session_id, timestamp, confidence, n_words, text_len, data_len \
+            = _HEADER.unpack_from(buf, 0)
+    except struct.error:
+        raise MessageError("payload too short for a message header ({} bytes)".format(len(buf)))
+    if magic != MAGIC:
+        raise MessageError("not a message, bad magic {!r}".format(magic))
+    if version != SCHEMA_VERSION:
+        raise MessageError("message schema version {}, expected {}".format(version, SCHEMA_VERSION))
+
+    try:
+        offset = _HEADER.size
+        text = str(buf[offset:offset + text_len], 'utf8')
+        offset += text_len
+        words = []
+        for _ in range(n_words):
+            start, end, word_confidence, word_len = _WORD.unpack_from(buf, offset)
+            offset += _WORD.size
+            words.append(Word(str(buf[offset:offset + word_len], 'utf8'), start, end, word_confidence))
+            offset += word_len
+        data = bytes(buf[offset:offset + data_len])
+        offset += data_len
+    except (struct.error, UnicodeDecodeError) as e:
+        raise MessageError("corrupt message: {}".format(e))
+    if offset != len(buf):
+        raise MessageError("message length mismatch, parsed {} of {} bytes".format(offset, len(buf)))
+
+    return Message(msg_type, text, confidence, words, data, msg_id, trace_id, session_id, timestamp)
+
+
+def transcript_from_vosk(result_json: str, msg_type=TRANSCRIPT, trace_id=0, time_offset=0.0):
+    """ turn a Vosk Result()/FinalResult() json string into a TRANSCRIPT message
+
+    The per word "result" list is only there when the recognizer has SetWords(True). Overall confidence is the mean
+    word confidence, or 1.0 when there are no word confidences to go on.
+
+    :param time_offset: subtracted from the word times, Vosk's run from when the recognizer was made
+    """
+    result = json.loads(result_json)
+    words = [Word(w["word"], w["start"] - time_offset, w["end"] - time_offset, w["conf"])
+             for w in result.get("result", [])]
+    confidence = sum(w.confidence for w in words) / len(words) if words else 1.0
+    return Message(msg_type, result.get("text", ""), confidence, words, trace_id=trace_id)
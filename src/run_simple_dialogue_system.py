@@ -1,98 +1,114 @@
 from time import sleep, time
+from threading import Thread
 import zmq
 import multiprocessing as mp
-from speech_to_text import speech_to_text_main
+from speech_to_text import speech_to_text_main, recognizer_worker_main
 from dialogue_control import control_main
-from text_to_speech import text_to_speech_main
+from text_to_speech import text_to_speech_main, synthesis_worker_main
+from tracing import metrics_collector_main
+import message_schema as ms
+from startup import StartupTimer
+from endpoints import EndpointConfig
+from event_loop import POLL_TIMEOUT_MS
+from worker_pool import recognizer_broker_main, synthesis_broker_main, worker_pid
+from supervisor import Supervisor
 
 
-def start_pubsub_proxy(port_config):
-    """ This is the pubsub proxy. We start it in another process as it blocks until we kill it"""
+def start_pubsub_proxy(endpoints, context=None):
+    """ This is the pubsub proxy. We start it in another process (or thread) as it blocks until we kill it
+
+    :param endpoints: EndpointConfig
+    :param context: zmq context to use when running as a thread, the proxy stops when it is terminated
+    """
 
     # create the zmq proxy. This must be started in it's own thread or process or it will block
-    context_proxy = zmq.Context()
+    context_proxy = zmq.Context() if context is None else context
 
     # socket that others publish to
     publish_to_socket = context_proxy.socket(zmq.XSUB)
-    publish_to_socket.bind("tcp://*:{}".format(port_config["pub_to_proxy_port"]))
+    publish_to_socket.bind(endpoints.bind("pub_to_proxy"))
 
     # socket that others subscribe to
     subscribe_to_socket = context_proxy.socket(zmq.XPUB)
-    subscribe_to_socket.bind("tcp://*:{}".format(port_config["sub_to_proxy_port"]))
+    subscribe_to_socket.bind(endpoints.bind("sub_to_proxy"))
 
     # now start the proxy
-    zmq.proxy(publish_to_socket, subscribe_to_socket)
-
-
-def start_all_processes(process_funcs, port_config):
-    """ Starts up processes"""
-    # empty list for storing processes
-    process_list = []
-
-    # start processes
-    for pf in process_funcs:
-        # start speech to text process
-        new_process = mp.Process(target=pf, kwargs={"port_config": port_config})
-        new_process.start()
-        process_list.append(new_process)
-
-    return process_list
-
-
-def stop_all_processes(process_list):
-    """Terminates all processes"""
-    for p in process_list:
-        print("terminating process", p)
-        p.terminate()
-
-
-def run_main(port_config=None):
-    """ This is responsible for starting up the system and shutting it down, either due to keyboard interrupt or the
-    system itself shutting down"""
+    try:
+        zmq.proxy(publish_to_socket, subscribe_to_socket)
+    except zmq.ContextTerminated:
+        # the threaded launcher is shutting down
+        publish_to_socket.close(linger=0)
+        subscribe_to_socket.close(linger=0)
+
+
+def run_main(port_config=None, session_id=None, transport="tcp", threaded=False, endpoints=None, collect_metrics=True,
+             recognizer_workers=0, synthesis_workers=0, drain_timeout_s=30.0, dialogue_config=None):
+    """ This is responsible for starting up the system, keeping it up and shutting it down, either due to keyboard
+    interrupt or the system itself shutting down. Processes that crash or hang are restarted, see supervisor.py
+
+    :param port_config: dict of tcp ports. Give each stack its own ports to run several on one machine (or use ipc)
+    :param session_id: if given, the control process uses the shared model in the dialogue server (start it first with
+        python3 dialogue_server.py) under this session id instead of loading its own
+    :param transport: "tcp", "ipc" or "inproc", see endpoints.py. inproc needs threaded=True
+    :param threaded: run the modules as threads of this process instead of as separate processes
+    :param endpoints: EndpointConfig to use instead of transport and port_config, e.g. to share a stack name with an
+        ipc dialogue server
+    :param collect_metrics: also run the metrics collector, which logs the latency of every stage of every turn and
+        serves the quantiles to Prometheus (see tracing.py)
+    :param recognizer_workers: if more than 0, speech recognition is done by a pool of this many Vosk workers (see
+        worker_pool.py) instead of in the speech to text process
+    :param synthesis_workers: if more than 0, synthesis is done by a pool of this many pico2wave workers
+    :param drain_timeout_s: after Ctrl-C, how long to wait for the turn in flight to finish. Ctrl-C again to not wait
+    :param dialogue_config: JSON file with the messages and agents of the control module, see agent_registry.py
+    """
 
     t_sleep = 0.1
+    t_start = time()
 
-    # set default ports
-    if port_config is None:
-        port_config = {"system_sync_port": 5553,  # report for system to check that modules are sync'ed properly
-                       "pub_to_proxy_port": 5554,  # port to publish to proxy so in the proxy it is xsub
-                       "sub_to_proxy_port": 5555,  # port to subscribe to the proxy so in the proxy it is xpub
-                       "stt_req_rep_port": 5556,  # REQ-REP control port for the stt pub sub
-                       "tts_req_rep_port": 5557,  # REQ-REP port for the text to speech
-                       }
+    if endpoints is None:
+        endpoints = EndpointConfig(transport, port_config)
+    if endpoints.transport == "inproc" and not threaded:
+        raise ValueError("inproc endpoints only work between threads, use threaded=True")
 
     # ------------------------------------------------------------------------------------------------------------------
-    # Start the pub sub proxy. Do this first to make sure it's there.
-    mp.set_start_method("spawn")  # set this to make sure code works cross platform
+    # make the context for the main process. Threaded modules share it
+    context = zmq.Context()
+    sockets_list = []
 
-    proxy_process = mp.Process(target=start_pubsub_proxy, kwargs={"port_config": port_config})
+    # ------------------------------------------------------------------------------------------------------------------
+    # Start the pub sub proxy. Do this first to make sure it's there.
+    if threaded:
+        proxy_process = Thread(target=start_pubsub_proxy, args=(endpoints, context), name="proxy", daemon=True)
+    else:
+        mp.set_start_method("spawn")  # set this to make sure code works cross platform
+        proxy_process = mp.Process(target=start_pubsub_proxy, kwargs={"endpoints": endpoints})
     proxy_process.start()
     sleep(t_sleep)
-    print("proxy created")
+    print("proxy created", endpoints)
 
     # ------------------------------------------------------------------------------------------------------------------
-    # make the context for the main process and connect to the pubsub proxy
-    context = zmq.Context()
-    sockets_list = []
-
+    # connect to the pubsub proxy
     socket_system_sync = context.socket(zmq.REP)
-    socket_system_sync.bind("tcp://*:{}".format(port_config["system_sync_port"]))
+    socket_system_sync.bind(endpoints.bind("system_sync"))
     sockets_list.append(socket_system_sync)
 
     # make publish to proxy socket
     socket_publisher = context.socket(zmq.PUB)
-    socket_publisher.connect("tcp://localhost:{}".format(port_config["pub_to_proxy_port"]))
+    socket_publisher.connect(endpoints.connect("pub_to_proxy"))
     sockets_list.append(socket_publisher)
 
     # make subscribe to proxy socket
     socket_subscriber = context.socket(zmq.SUB)
-    socket_subscriber.connect("tcp://localhost:{}".format(port_config["sub_to_proxy_port"]))
+    socket_subscriber.connect(endpoints.connect("sub_to_proxy"))
     socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"CONTROL")
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"POOL")  # workers the pool brokers have lost
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"HEARTBEAT")
     sockets_list.append(socket_subscriber)
 
-    # make poller because we are listening to both the subscriber and the stt_reply sockets
+    # make poller because we are listening to the subscriber, and to the sync socket for restarted modules
     poller = zmq.Poller()
     poller.register(socket_subscriber, zmq.POLLIN)
+    poller.register(socket_system_sync, zmq.POLLIN)
 
     sleep(t_sleep)
 
@@ -101,48 +117,115 @@ def run_main(port_config=None):
     process_funcs = [control_main,
                      text_to_speech_main,
                      speech_to_text_main]
+    if collect_metrics:
+        process_funcs.insert(0, metrics_collector_main)  # first, so it's subscribed before any spans go out
+
+    # control and speech to text have to agree on the voice commands, both get them from the dialogue config
+    process_kwargs = {control_main: {"session_id": session_id, "dialogue_config": dialogue_config},
+                      speech_to_text_main: {"dialogue_config": dialogue_config}}
+    # the worker pools, each with a broker that syncs like the modules do
+    if recognizer_workers > 0:
+        process_funcs.append(recognizer_broker_main)
+        process_kwargs[speech_to_text_main]["recognizer_pool"] = True
+    if synthesis_workers > 0:
+        process_funcs.append(synthesis_broker_main)
+        process_kwargs[text_to_speech_main] = {"synthesis_pool": True}
+
+    supervisor = Supervisor(endpoints, context, threaded)
+    for pf in process_funcs:
+        supervisor.start(pf, process_kwargs.get(pf))
 
-    process_list = start_all_processes(process_funcs, port_config)
+    # the workers load their models while everyone else starts up. They don't sync, they just tell their broker
+    for _ in range(recognizer_workers):
+        supervisor.start(recognizer_worker_main, heartbeats=False)
+    for _ in range(synthesis_workers):
+        supervisor.start(synthesis_worker_main, heartbeats=False)
 
-    # wait to be told that all processes have connected their sockets and are ready to go.
+    # wait to be told that all processes have connected their sockets and are ready to go. The ones that are, heartbeat
+    # in the meantime
     connected_modules = 0
     while connected_modules < len(process_funcs):
         # wait for sync request
-        msg = socket_system_sync.recv()
-        socket_system_sync.send(b"")
+        socks = dict(poller.poll(POLL_TIMEOUT_MS))
+        if socket_subscriber in socks:
+            topic, message = socket_subscriber.recv_multipart()
+            if topic == b"HEARTBEAT":
+                supervisor.on_heartbeat(ms.decode(message))
+        if socket_system_sync not in socks:
+            supervisor.check()  # in case something fell over loading its model
+            continue
+        msg = ms.decode(socket_system_sync.recv())
+        socket_system_sync.send(ms.encode(msg.reply(ms.ACK)))
         connected_modules += 1
-        print("The {} process has connected all sockets and has initialized all functionality.".format(msg.decode()))
+        supervisor.on_sync(msg)
+        print("The {} process has connected all sockets and has initialized all functionality.".format(msg.text))
+        if msg.data:
+            module_timer = StartupTimer.from_bytes(msg.data)
+            print(module_timer.report())
+            print("    {:<32s} {:7.2f}s".format("process spawn and imports", module_timer.t_start - t_start))
 
-    # append the proxy to the list of processes so we can shut the proxy process down later
-    process_list.append(proxy_process)
     sleep(0.1)
 
     # ------------------------------------------------------------------------------------------------------------------
     # Publish start message
-    socket_publisher.send_multipart([b"SYSTEM", b"START"])
+    socket_publisher.send_multipart([b"SYSTEM", ms.encode(ms.Message(ms.START))])
+    print("System ready {:.2f}s after start up.".format(time() - t_start))
 
-    # Now just hold until we
+    # Now just hold until we are told to shut down, restarting anything that fails on the way
+    drain_deadline = None
     try:
-        while True:
-            socks = dict(poller.poll(100))  # poll for .1 ms don't block
-            if socket_subscriber in socks and socks[socket_subscriber] == zmq.POLLIN:
-                topic, message = socket_subscriber.recv_multipart()
-                if topic == b"CONTROL" and message == b"SHUTDOWN":
-                    break
-            sleep(t_sleep)
+        while drain_deadline is None or time() < drain_deadline:
+            try:
+                socks = dict(poller.poll(POLL_TIMEOUT_MS))  # nothing to do until something fails or the shutdown
+
+                if socket_system_sync in socks:
+                    # a restarted module. Start it, and let the others know it lost whatever it was doing
+                    msg = ms.decode(socket_system_sync.recv())
+                    socket_system_sync.send(ms.encode(msg.reply(ms.ACK)))
+                    supervisor.on_sync(msg)
+                    print("The {} process has been restarted.".format(msg.text))
+                    socket_publisher.send_multipart([b"SYSTEM", ms.encode(ms.Message(ms.START))])
+                    socket_publisher.send_multipart([b"SUPERVISOR", ms.encode(ms.Message(ms.RESTARTED, msg.text))])
+
+                if socket_subscriber in socks and socks[socket_subscriber] == zmq.POLLIN:
+                    topic, message = socket_subscriber.recv_multipart()
+                    msg = ms.decode(message)
+                    if topic == b"HEARTBEAT":
+                        supervisor.on_heartbeat(msg)
+                    elif topic == b"CONTROL" and msg.msg_type == ms.SHUTDOWN:
+                        break
+                    elif topic == b"POOL" and msg.msg_type == ms.WORKER_LOST:
+                        supervisor.on_worker_lost(worker_pid(msg.text.encode()))
+
+                if drain_deadline is None:
+                    supervisor.check()
+
+            except KeyboardInterrupt:
+                if drain_deadline is not None:
+                    raise
+                print("Interrupt received, finishing the current turn ... (Ctrl-C again to stop now)")
+                socket_publisher.send_multipart([b"SYSTEM", ms.encode(ms.Message(ms.DRAIN))])
+                drain_deadline = time() + drain_timeout_s
+        else:
+            print("The current turn didn't finish in {:.0f}s, stopping anyway.".format(drain_timeout_s))
     except KeyboardInterrupt:
-        print("Interrupt received, stopping ...")
-        # TODO figure out if it can be shut down cleanly with keyboard interrupt or if I need to do something different
+        print("Interrupt received, stopping now ...")
     finally:
         print("Cleaning up ...")
-        stop_all_processes(process_list)
+        # ask everyone to stop and give them a moment to close up, the processes that don't get terminated
+        socket_publisher.send_multipart([b"SYSTEM", ms.encode(ms.Message(ms.SHUTDOWN))])
+        supervisor.stop()
+        if not threaded:
+            proxy_process.terminate()  # a proxy thread stops when the context is terminated
         print("All processes stopped.")
 
         # Close sockets and context
         for sock in sockets_list:
             sock.setsockopt(zmq.LINGER, 0)
             sock.close()
-        context.term()
+        if not threaded or not any(entry.worker.is_alive() for entry in supervisor.supervised):
+            context.term()  # would block on the sockets of threads that are still running
+        endpoints.cleanup()
         print("Main process shutdown.")
 
 
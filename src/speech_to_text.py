@@ -1,28 +1,162 @@
-from time import sleep
+from time import time
+import json
+import queue
+from threading import Thread, Event, Condition
+import numpy as np
 import pyaudio
 from vosk import Model, KaldiRecognizer
 import zmq
+from voice_activity import VADGate, EnergyVAD, WebRTCVAD
+import message_schema as ms
+from startup import StartupTimer, load_in_background
+from endpoints import make_endpoints
+from audio_bus import SharedAudioRing, span_message
+from tracing import Tracer, Timings
+from event_loop import Waker, POLL_TIMEOUT_MS
+from worker_pool import PoolClient, run_worker
+from supervisor import Heartbeat
+from commands import CommandIndex
+from agent_registry import load_dialogue_config
 
 # DIRECTORY WHERE THE VOSK SPEECH TO TEXT MODEL IS LOCATED
 #pwd_vosk_model = "../models/vosk-model-en-us-aspire-0.2"
 pwd_vosk_model = "../models/vosk-model-en-us-0.22"
 
+
+class EndpointPolicy:
+    """Decides when to finalize an utterance instead of waiting for Vosk's own (rather conservative) endpointing.
+
+    An utterance is finalized once there is a partial hypothesis and either the VAD has heard trailing_silence_s of
+    silence after it, the recognizer's word timings say nothing has been said for word_gap_s since the last word, or
+    the partial hypothesis hasn't changed for stable_partial_s. Times are in seconds of audio, not wall clock, so the
+    behaviour is the same however far behind real time recognition is running."""
+
+    def __init__(self, trailing_silence_s=0.4, stable_partial_s=0.8, min_words=1, word_gap_s=0.6):
+        """
+        :param trailing_silence_s: silence after speech that ends the utterance, None to disable
+        :param stable_partial_s: how long the partial hypothesis has to stay the same to end the utterance, None to
+            disable
+        :param min_words: don't finalize partial hypotheses shorter than this
+        :param word_gap_s: audio after the end of the last recognized word that ends the utterance, None to disable.
+            Catches pauses the VAD takes for speech, e.g. with background noise. Wants to be longer than
+            trailing_silence_s, the recognizer puts words in its partials a little late
+        """
+        self.trailing_silence_s = trailing_silence_s
+        self.stable_partial_s = stable_partial_s
+        self.min_words = min_words
+        self.word_gap_s = word_gap_s
+        self.reset()
+
+    def reset(self):
+        self.partial_text = ""
+        self.partial_since = 0.0
+
+    def on_partial(self, text: str, audio_time: float):
+        if text != self.partial_text:
+            self.partial_text = text
+            self.partial_since = audio_time
+
+    def should_finalize(self, audio_time: float, trailing_silence=None, word_gap=None):
+        """
+        :param audio_time: seconds of audio processed so far
+        :param trailing_silence: seconds of silence since speech, if known
+        :param word_gap: seconds of audio since the end of the last recognized word, if known
+        """
+        if len(self.partial_text.split()) < self.min_words:
+            return False
+        if self.trailing_silence_s is not None and trailing_silence is not None \
+                and trailing_silence >= self.trailing_silence_s:
+            return True
+        if self.word_gap_s is not None and word_gap is not None and word_gap >= self.word_gap_s:
+            return True
+        if self.stable_partial_s is not None and audio_time - self.partial_since >= self.stable_partial_s:
+            return True
+        return False
+
+
+class CommandSpotter:
+    """Spots voice commands (see commands.py) in the partial hypothesis, without waiting for the end of the utterance.
+
+    A command is spotted once the whole partial is one of the command phrases and the user has paused for min_pause_s
+    after it. Without the pause "stop by the store" would be a stop after its first word. That is well before the
+    utterance is finalized, which waits for a longer silence (see EndpointPolicy) and then for the final decode.
+    Only exact matches count, near misses are left to the control module's check of the final transcript."""
+
+    def __init__(self, index: CommandIndex, min_pause_s=0.3):
+        """
+        :param index: CommandIndex of the commands to spot
+        :param min_pause_s: seconds of silence after the command before it counts
+        """
+        self.index = index
+        self.min_pause_s = min_pause_s
+
+    def accept(self, partial_text: str, pause_s=None):
+        """
+        :param partial_text: the recognizer's partial hypothesis
+        :param pause_s: seconds since the last word, None if not known (then nothing is spotted)
+        :return: the name of the command, once one has been said and followed by a pause, otherwise None
+        """
+        if not partial_text or pause_s is None or pause_s < self.min_pause_s:
+            return None
+        return self.index.match(partial_text, fuzzy=False)
+
+
 class VoiceCapture:
 
-    def __init__(self, pwd_model=pwd_vosk_model):
+    def __init__(self, pwd_model=pwd_vosk_model, vad=None, event_callback=None, endpoint_policy=None, rate=16000,
+                 recognizer=None, commands=None):
         """Class that will set up a Vosk speech to text instance, start and stop pyaudio streams and listen for speech
 
         :param pwd_model: full path to vosk model
+        :param vad: optional VADGate. If given, only voiced audio (plus padding) reaches the recognizer
+        :param event_callback: optional function(topic: bytes, msg: Message) called with events such as speech
+            start and end or partial hypotheses, e.g. to publish them to the proxy
+        :param endpoint_policy: optional EndpointPolicy for finalizing utterances early
+        :param rate: sample rate
+        :param recognizer: optional stand in for the Vosk recognizer, e.g. a PooledRecognizer. The Vosk model isn't
+            loaded in this process then
+        :param commands: optional CommandIndex of voice commands to spot as they are said, see CommandSpotter. Needs
+            partial hypotheses, so not with a recognizer given
         """
         # initialize the model and the recognizer
-        self.model = Model(pwd_model)
-        self.recognizer = KaldiRecognizer(self.model, 16000)
+        self.rate = rate
+        if recognizer is None:
+            self.model = Model(pwd_model)
+            self.recognizer = KaldiRecognizer(self.model, rate)
+            # per word confidences and times in the results, and times in the partials for the endpointing
+            self.recognizer.SetWords(True)
+            if hasattr(self.recognizer, "SetPartialWords"):  # newer Vosk only
+                self.recognizer.SetPartialWords(True)
+        else:
+            self.model = None
+            self.recognizer = recognizer
+        self.command_spotter = None
+        if commands is not None and self.model is not None:
+            self.command_spotter = CommandSpotter(commands)
+        self.vad = vad
+        self.event_callback = event_callback
+        self.endpoint_policy = endpoint_policy
+        self.audio_time = 0.0
+        self.recognizer_time = 0.0  # seconds of audio given to the recognizer, the clock its word times run on
+        self.utterance_offset = 0.0  # recognizer time the current utterance started at
+        self.last_word_end = None  # recognizer time the last word in the partial hypothesis ended
+        self.partial_text = ""
+        self.last_timings = Timings()  # end_of_speech and final_transcript of the last utterance, see tracing.py
 
         # define audio stream but don't start it yet
-        self.p = pyaudio.PyAudio()
-        self.stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=16000, input=True, frames_per_buffer=8000)
+        self.p = self.open_audio_interface()
+        self.stream = self.open_audio_stream()
         self.is_listening = False
-        self.stream.stop_stream()
+
+    def open_audio_interface(self):
+        """the pyaudio instance the streams are opened from. Overridden to replay audio from files, see benchmark.py"""
+        return pyaudio.PyAudio()
+
+    def open_audio_stream(self):
+        """open the pyaudio stream in blocking mode, stopped until we want to listen"""
+        stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=self.rate, input=True, frames_per_buffer=8000)
+        stream.stop_stream()
+        return stream
 
     def start_audio_stream(self):
         """restart the pyaudio stream """
@@ -39,108 +173,638 @@ class VoiceCapture:
         self.stream.close()
         self.p.terminate()
 
-    def listen_once(self):
-        """listen for text and return it"""
-        # TODO We may want to implement a time out and return a None in that case.
-        done_listening = False
+    def emit(self, topic: bytes, msg):
+        """pass an event on to whoever is interested"""
+        if self.event_callback is not None:
+            self.event_callback(topic, msg)
+
+    def _non_empty(self, result_text):
+        """the Vosk result as a TRANSCRIPT message if it has some text in it, otherwise None. Word times are made
+        relative to the start of the utterance"""
+        transcript = ms.transcript_from_vosk(result_text, time_offset=self.utterance_offset)
+        self.utterance_offset = self.recognizer_time
+        self.last_word_end = None
+        return transcript if transcript.text != "" else None
+
+    def _command(self, command, start):
+        """ end the utterance on a spotted command, returns the COMMAND message"""
+        transcript = self._non_empty(self.recognizer.FinalResult())
+        msg = ms.Message(ms.COMMAND, command, words=transcript.words if transcript is not None else ())
+        self._record_endpoint(start, 0.0, "command", msg)
+        return msg
+
+    def word_gap(self):
+        """seconds of audio since the end of the last word the recognizer has heard, None if it hasn't heard one"""
+        if self.last_word_end is None:
+            return None
+        return self.recognizer_time - self.last_word_end
+
+    def accept_audio(self, audio_data):
+        """feed a chunk of audio to the recognizer, through the VAD gate if there is one
+
+        :param audio_data: int16 audio as bytes or bytearray
+        :return: a TRANSCRIPT message once an utterance with some text in it has finished, or a COMMAND message as
+            soon as a command has been spotted, otherwise None
+        """
+        self.audio_time += len(audio_data) / (2.0 * self.rate)
+        if self.vad is None:
+            voiced, events = audio_data, []
+        else:
+            voiced, events = self.vad.process(np.frombuffer(audio_data, dtype=np.int16))
+
+        if "SPEECH_START" in events:
+            self.emit(b"VAD", ms.Message(ms.VAD_EVENT, "SPEECH_START"))
+
+        result_text = None
+        if voiced:
+            start = time()
+            self.recognizer_time += len(voiced) / (2.0 * self.rate)
+            if self.recognizer.AcceptWaveform(voiced):
+                result_text = self._non_empty(self.recognizer.Result())
+                self._record_endpoint(start, 0.0, "recognizer", result_text)
+            else:
+                self._update_partial()
+            if result_text is None and self.command_spotter is not None:
+                pause_s = self.word_gap()
+                if pause_s is None and self.vad is not None:
+                    pause_s = self.vad.trailing_silence_s()
+                command = self.command_spotter.accept(self.partial_text, pause_s)
+                if command is not None:
+                    result_text = self._command(command, start)
+
+        if "SPEECH_END" in events:
+            self.emit(b"VAD", ms.Message(ms.VAD_EVENT, "SPEECH_END"))
+            # the recognizer never sees the trailing silence it would use to end the utterance, so end it ourselves
+            if result_text is None:
+                start = time()
+                result_text = self._non_empty(self.recognizer.FinalResult())
+                hangover_s = self.vad.hangover_frames * self.vad.frame_length / float(self.vad.detector.rate)
+                self._record_endpoint(start, hangover_s, "vad", result_text)
+
+        if result_text is None and self.endpoint_policy is not None:
+            trailing_silence = self.vad.trailing_silence_s() if self.vad is not None else None
+            if self.endpoint_policy.should_finalize(self.audio_time, trailing_silence, self.word_gap()):
+                start = time()
+                result_text = self._non_empty(self.recognizer.FinalResult())
+                self._record_endpoint(start, trailing_silence or 0.0, "endpoint_policy", result_text)
+
+        if result_text is not None:
+            self.partial_text = ""
+            if self.endpoint_policy is not None:
+                self.endpoint_policy.reset()
+        return result_text
+
+    def _record_endpoint(self, decided, silence_waited, reason, transcript):
+        """ timings of the end of an utterance: end_of_speech runs from when the user stopped talking (as best we can
+        tell) to when we decided they had, final_transcript from then until the transcript was ready"""
+        if transcript is None:
+            return
+        timings = Timings()
+        timings["end_of_speech"] = (decided - silence_waited, silence_waited, {"endpoint": reason})
+        timings["final_transcript"] = (decided, time() - decided, {"words": len(transcript.words),
+                                                                   "confidence": transcript.confidence})
+        self.last_timings = timings
+
+    def _update_partial(self):
+        """publish the partial hypothesis whenever it changes"""
+        partial = json.loads(self.recognizer.PartialResult())
+        if partial.get("partial_result"):
+            self.last_word_end = partial["partial_result"][-1]["end"]
+        partial_text = partial["partial"]
+        if partial_text == self.partial_text:
+            return
+        self.partial_text = partial_text
+        if self.endpoint_policy is not None:
+            self.endpoint_policy.on_partial(partial_text, self.audio_time)
+        if partial_text != "":
+            self.emit(b"STT_PARTIAL", ms.Message(ms.PARTIAL, partial_text))
+
+    def listen_once(self, should_stop=None):
+        """listen for text and return it as a TRANSCRIPT message (None if the audio stream ran dry)
+
+        :param should_stop: optional function() called with every chunk of audio, returning True gives up on the
+            utterance and returns None, e.g. when the system is shutting down while nobody is talking
+        """
+        result_text = None
+        if self.vad is not None:
+            self.vad.reset()
         self.start_audio_stream()
-        while not done_listening:
+        while result_text is None:
+            if should_stop is not None and should_stop():
+                self.recognizer.FinalResult()  # start the next utterance afresh
+                self.partial_text = ""
+                break
             audio_data = self.stream.read(4000)
             if len(audio_data) == 0:
-                result = None
                 break
-            if self.recognizer.AcceptWaveform(audio_data):
-                result_text = self.recognizer.Result()
-                if eval(result_text)["text"] != "":
-                    done_listening = True
+            result_text = self.accept_audio(audio_data)
         self.stop_audio_stream()
         return result_text
 
 
-def speech_to_text_main(port_config=None):
-    if port_config is None:
-        port_config = {"system_sync_port": 5553,  # report for system to check that modules are sync'ed properly
-                       "pub_to_proxy_port": 5554,  # port to publish to proxy so in the proxy it is xsub
-                       "sub_to_proxy_port": 5555,  # port to subscribe to the proxy so in the proxy it is xpub
-                       "stt_req_rep_port": 5556,  # REQ-REP control port for the stt pub sub
-                       "tts_req_rep_port": 5557,  # REQ-REP port for the text to speech
-                       }
+class AudioRingBuffer:
+    """Preallocated ring buffer of int16 samples with a single writer and a single reader.
+
+    Positions are absolute sample counts since the buffer was created, so a reader can tell how far behind the writer
+    it is. Once the writer has lapped a reader the oldest audio is gone and the reader is moved up to the oldest sample
+    still held."""
+
+    def __init__(self, capacity_samples: int):
+        self.capacity = capacity_samples
+        self.buffer = np.zeros(capacity_samples, dtype=np.int16)
+        self.write_index = 0
+        self.condition = Condition()
+
+    def write(self, samples):
+        """copy samples into the buffer and wake up the reader"""
+        n = len(samples)
+        if n > self.capacity:
+            samples = samples[-self.capacity:]
+            n = self.capacity
+        start = self.write_index % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+        with self.condition:
+            self.write_index += n
+            self.condition.notify_all()
+
+    def oldest_index(self):
+        return max(0, self.write_index - self.capacity)
+
+    def wait_for(self, index: int, timeout=None):
+        """block until the writer has got to index. Returns False on time out"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.write_index >= index, timeout)
+
+    def read_into(self, out, read_index: int):
+        """copy len(out) samples starting at read_index into the preallocated array out.
+
+        :return: the read index after the copy, which may have jumped forward if the reader had been lapped
+        """
+        read_index = max(read_index, self.oldest_index())
+        n = len(out)
+        start = read_index % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:] = self.buffer[:n - first]
+        return read_index + n
+
+
+class RingBufferVoiceCapture(VoiceCapture):
+    """Voice capture where pyaudio runs continuously in callback mode and writes into a preallocated ring buffer.
+
+    The stream is never stopped between turns, so nothing is lost while the rest of the system is busy, and when
+    LISTEN_ONCE arrives recognition starts pre-roll seconds in the past to catch the first syllables. Recognition
+    happens in a consumer thread that copies fixed size chunks out of the ring buffer into one reused buffer.
+
+    Because the microphone never stops, it can also listen for the user talking over the system (barge-in). While
+    monitoring is on (the text to speech process is playing a reply) the consumer thread runs small chunks through a
+    separate VAD gate and emits an INTERRUPT as soon as it hears speech. The next listen_once then starts from where
+    the interruption was heard. There's no echo cancellation, so the barge-in VAD wants a high margin, or a headset.
+
+    The ring can be a SharedAudioRing (audio_bus.py), in which case other processes can read the microphone audio in
+    place. The span of each utterance is then emitted as an AUDIO message on AUDIO_CAPTURE.
+
+    Events from the recognition thread are queued for the thread that owns the sockets. Set on_event to a function()
+    (e.g. a Waker's wake) to hear about them straight away instead of having to poll dispatch_events."""
+
+    def __init__(self, pwd_model=pwd_vosk_model, vad=None, event_callback=None, endpoint_policy=None, preroll_s=0.5,
+                 ring_s=10.0, chunk_samples=4000, rate=16000, barge_in_vad=None, barge_in_chunk_samples=800, ring=None,
+                 recognizer=None, commands=None):
+        """
+        :param pwd_model: full path to vosk model
+        :param vad: optional VADGate
+        :param event_callback: optional function(topic, message), always called from the thread calling listen_once
+        :param endpoint_policy: optional EndpointPolicy
+        :param preroll_s: seconds of audio from before the listen request to include
+        :param ring_s: seconds of audio held in the ring buffer, this bounds memory
+        :param chunk_samples: samples per AcceptWaveform call
+        :param rate: sample rate
+        :param barge_in_vad: optional VADGate used to detect the user talking while the system is speaking
+        :param barge_in_chunk_samples: samples per barge-in VAD step, small so an interruption is noticed quickly
+        :param ring: optional ring buffer to use, e.g. a SharedAudioRing. An AudioRingBuffer of ring_s seconds if None
+        :param recognizer: optional stand in for the Vosk recognizer, e.g. a PooledRecognizer
+        :param commands: optional CommandIndex of voice commands to spot
+        """
+        self.preroll_samples = int(preroll_s * rate)
+        self.chunk_samples = chunk_samples
+        self.ring = AudioRingBuffer(int(ring_s * rate)) if ring is None else ring
 
-    t_sleep = 0.1
+        # the one and only chunk buffer handed to the recognizer, with an int16 view for copying into
+        self.chunk_bytes = bytearray(chunk_samples * 2)
+        self.chunk = np.frombuffer(self.chunk_bytes, dtype=np.int16)
+
+        self.read_index = 0
+        self.barge_in_vad = barge_in_vad
+        self.barge_in_chunk = np.zeros(barge_in_chunk_samples, dtype=np.int16)
+        self.monitor_index = 0
+        self.monitoring = False
+        self.barge_in_index = None  # where in the ring buffer the last interruption was heard
+        self.listen_request = Event()
+        # events from the recognition thread, handed over to the listening thread. A finished transcript comes through
+        # here as well, with topic None, so listen_once can block on the one queue
+        self.events = queue.Queue()
+        self.on_event = None
+        self.running = True
+
+        super().__init__(pwd_model, vad, event_callback, endpoint_policy, rate, recognizer, commands)
+
+        self.consumer_thread = Thread(target=self._recognize_loop, daemon=True)
+        self.consumer_thread.start()
+
+    def open_audio_stream(self):
+        """open the pyaudio stream in callback mode and start it straight away"""
+        stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=self.rate, input=True,
+                             frames_per_buffer=self.chunk_samples, stream_callback=self._audio_callback)
+        stream.start_stream()
+        return stream
+
+    def _audio_callback(self, in_data, frame_count, time_info, status):
+        # np.frombuffer is a view, so the only copy is the one into the ring buffer
+        self.ring.write(np.frombuffer(in_data, dtype=np.int16))
+        return None, pyaudio.paContinue
+
+    def start_audio_stream(self):
+        """the stream runs all the time, we just note that we're listening"""
+        self.is_listening = True
+
+    def stop_audio_stream(self):
+        self.is_listening = False
+
+    def start_monitoring(self):
+        """listen for barge-in from now on, i.e. while the system is speaking"""
+        if self.barge_in_vad is None or self.monitoring:
+            return
+        self.barge_in_vad.reset()
+        self.monitor_index = self.ring.write_index
+        self.monitoring = True
+
+    def stop_monitoring(self):
+        self.monitoring = False
+
+    def _monitor_step(self):
+        """run the next small chunk through the barge-in VAD, emit INTERRUPT if it heard speech"""
+        if not self.ring.wait_for(self.monitor_index + len(self.barge_in_chunk), timeout=0.05):
+            return
+        self.monitor_index = self.ring.read_into(self.barge_in_chunk, self.monitor_index)
+        voiced, events = self.barge_in_vad.process(self.barge_in_chunk)
+        if "SPEECH_START" in events and self.monitoring:
+            self.monitoring = False
+            # the gate holds back a few frames before it's sure, start the next utterance from before those
+            self.barge_in_index = self.monitor_index - len(voiced) // 2
+            self.emit(b"STT_INTERRUPT", ms.Message(ms.INTERRUPT))
+
+    def _recognize_loop(self):
+        while self.running:
+            if self.monitoring and not self.listen_request.is_set():
+                self._monitor_step()
+                continue
+            if not self.listen_request.wait(timeout=0.05 if self.barge_in_vad is not None else 0.5):
+                continue
+            if not self.ring.wait_for(self.read_index + self.chunk_samples, timeout=0.5):
+                continue
+            self.read_index = self.ring.read_into(self.chunk, self.read_index)
+            result_text = self.accept_audio(self.chunk_bytes)
+            if result_text is not None:
+                self.listen_request.clear()
+                self.events.put((None, result_text))
+
+    def emit(self, topic: bytes, msg):
+        """zmq sockets aren't thread safe, so queue events up for the listening thread to dispatch"""
+        self.events.put((topic, msg))
+        if self.on_event is not None:
+            self.on_event()
+
+    def dispatch_events(self):
+        while not self.events.empty():
+            super().emit(*self.events.get())
+
+    def listen_once(self, should_stop=None):
+        """listen for text and return it as a TRANSCRIPT message, starting from pre-roll seconds before the call
+
+        :param should_stop: optional function() called every 0.1s or so while the recognition thread is alive,
+            returning True gives up on the utterance and returns None
+        """
+        if self.vad is not None:
+            self.vad.reset()
+        self.stop_monitoring()
+        self.start_audio_stream()
+        if self.barge_in_index is None:
+            start_index = self.ring.write_index - self.preroll_samples
+        else:
+            # no pre-roll after a barge-in, before the interruption it's mostly our own voice
+            start_index, self.barge_in_index = self.barge_in_index, None
+        self.read_index = max(start_index, self.ring.oldest_index())
+        utterance_start = self.read_index
+        self.listen_request.set()
+        result_text = None
+        while True:
+            try:
+                topic, msg = self.events.get(timeout=0.1)  # partials and VAD events as they come, then the transcript
+            except queue.Empty:
+                topic = msg = b""
+            if topic is None:
+                result_text = msg
+                break
+            if topic:
+                super().emit(topic, msg)
+            # a dead recognition thread never answers, so then stop asking should_stop (which heartbeats)
+            if should_stop is not None and self.consumer_thread.is_alive() and should_stop():
+                self.listen_request.clear()
+                break
+        self.stop_audio_stream()
+        if isinstance(self.ring, SharedAudioRing):
+            # where to find the audio of this utterance, for anyone else who wants it
+            super().emit(b"AUDIO_CAPTURE", span_message(self.ring, utterance_start, self.read_index - utterance_start))
+        return result_text
+
+    def shut_down_pyaudio(self):
+        """stop the recognition thread and shut down the pyaudio stream"""
+        self.running = False
+        self.listen_request.set()
+        self.consumer_thread.join()
+        super().shut_down_pyaudio()
+
+
+def shift_word_times(result_json: str, offset_s: float):
+    """ a Vosk result json string with offset_s added to all the word times"""
+    result = json.loads(result_json)
+    if not result.get("result"):
+        return result_json
+    for word in result["result"]:
+        word["start"] += offset_s
+        word["end"] += offset_s
+    return json.dumps(result)
+
+
+class PooledRecognizer:
+    """ Stands in for a KaldiRecognizer when recognition is done by the pool of recognizer workers (see worker_pool.py).
+
+    Audio is only collected here until the utterance ends, then the whole utterance goes to whichever worker is free,
+    so this process never loads the Vosk model. The price is that there are no partial results, and the recognizer
+    never ends an utterance by itself, so it needs a VAD (or an EndpointPolicy that goes on trailing silence).
+
+    Workers send word times from the start of the utterance, they're moved onto this recognizer's own clock to match
+    what a KaldiRecognizer gives."""
+
+    def __init__(self, client: PoolClient, rate=16000):
+        self.client = client
+        self.rate = rate
+        self.audio = bytearray()
+        self.stream_time = 0.0  # seconds of audio recognized before this utterance
+
+    def AcceptWaveform(self, data):
+        self.audio += data
+        return False
+
+    def PartialResult(self):
+        return json.dumps({"partial": ""})
+
+    def Result(self):
+        return self.FinalResult()
+
+    def FinalResult(self):
+        audio, self.audio = bytes(self.audio), bytearray()
+        if not audio:
+            return json.dumps({"text": ""})
+        utterance_start = self.stream_time
+        self.stream_time += len(audio) / (2.0 * self.rate)
+        try:
+            reply = self.client.request(ms.Message(ms.RECOGNIZE, str(self.rate), data=audio))
+        except RuntimeError as e:
+            # no workers (or no broker), lose the utterance rather than the recognizing thread
+            print("recognizer pool:", e)
+            return json.dumps({"text": ""})
+        if reply.text == "failed":
+            print("recognizer pool failed on an utterance of {:.1f}s".format(len(audio) / (2.0 * self.rate)))
+            return json.dumps({"text": ""})
+        return shift_word_times(reply.text, utterance_start)
+
+
+def recognizer_worker_main(port_config=None, endpoints=None, context=None, pwd_model=pwd_vosk_model):
+    """ A worker for the recognizer pool: Vosk recognition of whole utterances for whoever asks. Start as many as there
+    are cores to spare, the Vosk model is loaded (memory mapped) in each.
+
+    :param port_config: dict of tcp ports, used when no endpoints are given
+    :param endpoints: EndpointConfig with the socket addresses, see endpoints.py
+    :param context: zmq context to use, e.g. the launcher's when running as a thread. One is made if None
+    :param pwd_model: full path to vosk model
+    """
+    model = Model(pwd_model)
+    recognizers = {}  # sample rate -> [recognizer, seconds of audio it has recognized], reused between utterances
+
+    def handle(request):
+        rate = int(request.text)
+        if rate not in recognizers:
+            recognizers[rate] = [KaldiRecognizer(model, rate), 0.0]
+            recognizers[rate][0].SetWords(True)
+        recognizer, stream_time = recognizers[rate]
+        recognizer.AcceptWaveform(request.data)
+        recognizers[rate][1] += len(request.data) / (2.0 * rate)
+        # word times from the start of this utterance, the client has its own clock
+        return request.reply(ms.ACK, shift_word_times(recognizer.FinalResult(), -stream_time))
+
+    run_worker("stt", make_endpoints(port_config, endpoints), handle, context)
+
+
+def speech_to_text_main(port_config=None, endpoints=None, context=None, recognizer_pool=False,
+                        dialogue_config=None):
+    """ Listens for one utterance per LISTEN_ONCE request and replies with the transcript.
+
+    :param port_config: dict of tcp ports, used when no endpoints are given
+    :param endpoints: EndpointConfig with the socket addresses, see endpoints.py
+    :param context: zmq context to use, e.g. the launcher's when running as a thread. One is made if None
+    :param recognizer_pool: send each utterance to the pool of recognizer workers (see worker_pool.py) instead of
+        running Vosk in this process. Only the final transcript comes back, so no partials and no speculation
+    :param dialogue_config: JSON file the voice commands to spot come from (see agent_registry.py), the same one the
+        control module is given. The default commands if None
+    """
+    timer = StartupTimer("SPEECH TO TEXT MODULE")
+    endpoints = make_endpoints(port_config, endpoints)
+    tracer = Tracer("speech_to_text")
+
+    # "ring_buffer" keeps the microphone running continuously in callback mode, "blocking" is the original behaviour
+    capture_mode = "ring_buffer"
+    # voice activity detection in front of the recognizer: "energy", "webrtc" or None to send it all audio
+    vad_mode = "energy"
+    # finalize utterances after this much trailing silence, or once the partial transcript stops changing
+    endpoint_policy = EndpointPolicy(trailing_silence_s=0.4, stable_partial_s=0.8)
+    # full duplex: keep listening while the system speaks and interrupt it when the user talks over it (barge-in).
+    # Needs the ring buffer capture mode
+    barge_in = True
+    # put the microphone ring buffer in shared memory so other processes can read the audio (see audio_bus.py)
+    share_audio = True
+    ring_s = 10.0
+    # spot voice commands ("stop", "louder", see commands.py) in the partial transcript as they are said, rather than
+    # wait for the end of the utterance. Not with the recognizer pool
+    spot_commands = True
+    command_phrases = load_dialogue_config(dialogue_config)["commands"]  # None for the ones in commands.py
 
     # ------------------------------------------------------------------------------------------------------------------
-    # Create zmq context and sockets
+    # the zmq context comes first, the recognizer pool client needs it
+    own_context = context is None
+    if own_context:
+        context = zmq.Context()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # initialize voice capture class. Loading the Vosk model takes a while, so it's done in the background while we
+    # connect the sockets
+    if vad_mode == "energy":
+        vad = VADGate(EnergyVAD())
+    elif vad_mode == "webrtc":
+        vad = VADGate(WebRTCVAD(), hangover_frames=50, prepad_frames=25)
+    else:
+        vad = None
+
+    def publish_event(topic, msg):
+        socket_publisher.send_multipart([topic, ms.encode(msg)])
+
+    def make_voice_capture():
+        with timer.stage("load vosk model and open audio"):
+            recognizer = None
+            commands = CommandIndex(command_phrases) if spot_commands else None
+            if recognizer_pool:
+                recognizer = PooledRecognizer(PoolClient(context, endpoints.connect("stt_pool")))
+            if capture_mode == "ring_buffer":
+                # a bigger margin than the main VAD, so the system's own voice from the speakers doesn't set it off
+                barge_in_vad = VADGate(EnergyVAD(margin_db=18.0), min_speech_frames=4) if barge_in else None
+                ring = None
+                if share_audio:
+                    ring = SharedAudioRing(endpoints.stack_name + "-capture", int(ring_s * 16000), 16000, create=True)
+                return RingBufferVoiceCapture(vad=vad, event_callback=publish_event, endpoint_policy=endpoint_policy,
+                                              barge_in_vad=barge_in_vad, ring_s=ring_s, ring=ring,
+                                              recognizer=recognizer, commands=commands)
+            return VoiceCapture(vad=vad, event_callback=publish_event, endpoint_policy=endpoint_policy,
+                                recognizer=recognizer, commands=commands)
 
-    context = zmq.Context()
+    vcap_future = load_in_background(make_voice_capture)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Create zmq sockets
     sockets_list = []
 
     # system sync socket - this is for informing system of status
     socket_system_sync = context.socket(zmq.REQ)
-    socket_system_sync.connect("tcp://localhost:{}".format(port_config["system_sync_port"]))
+    socket_system_sync.connect(endpoints.connect("system_sync"))
     sockets_list.append(socket_system_sync)
 
     # publishing socket
     socket_publisher = context.socket(zmq.PUB)
-    socket_publisher.connect("tcp://localhost:{}".format(port_config["pub_to_proxy_port"]))
+    socket_publisher.connect(endpoints.connect("pub_to_proxy"))
     sockets_list.append(socket_publisher)
 
     # subscribing socket
     socket_subscriber = context.socket(zmq.SUB)
-    socket_subscriber.connect("tcp://localhost:{}".format(port_config["sub_to_proxy_port"]))
+    socket_subscriber.connect(endpoints.connect("sub_to_proxy"))
     socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"SYSTEM")
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"TTS_PLAYBACK")  # to know when to listen for barge-in
     sockets_list.append(socket_subscriber)
 
+    # the shutdowns only, checked while listening. The control module shuts down without waiting for the utterance it
+    # asked for when it's drained while nobody is talking
+    socket_shutdown_subscriber = context.socket(zmq.SUB)
+    socket_shutdown_subscriber.connect(endpoints.connect("sub_to_proxy"))
+    socket_shutdown_subscriber.setsockopt(zmq.SUBSCRIBE, b"SYSTEM")
+    socket_shutdown_subscriber.setsockopt(zmq.SUBSCRIBE, b"CONTROL")
+    sockets_list.append(socket_shutdown_subscriber)
+
     # speech to text control socket - this is for receiving a request for text and replying
     socket_stt_reply = context.socket(zmq.REP)
-    socket_stt_reply.bind("tcp://*:{}".format(port_config["stt_req_rep_port"]))
+    socket_stt_reply.bind(endpoints.bind("stt_req_rep"))
+    sockets_list.append(socket_stt_reply)
+
+    # the recognition thread wakes up the main loop when it has an event (an interruption) to publish
+    waker = Waker(context, "speech_to_text")
 
     # make poller because we are listening to both the subscriber and the stt_reply sockets
     poller = zmq.Poller()
     poller.register(socket_subscriber, zmq.POLLIN)
     poller.register(socket_stt_reply, zmq.POLLIN)
+    poller.register(waker.socket, zmq.POLLIN)
+    timer.mark("connect sockets")
 
     # ------------------------------------------------------------------------------------------------------------------
-    # initialize voice capture class
-    vcap = VoiceCapture()
+    # wait for the voice capture class, it was loading the Vosk model while we connected sockets
+    vcap = vcap_future.result()
+    vcap.on_event = waker.wake
+    timer.mark("wait for vosk model")
 
     # ------------------------------------------------------------------------------------------------------------------
     # inform the system that we have connected all sockets and are ready to listen for speech
-    socket_system_sync.send(b"TEXT TO SPEECH MODULE")
+    socket_system_sync.send(ms.encode(ms.Message(ms.SYNC, "SPEECH TO TEXT MODULE", data=timer.to_bytes())))
     msg = socket_system_sync.recv()  # this one can be blocking
+    heartbeat = Heartbeat(context, endpoints, "SPEECH TO TEXT MODULE").start()
+
+    def should_stop_listening():
+        """ while listening: heartbeat, and give up if the system is shutting down"""
+        heartbeat.beat()
+        while socket_shutdown_subscriber.poll(0):
+            topic, message = socket_shutdown_subscriber.recv_multipart()
+            if ms.decode(message).msg_type == ms.SHUTDOWN:
+                return True
+        return False
 
     # ------------------------------------------------------------------------------------------------------------------
     # Main Loop
+    monitoring = getattr(vcap, "barge_in_vad", None) is not None
     while True:
 
         try:
-            socks = dict(poller.poll(100))  # poll for .1 ms don't block
+            # blocks until there's a request, a broadcast or an event from the recognition thread
+            socks = dict(poller.poll(POLL_TIMEOUT_MS))
+            heartbeat.beat()
+
+            if waker.socket in socks:
+                waker.clear()
+                vcap.dispatch_events()
 
             # if a message from the system
             if socket_subscriber in socks and socks[socket_subscriber] == zmq.POLLIN:
                 topic, message = socket_subscriber.recv_multipart()
-                print(topic.decode(), message.decode())
-                if message == b"SHUTDOWN":
+                msg = ms.decode(message)
+                if msg.msg_type == ms.PLAYBACK:
+                    if monitoring and msg.text == "PLAYBACK_START":
+                        vcap.start_monitoring()
+                    elif monitoring and msg.text == "PLAYBACK_END":
+                        vcap.stop_monitoring()
+                    continue
+                print(topic.decode(), msg)
+                if msg.msg_type == ms.SHUTDOWN:
                     break
 
             # if a request to listen for speech
             elif socket_stt_reply in socks and socks[socket_stt_reply] == zmq.POLLIN:
-                msg = socket_stt_reply.recv()
-                if msg == b"LISTEN_ONCE":
-                    captured_speech = vcap.listen_once()
-                    # TODO Think about whether we want to deal with low confidence words by treating as masked text problem
-                    # TODO or more simply that we have some confidence threshold below which we ask for user to repeat themselves.
-                    socket_stt_reply.send(bytearray(captured_speech, 'utf8'))
+                msg = ms.decode(socket_stt_reply.recv())
+                if msg.msg_type == ms.LISTEN_ONCE:
+                    vcap.last_timings = Timings()
+                    transcript = vcap.listen_once(should_stop_listening)
+                    if transcript is None:
+                        transcript = ms.Message(ms.TRANSCRIPT)
+                    transcript.trace_id = msg.trace_id
+                    tracer.record_timings(msg.trace_id, vcap.last_timings)
+                    tracer.publish(socket_publisher)
+                    # the words carry their confidences and times, the control module decides what to do with
+                    # transcripts it can't trust (see RepromptPolicy in dialogue_control.py)
+                    socket_stt_reply.send(ms.encode(transcript))
 
         except KeyboardInterrupt:
             break
 
-        sleep(t_sleep)
-
     # for shutting down softly
     print("shutting everything down")
+    heartbeat.stop()
+    vcap.shut_down_pyaudio()
+    if isinstance(vcap.recognizer, PooledRecognizer):
+        vcap.recognizer.client.close()
+    waker.close()
+    if isinstance(getattr(vcap, "ring", None), SharedAudioRing):
+        vcap.ring.close()
     for sock in sockets_list:
+        sock.setsockopt(zmq.LINGER, 0)
         sock.close()
-    context.term()
+    if own_context:
+        context.term()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+""" Helpers for getting the modules from cold to ready quickly.
+
+- StartupTimer records how long each startup stage of a module took, so the system can report where the time goes.
+- load_pretrained loads a huggingface tokenizer and model in parallel threads. The first time it also saves them as a
+  local safetensors snapshot (memory mapped on load, no hub lookups), and every later start loads from the snapshot.
+- load_in_background starts a slow constructor (a model, the Vosk recognizer) on a thread so the process can get on
+  with connecting its sockets in the meantime.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import os
+from time import time
+
+# DIRECTORY WHERE LOCAL SNAPSHOTS OF THE HUGGINGFACE MODELS ARE KEPT
+pwd_model_snapshots = "../models/hf_snapshots"
+
+
+class StartupTimer:
+    """ Records named startup stages, relative to when the timer was made (i.e. when the process started up)"""
+
+    def __init__(self, module_name: str, t_start=None):
+        self.module_name = module_name
+        self.t_start = time() if t_start is None else t_start
+        self.stages = []  # (name, start offset, duration) in seconds
+        self.last_mark = self.t_start
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time()
+        try:
+            yield
+        finally:
+            self.stages.append((name, start - self.t_start, time() - start))
+
+    def mark(self, name: str):
+        """ record a stage that ran from the previous mark (or the start) until now"""
+        now = time()
+        self.stages.append((name, self.last_mark - self.t_start, now - self.last_mark))
+        self.last_mark = now
+
+    def elapsed(self):
+        return time() - self.t_start
+
+    def to_bytes(self):
+        return json.dumps({"module": self.module_name, "t_start": self.t_start, "stages": self.stages}).encode()
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        record = json.loads(data.decode())
+        timer = cls(record["module"], record["t_start"])
+        timer.stages = [tuple(stage) for stage in record["stages"]]
+        return timer
+
+    def report(self):
+        lines = ["{} startup:".format(self.module_name)]
+        for name, start, duration in sorted(self.stages, key=lambda stage: stage[1]):
+            lines.append("    {:<32s} {:7.2f}s  (from {:6.2f}s)".format(name, duration, start))
+        return "\n".join(lines)
+
+
+def snapshot_path(model_name: str, snapshot_dir=pwd_model_snapshots):
+    return os.path.join(snapshot_dir, model_name.replace("/", "--"))
+
+
+def load_pretrained(tokenizer_class, model_class, model_name: str, snapshot_dir=pwd_model_snapshots, timer=None):
+    """ Load a tokenizer and model, in parallel, preferring a local safetensors snapshot.
+
+    :param tokenizer_class: e.g. BlenderbotTokenizer
+    :param model_class: e.g. BlenderbotForConditionalGeneration
+    :param model_name: huggingface hub name, e.g. facebook/blenderbot-400M-distill
+    :param snapshot_dir: where snapshots live, None to always load from the hub cache
+    :param timer: optional StartupTimer to record the stages in
+    :return: (tokenizer, model)
+    """
+    local_path = snapshot_path(model_name, snapshot_dir) if snapshot_dir is not None else None
+    have_snapshot = local_path is not None and os.path.isdir(local_path)
+    source = local_path if have_snapshot else model_name
+    kwargs = {"local_files_only": True} if have_snapshot else {}
+
+    def timed(name, fn, *args, **fn_kwargs):
+        if timer is None:
+            return fn(*args, **fn_kwargs)
+        with timer.stage(name):
+            return fn(*args, **fn_kwargs)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        tokenizer_future = pool.submit(timed, "load tokenizer", tokenizer_class.from_pretrained, source, **kwargs)
+        model_future = pool.submit(timed, "load model", model_class.from_pretrained, source,
+                                   low_cpu_mem_usage=True, **kwargs)
+        tokenizer, model = tokenizer_future.result(), model_future.result()
+
+    if local_path is not None and not have_snapshot:
+        # first time round: save a snapshot so the next start doesn't need the hub at all
+        # (written under a temporary name and renamed, so an interrupted save isn't mistaken for a snapshot)
+        with timer.stage("save snapshot") if timer is not None else _no_stage():
+            tmp_path = "{}.{}.tmp".format(local_path, os.getpid())
+            tokenizer.save_pretrained(tmp_path)
+            model.save_pretrained(tmp_path, safe_serialization=True)
+            os.replace(tmp_path, local_path)
+    return tokenizer, model
+
+
+@contextmanager
+def _no_stage():
+    yield
+
+
+def load_in_background(fn, *args, **kwargs):
+    """ run fn(*args, **kwargs) on a background thread, returns a Future for the result"""
+    pool = ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(fn, *args, **kwargs)
+    pool.shutdown(wait=False)
+    return future
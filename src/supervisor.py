@@ -0,0 +1,267 @@
+""" Keeping the system up when one of its processes dies.
+
+run_main hands every process it starts to a Supervisor:
+
+- Modules publish a HEARTBEAT on the HEARTBEAT topic every HEARTBEAT_INTERVAL_S from a Heartbeat thread, starting
+  when they sync, but only while their main loop keeps calling beat(). A module process that exits, or that goes
+  HEARTBEAT_LIVENESS intervals without a heartbeat (a main loop that's deadlocked, a process that's frozen or stuck
+  in native code holding the GIL), is restarted. Work that can legitimately take longer than that without coming
+  round the loop (a reply being generated and spoken) runs inside busy(). Pool workers heartbeat their broker
+  instead, and are restarted when they exit or the broker reports them lost.
+- Only the failed process is restarted, everyone else keeps their warm models and sockets. The new one syncs like at
+  start up, run_main answers with START, and RESTARTED goes out on the SUPERVISOR topic so the control module can send
+  again any request that died with it.
+- Restarts back off: RESTART_BACKOFF_S after the first failure, doubling every failure up to MAX_BACKOFF_S, back to
+  the start once a process has been up for STABLE_S.
+- Threads (run_main(threaded=True)) can't be killed, so threaded modules are restarted when they exit but hangs are
+  only reported.
+
+Module processes ignore SIGINT, so Ctrl-C only reaches run_main, which drains: DRAIN asks the control module to
+finish the turn in flight and then shut the system down as usual.
+"""
+from contextlib import contextmanager
+import signal
+from threading import Thread, Event
+from time import time
+import multiprocessing as mp
+import zmq
+import message_schema as ms
+
+HEARTBEAT_INTERVAL_S = 1.0
+HEARTBEAT_LIVENESS = 5  # intervals without a heartbeat before a module counts as hung
+RESTART_BACKOFF_S = 1.0
+MAX_BACKOFF_S = 30.0
+STABLE_S = 60.0  # up for this long and the backoff starts over
+
+
+class Heartbeat:
+    """ Publishes HEARTBEAT on the HEARTBEAT topic from its own thread and socket until stopped, as long as the module
+    has called beat() since the last one or is busy(). The message id carries the pid, which is how the supervisor
+    tells processes apart"""
+
+    def __init__(self, context, endpoints, name: str, interval_s=HEARTBEAT_INTERVAL_S):
+        """
+        :param context: zmq context of the module
+        :param endpoints: EndpointConfig
+        :param name: the name the module syncs with
+        :param interval_s: seconds between heartbeats
+        """
+        self.context = context
+        self.address = endpoints.connect("pub_to_proxy")
+        self.name = name
+        self.interval_s = interval_s
+        self.beats = 0
+        self.busy_count = 0
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name="heartbeat", daemon=True)
+
+    def _run(self):
+        socket_publisher = self.context.socket(zmq.PUB)
+        socket_publisher.connect(self.address)
+        last_beats = -1
+        try:
+            while not self.stopped.wait(self.interval_s):
+                if self.beats == last_beats and not self.busy_count:
+                    continue  # the main loop hasn't been round since the last one
+                last_beats = self.beats
+                socket_publisher.send_multipart([b"HEARTBEAT", ms.encode(ms.Message(ms.HEARTBEAT, self.name))])
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            socket_publisher.close(linger=0)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def beat(self):
+        """ the main loop is alive, call every time round it (at least every interval_s)"""
+        self.beats += 1
+
+    @contextmanager
+    def busy(self):
+        """ keep heartbeating while the with block runs, for work that can't call beat()"""
+        self.busy_count += 1
+        try:
+            yield
+        finally:
+            self.busy_count -= 1
+            self.beats += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+def run_ignoring_interrupts(target, kwargs):
+    """ entry point of supervised processes: Ctrl-C is for run_main to deal with"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target(**kwargs)
+
+
+class Supervised:
+    """ One supervised process (or thread) and its counters"""
+
+    def __init__(self, func, kwargs, heartbeats: bool):
+        self.func = func
+        self.kwargs = kwargs
+        self.heartbeats = heartbeats
+        self.name = func.__name__  # until it syncs under its own name
+        self.worker = None
+        self.started = 0.0
+        self.last_heartbeat = None  # None until it has synced
+        self.restarts = 0
+        self.backoff_s = 0.0
+        self.restart_at = None  # when a restart is due, None when running
+        self.crashed = False  # a thread that raised, processes have their exit code for this
+        self.finished = False  # stopped by itself without an error, e.g. at the shutdown. Not restarted
+
+    def uptime(self, now=None):
+        if self.restart_at is not None or self.finished:
+            return 0.0
+        return (time() if now is None else now) - self.started
+
+
+class Supervisor:
+    """ Starts the processes (or threads) of the system and restarts any that fail, see the top of this file"""
+
+    def __init__(self, endpoints, context=None, threaded=False):
+        """
+        :param endpoints: EndpointConfig, passed to everything started
+        :param context: zmq context for threads
+        :param threaded: start threads of this process rather than processes
+        """
+        self.endpoints = endpoints
+        self.context = context
+        self.threaded = threaded
+        self.supervised = []
+        self.t_start = time()
+
+    @staticmethod
+    def _run_thread(entry, kwargs):
+        try:
+            entry.func(**kwargs)
+        except Exception:
+            entry.crashed = True
+            raise
+
+    def _spawn(self, entry):
+        kwargs = dict(endpoints=self.endpoints, **entry.kwargs)
+        if self.threaded:
+            entry.worker = Thread(target=self._run_thread, args=(entry, dict(context=self.context, **kwargs)),
+                                  name=entry.func.__name__, daemon=True)
+        else:
+            entry.worker = mp.Process(target=run_ignoring_interrupts, args=(entry.func, kwargs))
+        entry.worker.start()
+        entry.started = time()
+        entry.last_heartbeat = None
+        entry.restart_at = None
+        entry.crashed = False
+
+    def start(self, func, kwargs=None, heartbeats=True):
+        """
+        :param func: main function of the process, called with endpoints (and context when threaded) plus kwargs
+        :param kwargs: dict of extra keyword arguments
+        :param heartbeats: True for modules, which sync and heartbeat, False for pool workers
+        """
+        entry = Supervised(func, {} if kwargs is None else kwargs, heartbeats)
+        self._spawn(entry)
+        self.supervised.append(entry)
+        return entry
+
+    def _find(self, pid: int):
+        if self.threaded:
+            return None  # every thread has our pid
+        for entry in self.supervised:
+            if entry.worker is not None and entry.worker.pid == pid:
+                return entry
+        return None
+
+    def on_sync(self, msg):
+        """ a module synced, from now on it's expected to heartbeat"""
+        entry = self._find(msg.msg_id >> 32)
+        if entry is not None:
+            entry.name = msg.text
+            entry.last_heartbeat = time()
+
+    def on_heartbeat(self, msg):
+        entry = self._find(msg.msg_id >> 32)
+        if entry is not None:
+            entry.last_heartbeat = time()
+
+    def on_worker_lost(self, pid: int):
+        """ a pool broker gave up on the worker with this pid, see worker_pool.worker_pid"""
+        entry = self._find(pid)
+        if entry is not None and entry.restart_at is None:
+            self._failed(entry, "lost by its broker", time())
+
+    def _failed(self, entry, reason, now):
+        if entry.worker.is_alive() and not self.threaded:
+            entry.worker.terminate()
+            entry.worker.join(timeout=2.0)
+            if entry.worker.is_alive():
+                entry.worker.kill()  # SIGTERM doesn't get through to a stopped process
+                entry.worker.join(timeout=2.0)
+        if now - entry.started >= STABLE_S:
+            entry.backoff_s = 0.0
+        entry.backoff_s = min(max(2 * entry.backoff_s, RESTART_BACKOFF_S), MAX_BACKOFF_S)
+        entry.restart_at = now + entry.backoff_s
+        print("SUPERVISOR: {} {} after {:.0f}s up, restarting in {:.0f}s".format(
+            entry.name, reason, now - entry.started, entry.backoff_s))
+
+    def check(self):
+        """ Look for failed processes and restart the ones that are due. Call now and then.
+
+        :return: number restarted
+        """
+        now = time()
+        restarted = 0
+        for entry in self.supervised:
+            if entry.finished:
+                continue
+            if entry.restart_at is None:
+                if not entry.worker.is_alive():
+                    exitcode = getattr(entry.worker, "exitcode", None)
+                    if exitcode == 0 or (exitcode is None and not entry.crashed):
+                        print("SUPERVISOR: {} has finished".format(entry.name))
+                        entry.finished = True
+                        continue
+                    self._failed(entry, "crashed" if exitcode is None else "exited with code {}".format(exitcode),
+                                 now)
+                elif entry.heartbeats and entry.last_heartbeat is not None \
+                        and now - entry.last_heartbeat > HEARTBEAT_LIVENESS * HEARTBEAT_INTERVAL_S:
+                    if self.threaded:
+                        print("SUPERVISOR: {} has stopped heartbeating".format(entry.name))
+                        entry.last_heartbeat = None  # only say so once
+                    else:
+                        self._failed(entry, "stopped heartbeating", now)
+            if entry.restart_at is not None and now >= entry.restart_at:
+                self._spawn(entry)
+                entry.restarts += 1
+                restarted += 1
+        if restarted:
+            print(self.report())
+        return restarted
+
+    def report(self):
+        now = time()
+        lines = ["supervisor, up {:.0f}s:".format(now - self.t_start)]
+        for entry in self.supervised:
+            lines.append("    {:<32s} up {:7.0f}s  {} restarts".format(entry.name, entry.uptime(now), entry.restarts))
+        return "\n".join(lines)
+
+    def stop(self, timeout_s=5.0):
+        """ Wait for everything to finish, after the SHUTDOWN broadcast, and terminate the processes that don't"""
+        deadline = time() + timeout_s
+        for entry in self.supervised:
+            if entry.worker is None:
+                continue
+            entry.worker.join(timeout=max(0.0, deadline - time()))
+            if entry.worker.is_alive():
+                if self.threaded:
+                    print("thread still running", entry.worker.name)
+                else:
+                    print("terminating process", entry.name)
+                    entry.worker.terminate()
+        print(self.report())
@@ -0,0 +1,21 @@
+""" pytest test_dialogue_control.py, from src like the rest of the modules"""
+import pytest
+
+pytest.importorskip("transformers")  # dialogue_control loads the agents' models through it
+from dialogue_control import ClauseChunker
+
+
+def test_whole_reply_in_one_feed_comes_back_in_chunks():
+    chunker = ClauseChunker()
+    chunks = chunker.feed("Hi there. I like dogs, cats and birds. What about you? Tell me more")
+    assert chunks == ["Hi there.", "I like dogs, cats and birds.", "What about you?"]
+    assert chunker.flush() == ["Tell me more"]
+
+
+def test_streamed_reply_breaks_at_long_enough_clauses():
+    chunker = ClauseChunker(min_clause_chars=20)
+    chunks = []
+    for word in "Well, I have been thinking about it a lot, and honestly I think so. Yes!".split(" "):
+        chunks += chunker.feed(word + " ")
+    chunks += chunker.flush()
+    assert chunks == ["Well, I have been thinking about it a lot,", "and honestly I think so.", "Yes!"]
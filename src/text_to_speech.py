@@ -1,7 +1,24 @@
 import zmq
 import simpleaudio as sa
 import os
-from time import sleep
+import io
+import wave
+import queue
+import hashlib
+import tempfile
+import subprocess
+from collections import OrderedDict
+from threading import Thread, Lock, Condition
+from time import time
+import message_schema as ms
+from startup import StartupTimer
+from endpoints import make_endpoints
+from audio_bus import SharedAudioRing, span_message
+from tracing import Tracer
+from event_loop import Waker, POLL_TIMEOUT_MS
+from worker_pool import PoolClient, run_worker
+from supervisor import Heartbeat
+import numpy as np
 
 # ----------------------------------------------------------------------------------------------------------------------
 # A few ways of playing .wav files ... comment these out but keep for reference
@@ -48,106 +65,635 @@ from time import sleep
 #     p.terminate()
 
 
-def talk_pico2wave(text: str, tmp_file="tmp.wav"):
-    """ This is very hacky. I don't like writing a file, playing it and then deleting ...
-    but, the pico2speaker command seems to be defunct and so I'm stuck with pico2wave"""
-    text = "  ...  " + text
-    # write speech to a .wav file
-    pico_command = 'pico2wave -w ' + tmp_file + ' -l en-GB "' + text + ' "'
-    print(pico_command)
-    os.system(pico_command)  # this blocks
-
-    # play .wav file using simple audio
-    # simple audio
-    wave_obj = sa.WaveObject.from_wave_file(tmp_file)
-    play_obj = wave_obj.play()
-    play_obj.wait_done()  # Wait until sound has finished playing
+class PcmAudio:
+    """ Decoded PCM audio, ready to be handed to simpleaudio"""
+
+    def __init__(self, pcm: bytes, sample_rate: int, num_channels=1, bytes_per_sample=2):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self.bytes_per_sample = bytes_per_sample
+
+    @classmethod
+    def from_wav_bytes(cls, wav_bytes):
+        """ parse an in-memory .wav file"""
+        with wave.open(io.BytesIO(wav_bytes), 'rb') as wf:
+            return cls(wf.readframes(wf.getnframes()), wf.getframerate(), wf.getnchannels(), wf.getsampwidth())
+
+    def to_wav_bytes(self):
+        """ as an in-memory .wav file"""
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wf:
+            wf.setnchannels(self.num_channels)
+            wf.setsampwidth(self.bytes_per_sample)
+            wf.setframerate(self.sample_rate)
+            wf.writeframes(self.pcm)
+        return buffer.getvalue()
+
+    @property
+    def duration(self):
+        """ length in seconds"""
+        return len(self.pcm) / float(self.sample_rate * self.num_channels * self.bytes_per_sample)
+
+    def scaled(self, gain_db: float):
+        """ a copy with the volume changed by gain_db, clipped rather than wrapped around. 16 bit audio only"""
+        if gain_db == 0 or self.bytes_per_sample != 2:
+            return self
+        samples = np.frombuffer(self.pcm, dtype=np.int16).astype(np.float32) * 10 ** (gain_db / 20.0)
+        pcm = np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+        return PcmAudio(pcm, self.sample_rate, self.num_channels, self.bytes_per_sample)
+
+    def play(self):
+        """ start playback and return the simpleaudio PlayObject"""
+        return sa.play_buffer(self.pcm, self.num_channels, self.bytes_per_sample, self.sample_rate)
+
+
+class Pico2WaveBackend:
+    """ pico2wave synthesis without the tmp.wav round trip.
+
+    pico2wave insists on writing to a file name that ends in .wav (and seeks back to fix up the header, so a plain
+    pipe doesn't work). On Linux we give it an anonymous memfd instead: a .wav named symlink on tmpfs points at
+    /proc/self/fd/<n>, and the memfd is passed to the child under the same fd number, so pico2wave writes straight
+    into memory that we read back without anything touching disk. Where memfd_create isn't available we fall back to
+    a per-instance file in /dev/shm (or the temp dir), which at least can't collide with other TTS workers.
+
+    Arguments are passed to pico2wave as a list, never through a shell, so the text needs no quoting.
+    """
+
+    voice = "pico"
+
+    def __init__(self, lang="en-GB", lead_in="  ...  "):
+        self.lang = lang
+        self.lead_in = lead_in  # a little silence up front so the first word isn't clipped by the sound card
+        self.tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.buffer_fd = None
+        if hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd"):
+            self.buffer_fd = os.memfd_create("pico2wave", 0)
+            self.wav_path = os.path.join(self.tmp_dir, "pico2wave_{}_{}.wav".format(os.getpid(), self.buffer_fd))
+            if os.path.lexists(self.wav_path):
+                os.unlink(self.wav_path)
+            os.symlink("/proc/self/fd/{}".format(self.buffer_fd), self.wav_path)
+        else:
+            handle, self.wav_path = tempfile.mkstemp(suffix=".wav", prefix="pico2wave_", dir=self.tmp_dir)
+            os.close(handle)
+
+    def synthesize(self, text: str):
+        """ synthesize text and return it as PcmAudio"""
+        command = ["pico2wave", "-w", self.wav_path, "-l", self.lang, self.lead_in + text + " "]
+        pass_fds = (self.buffer_fd,) if self.buffer_fd is not None else ()
+        subprocess.run(command, check=True, pass_fds=pass_fds, stdout=subprocess.DEVNULL)  # this blocks
+
+        if self.buffer_fd is not None:
+            wav_bytes = os.pread(self.buffer_fd, os.fstat(self.buffer_fd).st_size, 0)
+        else:
+            with open(self.wav_path, 'rb') as f:
+                wav_bytes = f.read()
+        return PcmAudio.from_wav_bytes(wav_bytes)
+
+    def close(self):
+        if os.path.lexists(self.wav_path):
+            os.unlink(self.wav_path)
+        if self.buffer_fd is not None:
+            os.close(self.buffer_fd)
+            self.buffer_fd = None
+
+
+class PooledBackend:
+    """ Synthesis done by a pool of synthesis workers (see worker_pool.py) instead of in this process, so several
+    chunks can be synthesized on different cores. Same interface as Pico2WaveBackend"""
+
+    voice = Pico2WaveBackend.voice
+
+    def __init__(self, client: PoolClient, lang="en-GB"):
+        """
+        :param client: PoolClient connected to the tts pool
+        :param lang: has to match the workers', it's part of the cache key
+        """
+        self.client = client
+        self.lang = lang
+
+    def synthesize(self, text: str):
+        reply = self.client.request(ms.Message(ms.SYNTHESIZE, text))
+        if reply.text != "synthesized":
+            raise RuntimeError("synthesis pool failed on {!r}".format(text))
+        return PcmAudio.from_wav_bytes(reply.data)
+
+    def close(self):
+        self.client.close()
+
+
+def synthesis_worker_main(port_config=None, endpoints=None, context=None):
+    """ A worker for the synthesis pool: pico2wave for whoever asks. Start as many as there are cores to spare.
+
+    :param port_config: dict of tcp ports, used when no endpoints are given
+    :param endpoints: EndpointConfig with the socket addresses, see endpoints.py
+    :param context: zmq context to use, e.g. the launcher's when running as a thread. One is made if None
+    """
+    backend = Pico2WaveBackend()
+
+    def handle(request):
+        audio = backend.synthesize(request.text)
+        return request.reply(ms.ACK, "synthesized", data=audio.to_wav_bytes())
+
+    try:
+        run_worker("tts", make_endpoints(port_config, endpoints), handle, context)
+    finally:
+        backend.close()
+
+
+class SynthesisCache:
+    """ Content addressed cache of synthesized audio, keyed on (text, voice, language).
+
+    There are two tiers. The memory tier is an LRU of decoded PcmAudio bounded by a byte budget. The optional disk tier
+    keeps a .wav in disk_dir for the entries put with persist=True, the fixed phrases that are prewarmed, so those
+    survive restarts; disk hits are promoted to memory. Replies aren't written to disk, so it doesn't grow with every
+    conversation or keep what was said. Counters for both tiers are kept so hit rates can be reported.
+    """
+
+    def __init__(self, max_memory_bytes=32 * 1024 * 1024, disk_dir=None):
+        """
+        :param max_memory_bytes: byte budget for the PCM held in memory
+        :param disk_dir: directory for the on disk tier, None to keep the cache in memory only
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = Lock()  # the streaming speaker synthesizes from its own thread
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str, voice: str, lang: str):
+        return hashlib.sha256("\x00".join([voice, lang, text]).encode('utf8')).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + ".wav")
+
+    def _put_memory(self, key, audio):
+        if len(audio.pcm) > self.max_memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key).pcm)
+        self.memory[key] = audio
+        self.memory_bytes += len(audio.pcm)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted.pcm)
+
+    def get(self, key):
+        """ return the cached PcmAudio for key, or None"""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+            if self.disk_dir is not None and os.path.exists(self._disk_path(key)):
+                with open(self._disk_path(key), 'rb') as f:
+                    audio = PcmAudio.from_wav_bytes(f.read())
+                self._put_memory(key, audio)
+                self.disk_hits += 1
+                return audio
+            self.misses += 1
+            return None
+
+    def put(self, key, audio, persist=False):
+        """
+        :param persist: also write it to the disk tier, if there is one. For fixed phrases only
+        """
+        with self.lock:
+            self._put_memory(key, audio)
+            if persist and self.disk_dir is not None and not os.path.exists(self._disk_path(key)):
+                # write to a temp name and rename so a crash can't leave a half written entry behind
+                tmp_path = self._disk_path(key) + ".{}.tmp".format(os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(audio.to_wav_bytes())
+                os.replace(tmp_path, self._disk_path(key))
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory), "memory_bytes": self.memory_bytes}
+
+
+class CachedBackend:
+    """ Wraps a synthesis backend so that cache hits skip synthesis entirely"""
+
+    def __init__(self, backend, cache: SynthesisCache):
+        self.backend = backend
+        self.cache = cache
+        self.voice = backend.voice
+        self.lang = backend.lang
+
+    def synthesize(self, text: str):
+        key = self.cache.make_key(text, self.voice, self.lang)
+        audio = self.cache.get(key)
+        if audio is None:
+            audio = self.backend.synthesize(text)
+            self.cache.put(key, audio)
+        return audio
+
+    def prewarm(self, phrases):
+        """ synthesize (or load from disk) phrases we know will be spoken, so the first use is already a hit. These
+        are the ones kept on disk"""
+        for phrase in phrases:
+            self.cache.put(self.cache.make_key(phrase, self.voice, self.lang), self.synthesize(phrase), persist=True)
+
+    def close(self):
+        print("text to speech cache", self.cache.stats())
+        self.backend.close()
+
+
+def talk(text: str, backend):
+    """ synthesize text with the given backend and play it, blocking until it has been spoken"""
+    audio = backend.synthesize(text)
+    audio.play().wait_done()
     print("done speaking")
 
-    # delete .wav file (clean up)
-    rm_command = 'rm ' + tmp_file
-    os.system(rm_command)
 
+class StreamingSpeaker:
+    """ Speaks a stream of text chunks. Synthesis and playback run in two threads connected by a queue, so chunk N+1
+    is synthesized while chunk N is playing. Chunks are always spoken in the order they were queued.
+
+    interrupt() stops whatever is playing straight away and drops everything still queued. Each chunk is tagged with
+    the epoch it was queued in and interrupt() starts a new epoch, so audio that was being synthesized at the time is
+    thrown away rather than played.
+
+    With a playback_ring (a SharedAudioRing) every chunk is also written to shared memory just before it is played,
+    and its span is queued in played_spans for the main thread to announce, so other processes can see exactly what
+    went out of the speakers (say, as an echo reference for barge-in).
+
+    With a tracer, every chunk gets a synthesis span and each reply a first_audio_out span, from its first chunk being
+    queued until it starts to play.
+
+    on_event, if set, is called from the playback thread whenever a chunk starts playing or is done with, e.g. a
+    Waker's wake so the main loop can block in its poll until then.
+
+    gain_db is applied to every chunk as it is played (so cached audio stays as synthesized), see change_volume.
+
+    A chunk that can't be synthesized (say the synthesis pool is down) is skipped and counted in failures."""
+
+    MIN_GAIN_DB = -20.0
+    MAX_GAIN_DB = 12.0
+
+    def __init__(self, backend, playback_ring=None, tracer=None):
+        self.backend = backend
+        self.playback_ring = playback_ring
+        self.tracer = tracer
+        self.first_request = {}  # trace id -> time its first chunk was queued, until that chunk plays
+        self.first_audio_trace = None  # the last trace that started playing
+        self.on_event = None
+        self.gain_db = 0.0
+        self.failures = 0
+        self.played_spans = queue.Queue()  # (start, count) in the playback ring
+        self.text_queue = queue.Queue()
+        self.audio_queue = queue.Queue(maxsize=2)  # don't synthesize too far ahead of playback
+        self.epoch = 0
+        self.play_obj = None
+        self.pending = 0  # chunks queued but not yet heard (or dropped)
+        self.pending_condition = Condition()
+        self.synthesis_thread = Thread(target=self._synthesis_loop, daemon=True)
+        self.playback_thread = Thread(target=self._playback_loop, daemon=True)
+        self.synthesis_thread.start()
+        self.playback_thread.start()
+
+    def _chunk_done(self):
+        with self.pending_condition:
+            self.pending -= 1
+            self.pending_condition.notify_all()
+        self._notify()
+
+    def _notify(self):
+        if self.on_event is not None:
+            self.on_event()
+
+    def _synthesis_loop(self):
+        while True:
+            item = self.text_queue.get()
+            if item is None:
+                self.audio_queue.put(None)
+                break
+            epoch, trace_id, text = item
+            if epoch != self.epoch:
+                self._chunk_done()
+                continue
+            start = time()
+            try:
+                audio = self.backend.synthesize(text)
+            except RuntimeError as e:
+                print("synthesis failed:", e)
+                self.failures += 1
+                self._chunk_done()
+                continue
+            if self.tracer is not None and trace_id != 0:
+                self.tracer.record(trace_id, "synthesis", start, time() - start, characters=len(text))
+            self.audio_queue.put((epoch, trace_id, audio))
+
+    def _playback_loop(self):
+        while True:
+            item = self.audio_queue.get()
+            if item is None:
+                break
+            epoch, trace_id, audio = item
+            if epoch == self.epoch:
+                audio = audio.scaled(self.gain_db)
+                self._share(audio)
+                self.play_obj = audio.play()
+                self._first_audio(trace_id)
+                self._notify()
+                self.play_obj.wait_done()
+                self.play_obj = None
+            self._chunk_done()  # a chunk only counts as done once it has been heard
+
+    def _first_audio(self, trace_id):
+        self.first_audio_trace = trace_id
+        start = self.first_request.pop(trace_id, None)
+        if self.tracer is not None and start is not None:
+            self.tracer.record(trace_id, "first_audio_out", start, time() - start)
+
+    def _share(self, audio):
+        ring = self.playback_ring
+        if ring is None or audio.sample_rate != ring.sample_rate or audio.num_channels != 1:
+            return
+        start = ring.write_index
+        samples = np.frombuffer(audio.pcm, dtype=np.int16)
+        ring.write(samples)
+        self.played_spans.put((start, len(samples)))
+
+    def speak(self, text: str, trace_id=0):
+        """ queue a chunk of text, returns immediately"""
+        if trace_id != 0 and trace_id != self.first_audio_trace and trace_id not in self.first_request:
+            self.first_request[trace_id] = time()
+        with self.pending_condition:
+            self.pending += 1
+        self.text_queue.put((self.epoch, trace_id, text))
+
+    def is_busy(self):
+        return self.pending > 0
 
-def text_to_speech_main(port_config=None):
+    def change_volume(self, db: float):
+        """ louder (or quieter, db < 0) from the next chunk on. Returns the new gain"""
+        self.gain_db = min(max(self.gain_db + db, self.MIN_GAIN_DB), self.MAX_GAIN_DB)
+        return self.gain_db
+
+    def wait_done(self, timeout=None):
+        """ block until every queued chunk has been played. Returns False if it timed out first"""
+        with self.pending_condition:
+            return self.pending_condition.wait_for(lambda: self.pending == 0, timeout)
+
+    def interrupt(self):
+        """ stop speaking now and forget about everything queued"""
+        self.epoch += 1
+        self.first_request.clear()
+        play_obj = self.play_obj
+        if play_obj is not None:
+            play_obj.stop()  # wait_done in the playback thread returns as soon as playback stops
+        # anything still in the queues is from the old epoch and gets skipped by the threads, which also keeps the
+        # pending count right
+
+    def shut_down(self):
+        self.interrupt()
+        self.text_queue.put(None)
+        self.synthesis_thread.join()
+        self.playback_thread.join()
+
+
+def text_to_speech_main(port_config=None, endpoints=None, context=None, synthesis_pool=False):
     """The intended functionality here is to speak only one response at a time. Specifically
     receive text as a zmq message, speak it, and then reply with a message that the text has been
     spoken. As such, this function is deliberately blocking.
 
-    In between we listen for system commands if needed."""
+    A response can also be streamed: each STREAM_CHUNK request is queued and acknowledged
+    immediately so synthesis and playback overlap with generation, and the final STREAM_END
+    request is only answered once everything queued has been spoken. A PREWARM request fills
+    the synthesis cache with phrases that are going to be spoken again and again.
 
-    if port_config is None:
-        port_config = {"system_sync_port": 5553,  # report for system to check that modules are sync'ed properly
-                       "pub_to_proxy_port": 5554,  # port to publish to proxy so in the proxy it is xsub
-                       "sub_to_proxy_port": 5555,  # port to subscribe to the proxy so in the proxy it is xpub
-                       "stt_req_rep_port": 5556,  # REQ-REP control port for the stt pub sub
-                       "tts_req_rep_port": 5557,  # REQ-REP port for the text to speech
-                       }
+    For barge-in, PLAYBACK_START / PLAYBACK_END are published on TTS_PLAYBACK around every spoken
+    reply so the speech to text process knows when to listen for the user talking over it. An
+    INTERRUPT from it stops playback at once, drops anything queued, and every remaining request
+    for that reply is answered with "interrupted" so the control process can move on.
 
-    t_sleep = 0.1
+    In between we listen for system commands if needed.
+
+    :param port_config: dict of tcp ports, used when no endpoints are given
+    :param endpoints: EndpointConfig with the socket addresses, see endpoints.py
+    :param context: zmq context to use, e.g. the launcher's when running as a thread. One is made if None
+    :param synthesis_pool: send the synthesis to the pool of synthesis workers (see worker_pool.py) instead of running
+        pico2wave in this process
+    """
+    timer = StartupTimer("TEXT TO SPEECH MODULE")
+    tracer = Tracer("text_to_speech")
+    endpoints = make_endpoints(port_config, endpoints)
+
+    # cache of synthesized audio. Give a directory, e.g. "../cache/tts_audio", to keep the prewarmed fixed phrases on
+    # disk between runs
+    tts_cache_dir = None
+    tts_cache_bytes = 32 * 1024 * 1024
+    # put the audio being played in shared memory too, so other processes can see it (see audio_bus.py)
+    share_audio = True
+    playback_ring_s = 10.0
+    playback_rate = 16000  # pico2wave's rate
 
     # ------------------------------------------------------------------------------------------------------------------
     # Make context and sockets
 
-    context = zmq.Context()
+    own_context = context is None
+    if own_context:
+        context = zmq.Context()
     sockets_list = []
 
     # system sync socket
     socket_system_sync = context.socket(zmq.REQ)
-    socket_system_sync.connect("tcp://localhost:{}".format(port_config["system_sync_port"]))
+    socket_system_sync.connect(endpoints.connect("system_sync"))
     sockets_list.append(socket_system_sync)
 
     # socket for publishing to proxy
     socket_publisher = context.socket(zmq.PUB)
-    socket_publisher.connect("tcp://localhost:{}".format(port_config["pub_to_proxy_port"]))
+    socket_publisher.connect(endpoints.connect("pub_to_proxy"))
     sockets_list.append(socket_publisher)
 
     # socket for subscribing to proxy
     socket_subscriber = context.socket(zmq.SUB)
-    socket_subscriber.connect("tcp://localhost:{}".format(port_config["sub_to_proxy_port"]))
+    socket_subscriber.connect(endpoints.connect("sub_to_proxy"))
     socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"SYSTEM")
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"STT_INTERRUPT")
     sockets_list.append(socket_subscriber)
 
     # open tts_reply socket
     socket_tts_reply = context.socket(zmq.REP)
-    socket_tts_reply.bind("tcp://*:{}".format(port_config["tts_req_rep_port"]))
+    socket_tts_reply.bind(endpoints.bind("tts_req_rep"))
     sockets_list.append(socket_tts_reply)
 
+    # the playback thread wakes up the main loop when a chunk starts or finishes playing
+    waker = Waker(context, "text_to_speech")
+
     # make poller because we are listening to both the subscriber and the stt_reply sockets
     poller = zmq.Poller()
     poller.register(socket_subscriber, zmq.POLLIN)
     poller.register(socket_tts_reply, zmq.POLLIN)
+    poller.register(waker.socket, zmq.POLLIN)
+    # and one for while a reply is being spoken, when requests have to wait
+    speaking_poller = zmq.Poller()
+    speaking_poller.register(socket_subscriber, zmq.POLLIN)
+    speaking_poller.register(waker.socket, zmq.POLLIN)
+    timer.mark("connect sockets")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # synthesis backend, and a speaker for streamed responses
+    if synthesis_pool:
+        synthesizer = PooledBackend(PoolClient(context, endpoints.connect("tts_pool")))
+    else:
+        synthesizer = Pico2WaveBackend()
+    backend = CachedBackend(synthesizer, SynthesisCache(tts_cache_bytes, tts_cache_dir))
+    playback_ring = None
+    if share_audio:
+        playback_ring = SharedAudioRing(endpoints.stack_name + "-playback", int(playback_ring_s * playback_rate),
+                                        playback_rate, create=True)
+    speaker = StreamingSpeaker(backend, playback_ring, tracer)
+    speaker.on_event = waker.wake
+    timer.mark("start synthesis backend")
 
     # ------------------------------------------------------------------------------------------------------------------
     # inform the system that we have connected all sockets and are ready to go
-    socket_system_sync.send(b"SPEECH TO TEXT MODULE")
+    socket_system_sync.send(ms.encode(ms.Message(ms.SYNC, "TEXT TO SPEECH MODULE", data=timer.to_bytes())))
     msg = socket_system_sync.recv()  # this one can be blocking
+    heartbeat = Heartbeat(context, endpoints, "TEXT TO SPEECH MODULE").start()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # the reply being spoken, by trace id. A reply that was interrupted stays interrupted, any more chunks of it that
+    # turn up are dropped
+    speaking_trace = None
+    speaking_since = 0.0
+    failures_before = 0  # speaker.failures when the reply started
+    interrupted_trace = None
+    shutting_down = False
+
+    def start_playback(trace_id):
+        nonlocal speaking_trace, speaking_since, failures_before
+        if speaking_trace != trace_id:
+            speaking_trace = trace_id
+            speaking_since = time()
+            failures_before = speaker.failures
+            socket_publisher.send_multipart([b"TTS_PLAYBACK", ms.encode(ms.Message(ms.PLAYBACK, "PLAYBACK_START",
+                                                                                   trace_id=trace_id))])
+
+    def end_playback(interrupted=False):
+        nonlocal speaking_trace
+        if speaking_trace is not None:
+            tracer.record(speaking_trace, "playback_done", speaking_since, time() - speaking_since,
+                          interrupted=interrupted)
+            socket_publisher.send_multipart([b"TTS_PLAYBACK", ms.encode(ms.Message(ms.PLAYBACK, "PLAYBACK_END",
+                                                                                   trace_id=speaking_trace))])
+            speaking_trace = None
+
+    def announce_played_audio():
+        """ publish where the chunks that started playing since last time are in the playback ring"""
+        while not speaker.played_spans.empty():
+            start, count = speaker.played_spans.get()
+            socket_publisher.send_multipart([b"AUDIO_PLAYBACK", ms.encode(span_message(playback_ring, start, count,
+                                                                                       speaking_trace or 0))])
+
+    def handle_broadcast():
+        """ one message from the subscriber: stop speaking on an interrupt, note a shutdown"""
+        nonlocal interrupted_trace, shutting_down
+        topic, message = socket_subscriber.recv_multipart()
+        msg = ms.decode(message)
+        if msg.msg_type == ms.INTERRUPT:
+            if speaking_trace is not None:
+                speaker.interrupt()
+                interrupted_trace = speaking_trace
+                end_playback(interrupted=True)
+            return
+        print(topic.decode(), msg)
+        if msg.msg_type == ms.SHUTDOWN:
+            shutting_down = True
+
+    def wait_while_speaking():
+        """ block until everything queued has been spoken, but keep an ear out for interrupts"""
+        while speaker.is_busy():
+            # the last chunk finishing wakes us up, so no need to check on the speaker every so often
+            socks = dict(speaking_poller.poll(POLL_TIMEOUT_MS))
+            if speaker.synthesis_thread.is_alive() and speaker.playback_thread.is_alive():
+                heartbeat.beat()  # otherwise we'd wait here forever, better to be restarted
+            if waker.socket in socks:
+                waker.clear()
+            announce_played_audio()
+            tracer.publish(socket_publisher)
+            if socket_subscriber in socks:
+                handle_broadcast()
 
     # ------------------------------------------------------------------------------------------------------------------
     # main loop
-    while True:
+    while not shutting_down:
 
         try:
-            socks = dict(poller.poll(100))  # poll for .1 ms don't block
+            # blocks until there's a request, a broadcast or news from the playback thread
+            socks = dict(poller.poll(POLL_TIMEOUT_MS))
+            heartbeat.beat()
+            if waker.socket in socks:
+                waker.clear()
+            announce_played_audio()
+            tracer.publish(socket_publisher)
 
             # if a message from the system
             if socket_subscriber in socks and socks[socket_subscriber] == zmq.POLLIN:
-                topic, message = socket_subscriber.recv_multipart()
-                print(topic.decode(), message.decode())
-                if message == b"SHUTDOWN":
-                    break
+                handle_broadcast()
 
-            # if a request to listen for speech
+            # if a request to speak
             elif socket_tts_reply in socks and socks[socket_tts_reply] == zmq.POLLIN:
-                text = socket_tts_reply.recv().decode()
-                talk_pico2wave(text)
-                sleep(t_sleep)
-                socket_tts_reply.send(b"text spoken")
+                msg = ms.decode(socket_tts_reply.recv())
+                if msg.msg_type == ms.PREWARM:
+                    with heartbeat.busy():
+                        backend.prewarm(msg.text.split("\n"))
+                    socket_tts_reply.send(ms.encode(msg.reply(ms.ACK, "cache warmed")))
+                    continue
+                if msg.msg_type == ms.VOLUME:
+                    gain_db = speaker.change_volume(float(msg.text))
+                    socket_tts_reply.send(ms.encode(msg.reply(ms.ACK, "gain {:+.0f} dB".format(gain_db))))
+                    continue
+                if msg.trace_id != 0 and msg.trace_id == interrupted_trace:
+                    socket_tts_reply.send(ms.encode(msg.reply(ms.ACK, "interrupted")))
+                    continue
+
+                start_playback(msg.trace_id)
+                if msg.msg_type == ms.STREAM_CHUNK:
+                    speaker.speak(msg.text, msg.trace_id)
+                    socket_tts_reply.send(ms.encode(msg.reply(ms.ACK, "chunk queued")))
+                    continue  # reply straight away so the next chunk isn't held up
+                elif msg.msg_type == ms.STREAM_END:
+                    wait_while_speaking()
+                else:
+                    speaker.speak(msg.text, msg.trace_id)
+                    wait_while_speaking()
+
+                if speaking_trace is None:  # an interrupt ended it early
+                    socket_tts_reply.send(ms.encode(msg.reply(ms.ACK, "interrupted")))
+                    continue
+                end_playback()
+                tracer.publish(socket_publisher)
+                if speaker.failures != failures_before:
+                    socket_tts_reply.send(ms.encode(msg.reply(ms.ACK, "synthesis failed")))
+                    continue
+                socket_tts_reply.send(ms.encode(msg.reply(ms.ACK, "text spoken")))
 
         except KeyboardInterrupt:
             break
 
-        sleep(t_sleep)
+    heartbeat.stop()
+    speaker.shut_down()
+    backend.close()
+    waker.close()
+    if playback_ring is not None:
+        playback_ring.close()
+    for sock in sockets_list:
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.close()
+    if own_context:
+        context.term()
 
 
 if __name__ == "__main__":
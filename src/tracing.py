@@ -0,0 +1,272 @@
+""" Per turn latency tracing.
+
+Every dialogue turn has a trace id (see message_schema.new_trace_id) that travels with its messages through all the
+processes. Each module records spans against it with a Tracer, one per stage:
+
+    speech_to_text  end_of_speech, final_transcript
+    control         tokenize, generate (with tokens per second), decode, respond
+    text_to_speech  synthesis, first_audio_out, playback_done
+
+Spans are recorded from whatever thread did the work and published by the module's main thread as SPAN messages on
+the METRICS topic. The MetricsCollector (metrics_collector_main, started by run_main) picks them up, appends them to a
+JSONL file, adds an end_to_first_audio span per turn (end of speech until the first audio of the reply), and serves
+p50/p95/p99 latency per stage in Prometheus text format over http.
+
+To summarize a JSONL file after the fact:
+python3 tracing.py ../logs/trace_spans.jsonl
+"""
+from collections import defaultdict, deque, OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import sys
+from threading import Thread, Lock
+from time import time
+import numpy as np
+import zmq
+import message_schema as ms
+from endpoints import make_endpoints
+from supervisor import Heartbeat
+from event_loop import POLL_TIMEOUT_MS
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Tracer:
+    """ Records spans from any thread and publishes them from the one that owns the publisher socket"""
+
+    def __init__(self, module_name: str):
+        self.module_name = module_name
+        self.pending = queue.Queue()
+
+    def record(self, trace_id: int, stage: str, start: float, duration: float, **attrs):
+        """
+        :param trace_id: the turn the span belongs to
+        :param stage: e.g. "generate"
+        :param start: time() when the stage started
+        :param duration: seconds
+        :param attrs: anything else worth keeping, e.g. tokens_per_s. Has to be json serializable
+        """
+        attrs.update(module=self.module_name, duration=duration)
+        self.pending.put(ms.Message(ms.SPAN, stage, data=json.dumps(attrs).encode(), trace_id=trace_id,
+                                    timestamp=start))
+
+    @contextmanager
+    def span(self, trace_id: int, stage: str, **attrs):
+        """ time the body of a with statement. Yields the attrs dict, so more can be added along the way"""
+        start = time()
+        try:
+            yield attrs
+        finally:
+            self.record(trace_id, stage, start, time() - start, **attrs)
+
+    def record_timings(self, trace_id: int, timings):
+        """ record a dict of stage -> (start, duration, attrs), e.g. an agent's last_timings"""
+        for stage, (start, duration, attrs) in timings.items():
+            self.record(trace_id, stage, start, duration, **attrs)
+
+    def publish(self, socket):
+        """ send everything recorded so far on the METRICS topic. Call from the thread that owns socket"""
+        while not self.pending.empty():
+            socket.send_multipart([b"METRICS", ms.encode(self.pending.get())])
+
+
+class Timings(dict):
+    """ stage -> (start, duration, attrs) for one call, e.g. an agent's last_timings. No trace id or sockets needed,
+    so the agents can fill one in without knowing about any of this"""
+
+    @contextmanager
+    def stage(self, name: str, **attrs):
+        start = time()
+        try:
+            yield attrs
+        finally:
+            self[name] = (start, time() - start, attrs)
+
+
+def span_record(msg):
+    """ a SPAN message as a flat dict, which is also what goes in the JSONL file"""
+    record = json.loads(msg.data.decode())
+    record.update(trace_id="{:016x}".format(msg.trace_id), stage=msg.text, start=msg.timestamp)
+    return record
+
+
+class MetricsCollector:
+    """ Keeps the latest durations of every stage and works out quantiles over them"""
+
+    def __init__(self, window=10000, jsonl_path=None):
+        """
+        :param window: durations kept per stage for the quantiles
+        :param jsonl_path: file every span is appended to, None to not keep them
+        """
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+        self.totals = defaultdict(lambda: [0, 0.0])  # stage -> [count, sum], over everything ever seen
+        self.tokens_per_s = deque(maxlen=window)
+        self.turns = OrderedDict()  # trace id -> {stage: record}, for spans that cover several modules
+        self.lock = Lock()  # the http server reads from its own threads
+        self.jsonl_file = None
+        if jsonl_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+            self.jsonl_file = open(jsonl_path, "a")
+
+    def add(self, record):
+        with self.lock:
+            self._add(record)
+            turn = self.turns.setdefault(record["trace_id"], {})
+            turn[record["stage"]] = record
+            # spans from different processes can turn up in any order, so whichever of the two comes second
+            if record["stage"] in ("first_audio_out", "end_of_speech") and \
+                    "first_audio_out" in turn and "end_of_speech" in turn:
+                first_audio = turn["first_audio_out"]
+                end_of_speech = turn["end_of_speech"]["start"]
+                # derived again whenever the file is read back, so not written to it
+                self._add({"stage": "end_to_first_audio", "trace_id": record["trace_id"], "module": "collector",
+                           "start": end_of_speech,
+                           "duration": first_audio["start"] + first_audio["duration"] - end_of_speech}, write=False)
+            while len(self.turns) > 1000:
+                self.turns.popitem(last=False)
+
+    def _add(self, record, write=True):
+        stage = record["stage"]
+        self.durations[stage].append(record["duration"])
+        self.totals[stage][0] += 1
+        self.totals[stage][1] += record["duration"]
+        if "tokens_per_s" in record:
+            self.tokens_per_s.append(record["tokens_per_s"])
+        if write and self.jsonl_file is not None:
+            self.jsonl_file.write(json.dumps(record) + "\n")
+            self.jsonl_file.flush()
+
+    def quantiles(self):
+        """ stage -> {0.5: seconds, 0.95: seconds, 0.99: seconds}"""
+        with self.lock:
+            return {stage: dict(zip(QUANTILES, np.quantile(np.array(values), QUANTILES)))
+                    for stage, values in self.durations.items() if values}
+
+    def prometheus_text(self):
+        lines = ["# HELP sv_stage_latency_seconds Latency of each stage of a dialogue turn",
+                 "# TYPE sv_stage_latency_seconds summary"]
+        quantiles = self.quantiles()
+        with self.lock:
+            for stage in sorted(quantiles):
+                for q, value in quantiles[stage].items():
+                    lines.append('sv_stage_latency_seconds{{stage="{}",quantile="{}"}} {:.6f}'.format(stage, q, value))
+                count, total = self.totals[stage]
+                lines.append('sv_stage_latency_seconds_sum{{stage="{}"}} {:.6f}'.format(stage, total))
+                lines.append('sv_stage_latency_seconds_count{{stage="{}"}} {}'.format(stage, count))
+            if self.tokens_per_s:
+                lines += ["# HELP sv_generate_tokens_per_second Mean generation speed",
+                          "# TYPE sv_generate_tokens_per_second gauge",
+                          "sv_generate_tokens_per_second {:.3f}".format(float(np.mean(self.tokens_per_s)))]
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        lines = ["{:<22s} {:>6s} {:>9s} {:>9s} {:>9s}".format("stage", "count", "p50", "p95", "p99")]
+        for stage, values in sorted(self.quantiles().items()):
+            lines.append("{:<22s} {:>6d} {:>8.3f}s {:>8.3f}s {:>8.3f}s".format(
+                stage, self.totals[stage][0], values[0.5], values[0.95], values[0.99]))
+        return "\n".join(lines)
+
+    def close(self):
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+
+
+def serve_prometheus(collector: MetricsCollector, port: int):
+    """ serve collector.prometheus_text() on http://localhost:port/metrics from a background thread
+
+    :return: the server, None if the port can't be bound (e.g. another stack on this machine has it)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = collector.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # no line per scrape
+
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    except OSError as e:
+        print("METRICS COLLECTOR: no Prometheus endpoint, can't bind port {}: {}".format(port, e))
+        return None
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def metrics_collector_main(port_config=None, endpoints=None, context=None, jsonl_path="../logs/trace_spans.jsonl",
+                           http_port="config"):
+    """ Collects the spans published on METRICS, writes them to jsonl_path and serves the quantiles to Prometheus.
+
+    :param port_config: dict of tcp ports, used when no endpoints are given
+    :param endpoints: EndpointConfig, see endpoints.py
+    :param context: zmq context to use, e.g. the launcher's when running as a thread. One is made if None
+    :param jsonl_path: where to append the spans, None to not write them
+    :param http_port: port for the Prometheus text endpoint, None for no endpoint. By default the metrics_http_port
+        of the endpoints' port_config, so a second stack on the same machine can be given its own
+    """
+    endpoints = make_endpoints(port_config, endpoints)
+    own_context = context is None
+    if own_context:
+        context = zmq.Context()
+
+    socket_system_sync = context.socket(zmq.REQ)
+    socket_system_sync.connect(endpoints.connect("system_sync"))
+
+    socket_subscriber = context.socket(zmq.SUB)
+    socket_subscriber.connect(endpoints.connect("sub_to_proxy"))
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"METRICS")
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"SYSTEM")
+
+    if http_port == "config":
+        http_port = endpoints.port_config.get("metrics_http_port")
+    collector = MetricsCollector(jsonl_path=jsonl_path)
+    server = serve_prometheus(collector, http_port) if http_port is not None else None
+
+    socket_system_sync.send(ms.encode(ms.Message(ms.SYNC, "METRICS COLLECTOR")))
+    msg = socket_system_sync.recv()
+    heartbeat = Heartbeat(context, endpoints, "METRICS COLLECTOR").start()
+
+    try:
+        while True:
+            heartbeat.beat()
+            if not socket_subscriber.poll(POLL_TIMEOUT_MS):
+                continue
+            topic, message = socket_subscriber.recv_multipart()
+            msg = ms.decode(message)
+            if msg.msg_type == ms.SPAN:
+                collector.add(span_record(msg))
+            elif msg.msg_type == ms.SHUTDOWN:
+                break
+    except (KeyboardInterrupt, zmq.ContextTerminated):
+        pass
+    finally:
+        heartbeat.stop()
+        print(collector.report())
+        collector.close()
+        if server is not None:
+            server.shutdown()
+        for sock in [socket_system_sync, socket_subscriber]:
+            sock.close(linger=0)
+        if own_context:
+            context.term()
+
+
+def summarize_jsonl(path: str):
+    """ p50/p95/p99 per stage from a JSONL file of spans"""
+    collector = MetricsCollector()
+    with open(path) as f:
+        for line in f:
+            collector.add(json.loads(line))
+    return collector.report()
+
+
+if __name__ == "__main__":
+    print(summarize_jsonl(sys.argv[1] if len(sys.argv) > 1 else "../logs/trace_spans.jsonl"))
@@ -0,0 +1,151 @@
+from collections import deque
+import numpy as np
+
+# webrtcvad is optional, only needed for the model based detector
+try:
+    import webrtcvad
+except ImportError:
+    webrtcvad = None
+
+
+class EnergyVAD:
+    """Voice activity detection from short time energy and zero crossing rate, vectorized over all the frames in a
+    chunk at once.
+
+    The noise floor adapts to the room: it tracks the energy of frames judged to be silence, and a frame counts as
+    voiced when it is margin_db above that floor and its zero crossing rate looks like speech rather than hiss or hum.
+    """
+
+    def __init__(self, rate=16000, frame_ms=25, margin_db=12.0, min_energy_db=-55.0, zcr_range=(0.02, 0.5),
+                 noise_adapt=0.05):
+        """
+        :param rate: sample rate
+        :param frame_ms: frame length in milliseconds
+        :param margin_db: how far above the noise floor a frame has to be to count as speech
+        :param min_energy_db: absolute floor (dB relative to int16 full scale) below which nothing is speech
+        :param zcr_range: zero crossings per sample that are plausible for speech
+        :param noise_adapt: how quickly the noise floor follows the energy of silent frames
+        """
+        self.rate = rate
+        self.frame_length = int(rate * frame_ms / 1000)
+        self.margin_db = margin_db
+        self.min_energy_db = min_energy_db
+        self.zcr_range = zcr_range
+        self.noise_adapt = noise_adapt
+        self.noise_floor_db = min_energy_db
+
+    def is_speech(self, frames):
+        """
+        :param frames: int16 array of shape (n_frames, frame_length)
+        :return: boolean array of shape (n_frames,)
+        """
+        x = frames.astype(np.float32) / 32768.0
+        energy_db = 10.0 * np.log10(np.mean(x * x, axis=1) + 1e-10)
+        zcr = np.mean(np.signbit(x[:, 1:]) != np.signbit(x[:, :-1]), axis=1)
+
+        threshold = max(self.noise_floor_db + self.margin_db, self.min_energy_db)
+        voiced = (energy_db > threshold) & (zcr >= self.zcr_range[0]) & (zcr <= self.zcr_range[1])
+
+        # follow the noise floor using the frames we think are silence
+        silent = energy_db[~voiced]
+        if len(silent) > 0:
+            self.noise_floor_db += self.noise_adapt * (float(np.median(silent)) - self.noise_floor_db)
+        return voiced
+
+
+class WebRTCVAD:
+    """Model based voice activity detection using the webrtcvad package (pip install webrtcvad)"""
+
+    def __init__(self, rate=16000, frame_ms=10, aggressiveness=2):
+        """
+        :param rate: sample rate, one of 8000, 16000, 32000, 48000
+        :param frame_ms: frame length in milliseconds, one of 10, 20, 30
+        :param aggressiveness: 0 (least) to 3 (most) aggressive at filtering out non speech
+        """
+        if webrtcvad is None:
+            raise ImportError("WebRTCVAD needs the webrtcvad package: pip install webrtcvad")
+        self.rate = rate
+        self.frame_length = int(rate * frame_ms / 1000)
+        self.vad = webrtcvad.Vad(aggressiveness)
+
+    def is_speech(self, frames):
+        return np.array([self.vad.is_speech(frame.tobytes(), self.rate) for frame in frames], dtype=bool)
+
+
+class VADGate:
+    """Sits in front of the recognizer and only lets speech through.
+
+    Audio is split into detector frames. Once speech starts, the prepad frames from just before it are forwarded too
+    (so the onset isn't clipped) and forwarding carries on for hangover frames after the last voiced frame (so word
+    endings and short pauses aren't clipped). Everything else is dropped, which keeps the recognizer idle while nobody
+    is talking.
+    """
+
+    def __init__(self, detector=None, hangover_frames=20, prepad_frames=10, min_speech_frames=3):
+        """
+        :param detector: EnergyVAD, WebRTCVAD or anything with frame_length and is_speech(frames)
+        :param hangover_frames: frames to keep forwarding after the last voiced frame
+        :param prepad_frames: frames from before speech onset to forward
+        :param min_speech_frames: consecutive voiced frames needed to declare speech has started
+        """
+        self.detector = detector if detector is not None else EnergyVAD()
+        self.frame_length = self.detector.frame_length
+        self.hangover_frames = hangover_frames
+        self.min_speech_frames = min_speech_frames
+        self.prepad = deque(maxlen=prepad_frames + min_speech_frames)
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.in_speech = False
+        self.voiced_run = 0
+        self.silence_run = 0
+
+    def reset(self):
+        self.prepad.clear()
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.in_speech = False
+        self.voiced_run = 0
+        self.silence_run = 0
+
+    def trailing_silence_s(self):
+        """seconds of silence since the last voiced frame, while still in speech (0 outside speech)"""
+        if not self.in_speech:
+            return 0.0
+        return self.silence_run * self.frame_length / float(self.detector.rate)
+
+    def process(self, samples):
+        """
+        :param samples: int16 array of any length
+        :return: (bytes of audio to forward to the recognizer, list of "SPEECH_START" / "SPEECH_END" events)
+        """
+        if len(self.remainder) > 0:
+            samples = np.concatenate([self.remainder, samples])
+        n_frames = len(samples) // self.frame_length
+        self.remainder = samples[n_frames * self.frame_length:].copy()
+        if n_frames == 0:
+            return b"", []
+
+        frames = samples[:n_frames * self.frame_length].reshape(n_frames, self.frame_length)
+        voiced = self.detector.is_speech(frames)
+
+        forward = []
+        events = []
+        for frame, is_voiced in zip(frames, voiced):
+            if not self.in_speech:
+                self.prepad.append(frame.copy())  # frame is a view of the caller's buffer, which may get reused
+                self.voiced_run = self.voiced_run + 1 if is_voiced else 0
+                if self.voiced_run >= self.min_speech_frames:
+                    self.in_speech = True
+                    self.silence_run = 0
+                    events.append("SPEECH_START")
+                    forward.extend(self.prepad)
+                    self.prepad.clear()
+            else:
+                forward.append(frame)
+                self.silence_run = 0 if is_voiced else self.silence_run + 1
+                if self.silence_run > self.hangover_frames:
+                    self.in_speech = False
+                    self.voiced_run = 0
+                    events.append("SPEECH_END")
+
+        if not forward:
+            return b"", events
+        return np.concatenate(forward).tobytes(), events
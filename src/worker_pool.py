@@ -0,0 +1,319 @@
+""" Pools of recognition and synthesis workers behind load balancing brokers.
+
+Recognition (Vosk) and synthesis (pico2wave) are CPU bound and single threaded, so one speech to text and one text to
+speech process only ever use two cores. With pools, the heavy lifting is done by any number of worker processes:
+
+    client  --DEALER-->  ROUTER  broker  ROUTER  <--DEALER--  worker, worker, ...
+                      "<pool>_pool"      "<pool>_pool_workers"
+
+The pools are "stt" (RECOGNIZE requests, see recognizer_worker_main in speech_to_text.py) and "tts" (SYNTHESIZE
+requests, see synthesis_worker_main in text_to_speech.py). Each stack started by run_main has its own pools.
+
+Workers tell the broker when they are READY and each request goes to the worker that has been idle longest (LRU).
+Broker and workers heartbeat each other while idle. A worker that stops heartbeating, or sits on a request for longer
+than request_timeout_s, is dropped: its request goes to another worker (once, a request that hangs two workers is
+given up on) and a WORKER_LOST message is published on the
+POOL topic so the supervisor (see supervisor.py) can replace it. A worker that stops hearing from the
+broker reconnects with a new socket.
+
+Frames, after the ROUTER's identity frame:
+    worker -> broker    b"", READY / HEARTBEAT          or  b"", client id, b"", reply
+    broker -> worker    b"", HEARTBEAT                  or  b"", client id, b"", request
+    client <-> broker   b"", request / reply
+"""
+from collections import OrderedDict, deque
+import os
+from threading import Lock, get_ident
+from time import sleep, time
+import zmq
+import message_schema as ms
+from endpoints import make_endpoints
+from supervisor import Heartbeat
+
+POOLS = ["stt", "tts"]
+HEARTBEAT_INTERVAL_S = 1.0
+HEARTBEAT_LIVENESS = 3  # heartbeats missed before the other side counts as gone
+MAX_ATTEMPTS = 2  # workers a request may time out on before it's dropped
+
+
+def worker_identity(pool: str):
+    """ unique per worker, with the pid in it so the supervisor knows which process to replace"""
+    return "{}-{}-{}".format(pool, os.getpid(), get_ident()).encode()
+
+
+def worker_pid(identity: bytes):
+    return int(identity.decode().split("-")[1])
+
+
+class PoolClient:
+    """ Sends requests to a pool and waits for the reply. Thread safe, one request at a time.
+
+    If no reply comes within timeout_s the socket is thrown away and the request sent again on a new one (the lazy
+    pirate pattern), so a late reply to the old request can't be mistaken for the reply to a new one."""
+
+    def __init__(self, context, address: str, timeout_s=30.0, retries=1):
+        """
+        :param context: zmq context
+        :param address: the pool's client address, e.g. endpoints.connect("tts_pool")
+        :param timeout_s: how long to wait for a reply. Generous, the workers may still be loading their models
+        :param retries: how many times to send a request again before giving up
+        """
+        self.context = context
+        self.address = address
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.lock = Lock()
+        self.socket = None
+        self._connect()
+
+    def _connect(self):
+        if self.socket is not None:
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.close()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.connect(self.address)
+
+    def request(self, msg):
+        """ send msg to a worker and return its reply
+
+        :raises RuntimeError: if there was no reply after all the retries
+        """
+        with self.lock:
+            for attempt in range(self.retries + 1):
+                self.socket.send_multipart([b"", ms.encode(msg)])
+                if self.socket.poll(int(self.timeout_s * 1000)):
+                    empty, payload = self.socket.recv_multipart()
+                    return ms.decode(payload)
+                print("no reply from {} after {:.0f}s".format(self.address, self.timeout_s))
+                self._connect()
+        raise RuntimeError("no reply from the worker pool at {}".format(self.address))
+
+    def close(self):
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# broker
+
+def pool_broker_main(pool: str, port_config=None, endpoints=None, context=None, request_timeout_s=30.0):
+    """ Load balances the requests of any number of clients over the workers of one pool.
+
+    :param pool: "stt" or "tts"
+    :param port_config: dict of tcp ports, used when no endpoints are given
+    :param endpoints: EndpointConfig, see endpoints.py
+    :param context: zmq context to use, e.g. the launcher's when running as a thread. One is made if None
+    :param request_timeout_s: a worker that takes longer than this over a request is counted as hung
+    """
+    if pool not in POOLS:
+        raise ValueError("unknown pool {!r}, choose from {}".format(pool, POOLS))
+    endpoints = make_endpoints(port_config, endpoints)
+    own_context = context is None
+    if own_context:
+        context = zmq.Context()
+    name = "{} POOL BROKER".format(pool.upper())
+
+    socket_system_sync = context.socket(zmq.REQ)
+    socket_system_sync.connect(endpoints.connect("system_sync"))
+
+    socket_publisher = context.socket(zmq.PUB)
+    socket_publisher.connect(endpoints.connect("pub_to_proxy"))
+
+    socket_subscriber = context.socket(zmq.SUB)
+    socket_subscriber.connect(endpoints.connect("sub_to_proxy"))
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"SYSTEM")
+
+    socket_frontend = context.socket(zmq.ROUTER)
+    socket_frontend.bind(endpoints.bind(pool + "_pool"))
+
+    socket_backend = context.socket(zmq.ROUTER)
+    socket_backend.bind(endpoints.bind(pool + "_pool_workers"))
+
+    poller = zmq.Poller()
+    for sock in [socket_frontend, socket_backend, socket_subscriber]:
+        poller.register(sock, zmq.POLLIN)
+
+    socket_system_sync.send(ms.encode(ms.Message(ms.SYNC, name)))
+    msg = socket_system_sync.recv()
+    supervisor_heartbeat = Heartbeat(context, endpoints, name).start()
+
+    ready = OrderedDict()  # worker id -> time it expires, longest idle first
+    busy = {}  # worker id -> (client id, request, attempts, deadline)
+    pending = deque()  # (client id, request, attempts) waiting for a worker
+    served = lost = 0
+    heartbeat = ms.encode(ms.Message(ms.HEARTBEAT))
+    next_heartbeat = time() + HEARTBEAT_INTERVAL_S
+
+    def worker_lost(worker_id, reason):
+        nonlocal lost
+        lost += 1
+        print("{}: lost worker {} ({})".format(name, worker_id.decode(), reason))
+        socket_publisher.send_multipart([b"POOL", ms.encode(ms.Message(ms.WORKER_LOST, worker_id.decode()))])
+
+    try:
+        while True:
+            socks = dict(poller.poll(int(HEARTBEAT_INTERVAL_S * 1000)))
+            now = time()
+            supervisor_heartbeat.beat()
+
+            if socket_subscriber in socks:
+                topic, message = socket_subscriber.recv_multipart()
+                if ms.decode(message).msg_type == ms.SHUTDOWN:
+                    break
+
+            if socket_backend in socks:
+                frames = socket_backend.recv_multipart()
+                worker_id = frames[0]
+                expiry = now + HEARTBEAT_INTERVAL_S * HEARTBEAT_LIVENESS
+                if len(frames) == 5:
+                    # a reply, pass it on. Unless it's a late one to a request that has gone to another worker since
+                    if worker_id in busy:
+                        socket_frontend.send_multipart([frames[2], b"", frames[4]])
+                        served += 1
+                        del busy[worker_id]
+                    ready[worker_id] = expiry
+                else:
+                    msg = ms.decode(frames[2])
+                    if msg.msg_type == ms.READY:
+                        if worker_id in busy:
+                            # it started again in the middle of a request, so that request needs doing again
+                            client_id, request, attempts, _ = busy.pop(worker_id)
+                            pending.appendleft((client_id, request, attempts))
+                        ready.pop(worker_id, None)
+                        ready[worker_id] = expiry
+                    elif msg.msg_type == ms.HEARTBEAT and worker_id not in busy:
+                        # a worker already in the queue keeps its place. This also takes back workers we'd given up
+                        # on, and ones that were there before the broker restarted
+                        ready[worker_id] = expiry
+
+            if socket_frontend in socks:
+                client_id, empty, request = socket_frontend.recv_multipart()
+                pending.append((client_id, request, 0))
+
+            # hand out the waiting requests, least recently used worker first
+            while pending and ready:
+                worker_id, _ = ready.popitem(last=False)
+                client_id, request, attempts = pending.popleft()
+                socket_backend.send_multipart([worker_id, b"", client_id, b"", request])
+                busy[worker_id] = (client_id, request, attempts + 1, now + request_timeout_s)
+
+            # heartbeats, and dropping workers that have gone quiet
+            if now >= next_heartbeat:
+                for worker_id in ready:
+                    socket_backend.send_multipart([worker_id, b"", heartbeat])
+                next_heartbeat = now + HEARTBEAT_INTERVAL_S
+            for worker_id in [w for w, expiry in ready.items() if expiry < now]:
+                del ready[worker_id]
+                worker_lost(worker_id, "no heartbeat")
+            for worker_id in [w for w, (_, _, _, deadline) in busy.items() if deadline < now]:
+                client_id, request, attempts, _ = busy.pop(worker_id)
+                if attempts < MAX_ATTEMPTS:
+                    pending.appendleft((client_id, request, attempts))
+                else:
+                    print("{}: giving up on a request that timed out on {} workers".format(name, attempts))
+                worker_lost(worker_id, "request timed out")
+
+    except (KeyboardInterrupt, zmq.ContextTerminated):
+        pass
+    finally:
+        supervisor_heartbeat.stop()
+        print("{}: served {} requests, lost {} workers".format(name, served, lost))
+        for sock in [socket_system_sync, socket_publisher, socket_subscriber, socket_frontend, socket_backend]:
+            sock.close(linger=0)
+        if own_context:
+            context.term()
+
+
+def recognizer_broker_main(port_config=None, endpoints=None, context=None):
+    """ broker for the pool of Vosk recognizer workers"""
+    pool_broker_main("stt", port_config, endpoints, context)
+
+
+def synthesis_broker_main(port_config=None, endpoints=None, context=None):
+    """ broker for the pool of synthesis workers"""
+    pool_broker_main("tts", port_config, endpoints, context)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# worker
+
+def run_worker(pool: str, endpoints, handle, context=None):
+    """ Serve requests for a pool until SHUTDOWN. Each request is handled in this thread, one at a time.
+
+    :param pool: "stt" or "tts"
+    :param endpoints: EndpointConfig
+    :param handle: function(request Message) -> reply Message. Exceptions are caught and answered with a "failed" ACK
+    :param context: zmq context to use, e.g. the launcher's when running as a thread. One is made if None
+    """
+    own_context = context is None
+    if own_context:
+        context = zmq.Context()
+    identity = worker_identity(pool)
+    heartbeat = ms.encode(ms.Message(ms.HEARTBEAT))
+
+    socket_subscriber = context.socket(zmq.SUB)
+    socket_subscriber.connect(endpoints.connect("sub_to_proxy"))
+    socket_subscriber.setsockopt(zmq.SUBSCRIBE, b"SYSTEM")
+
+    def connect():
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.IDENTITY, identity)
+        sock.connect(endpoints.connect(pool + "_pool_workers"))
+        sock.send_multipart([b"", ms.encode(ms.Message(ms.READY))])
+        return sock
+
+    socket_worker = connect()
+    poller = zmq.Poller()
+    poller.register(socket_worker, zmq.POLLIN)
+    poller.register(socket_subscriber, zmq.POLLIN)
+
+    liveness = HEARTBEAT_LIVENESS
+    reconnect_s = HEARTBEAT_INTERVAL_S
+    next_heartbeat = time() + HEARTBEAT_INTERVAL_S
+    try:
+        while True:
+            socks = dict(poller.poll(int(HEARTBEAT_INTERVAL_S * 1000)))
+
+            if socket_subscriber in socks:
+                topic, message = socket_subscriber.recv_multipart()
+                if ms.decode(message).msg_type == ms.SHUTDOWN:
+                    break
+
+            if socket_worker in socks:
+                frames = socket_worker.recv_multipart()
+                liveness = HEARTBEAT_LIVENESS
+                reconnect_s = HEARTBEAT_INTERVAL_S
+                if len(frames) == 4:
+                    empty, client_id, empty, payload = frames
+                    request = ms.decode(payload)
+                    try:
+                        reply = handle(request)
+                    except Exception as e:
+                        print("{}: request failed: {}".format(identity.decode(), e))
+                        reply = request.reply(ms.ACK, "failed")
+                    socket_worker.send_multipart([b"", client_id, b"", ms.encode(reply)])
+            elif socket_subscriber not in socks:
+                liveness -= 1
+                if liveness == 0:
+                    # the broker has gone quiet, start again with a new socket, backing off if it stays away
+                    print("{}: no heartbeat from the broker, reconnecting in {:.0f}s".format(identity.decode(),
+                                                                                          reconnect_s))
+                    sleep(reconnect_s)
+                    reconnect_s = min(2 * reconnect_s, 32.0)
+                    poller.unregister(socket_worker)
+                    socket_worker.close(linger=0)
+                    socket_worker = connect()
+                    poller.register(socket_worker, zmq.POLLIN)
+                    liveness = HEARTBEAT_LIVENESS
+
+            if time() >= next_heartbeat:
+                socket_worker.send_multipart([b"", heartbeat])
+                next_heartbeat = time() + HEARTBEAT_INTERVAL_S
+
+    except (KeyboardInterrupt, zmq.ContextTerminated):
+        pass
+    finally:
+        socket_worker.close(linger=0)
+        socket_subscriber.close(linger=0)
+        if own_context:
+            context.term()